@@ -9,13 +9,37 @@ st.write("---")
 
 # ==== MongoDB (conexão e utilitários) ====
 try:
-    from pymongo import MongoClient
+    from pymongo import MongoClient, IndexModel, InsertOne, UpdateOne, DeleteOne, ReplaceOne
+    from pymongo.errors import BulkWriteError
+    from pymongo import monitoring, ReadPreference
+    from pymongo.read_preferences import SecondaryPreferred
+    from bson import json_util
+    import bson
     _HAS_PYMONGO = True
 except Exception:
     _HAS_PYMONGO = False
 import uuid
-from datetime import date, datetime
+import hmac
+import atexit
+import gzip
+from datetime import date, datetime, timedelta
 import os
+import sys
+import threading
+import re
+import csv
+import io
+import unicodedata
+import itertools
+import tempfile
+import sqlite3
+import zlib
+import json
+import time
+import bisect
+import functools
+import heapq
+from concurrent.futures import ThreadPoolExecutor
 
 try:
     import certifi
@@ -23,6 +47,39 @@ try:
 except Exception:
     _TLS_CA_FILE = None
 
+# Compressão da rede com o MongoDB: zstd e snappy dependem de pacotes opcionais, zlib não
+_COMPRESSORES_MONGO = ['zlib']
+try:
+    import snappy
+    _COMPRESSORES_MONGO.insert(0, 'snappy')
+except Exception:
+    pass
+try:
+    import zstandard
+    _COMPRESSORES_MONGO.insert(0, 'zstd')
+except Exception:
+    pass
+
+try:
+    import openpyxl
+    _HAS_OPENPYXL = True
+except Exception:
+    _HAS_OPENPYXL = False
+
+try:
+    import numpy as np
+    import pandas as pd
+    _HAS_PANDAS = True
+except Exception:
+    _HAS_PANDAS = False
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    _HAS_PYARROW = True
+except Exception:
+    _HAS_PYARROW = False
+
 SOLICITANTES = [
     "Erika Gonçalves Sousa de Jesus",
     "Nathalia Duarte Ballesteros",
@@ -64,33 +121,2221 @@ def get_collection():
     if not all([username, password, cluster, db_name]):
         raise RuntimeError("Configuração de MongoDB ausente")
     conn_str = f"mongodb+srv://{username}:{password}@{cluster}/?retryWrites=true&w=majority"
-    client = MongoClient(conn_str, tls=True, tlsCAFile=_TLS_CA_FILE) if _TLS_CA_FILE else MongoClient(conn_str, tls=True)
+    opcoes = dict(_opcoes_conexao(), tls=True)
+    if _TLS_CA_FILE:
+        opcoes['tlsCAFile'] = _TLS_CA_FILE
+    if _metricas_ativas():
+        opcoes['event_listeners'] = [OuvinteMongo(get_metricas())]
+    client = MongoClient(conn_str, **opcoes)
+    _aquecer_conexoes(client)
     db = client[db_name]
-    return db["registros"]
+    col = db["registros"]
+    # Em segundo plano: create_indexes é uma ida ao servidor por coleção (e, num índice novo, a
+    # construção inteira) e não deve atrasar a partida a frio. Consultas feitas antes de o índice
+    # existir só ficam mais lentas; a Manutenção permite criá-los de novo e ver o erro.
+    threading.Thread(target=_garantir_indices_em_segundo_plano, args=(col,), daemon=True).start()
+    return col
 
-def load_all_registros():
+# ==== Pool de conexões e roteamento de leituras ====
+def _opcoes_conexao():
+    # Um MongoClient por processo, compartilhado por todas as sessões: o pool precisa comportar os
+    # usuários simultâneos e as consultas paralelas (MIDIA_CONCORRENCIA)
+    compressores = _config('MIDIA_MONGO_COMPRESSORES')
+    return {
+        'maxPoolSize': int(_config('MIDIA_MONGO_POOL_MAX', 50)),
+        'minPoolSize': int(_config('MIDIA_MONGO_POOL_MIN', 2)),
+        'maxIdleTimeMS': int(_config('MIDIA_MONGO_OCIOSO_MS', 300000)),
+        'serverSelectionTimeoutMS': int(_config('MIDIA_MONGO_SELECAO_MS', 10000)),
+        'connectTimeoutMS': int(_config('MIDIA_MONGO_CONEXAO_MS', 10000)),
+        'socketTimeoutMS': int(_config('MIDIA_MONGO_SOCKET_MS', 120000)),
+        'compressors': ','.join(_COMPRESSORES_MONGO) if compressores is None else compressores,
+    }
+
+def _preferencia_relatorios():
+    # Relatórios, exportação, agregação do dashboard no servidor e arquivo toleram alguns segundos
+    # de atraso e podem sair do primário. A sincronização do cache, as gravações e a paginação dos
+    # seletores continuam no primário, que é onde a escrita recém-feita já está visível.
+    if str(_config('MIDIA_MONGO_LEITURA_RELATORIOS', 'secondaryPreferred')) == 'primary':
+        return ReadPreference.PRIMARY
+    # O driver não aceita defasagem máxima abaixo de 90 s
+    return SecondaryPreferred(max_staleness=max(90, int(_config('MIDIA_MONGO_DEFASAGEM_MAX', 90))))
+
+def para_relatorios(colecao):
+    preferencia = _preferencia_relatorios()
+    if preferencia == ReadPreference.PRIMARY:
+        return colecao
+    return colecao.with_options(read_preference=preferencia)
+
+def _aquecer_conexoes(client):
+    # Abre conexões com o primário (e um secundário, se houver) antes da primeira consulta:
+    # seleção de servidor, TLS e autenticação saem do caminho da primeira página. Depois disso,
+    # minPoolSize mantém o pool aquecido. Pings simultâneos ocupam conexões distintas.
+    preferencias = [ReadPreference.PRIMARY] * max(1, int(_config('MIDIA_MONGO_POOL_MIN', 2)))
+    if _preferencia_relatorios() != ReadPreference.PRIMARY:
+        preferencias.append(_preferencia_relatorios())
+    def ping(preferencia):
+        try:
+            client.admin.command('ping', read_preference=preferencia)
+        except Exception:
+            # Falhas de conexão aparecem na primeira consulta de verdade, com a mensagem do driver
+            pass
+    def aquecer():
+        with ThreadPoolExecutor(max_workers=len(preferencias)) as executor:
+            list(executor.map(ping, preferencias))
+    threading.Thread(target=aquecer, name='aquecer-conexoes', daemon=True).start()
+
+# ==== Índices ====
+# Índices compostos seguem a ordem dos filtros do dashboard (igualdade antes do intervalo de datas)
+INDICES_REGISTROS = [
+    ([('solicitacao.unidade', 1), ('solicitacao.solicitante', 1), ('solicitacao.data_solicitacao', 1)], 'unidade_solicitante_data'),
+    ([('solicitacao.solicitante', 1), ('solicitacao.data_solicitacao', 1)], 'solicitante_data'),
+    ([('status', 1), ('solicitacao.data_solicitacao', 1)], 'status_data'),
+    ([('solicitacao.data_solicitacao', 1)], 'data_solicitacao'),
+    ([('faturamentos.id', 1)], 'faturamentos_id'),
+    ([('updated_at', 1)], 'updated_at'),
+]
+
+def garantir_indices(col):
+    # Idempotente: create_index não faz nada quando o índice já existe com a mesma definição
+    col.create_indexes([IndexModel(chaves, name=nome) for chaves, nome in INDICES_REGISTROS])
+    _colecao_exclusoes(col).create_index([('deleted_at', 1)], name='deleted_at')
+    _colecao_arquivo(col).create_index([('unidade', 1), ('solicitante', 1), ('data_solicitacao', 1)], name='unidade_solicitante_data')
+
+def _garantir_indices_em_segundo_plano(col):
+    try:
+        garantir_indices(col)
+    except Exception:
+        # Sem permissão de createIndex a aplicação continua funcionando (consultas sem índice)
+        pass
+
+def _estagios_plano(plano):
+    estagios = []
+    pendentes = [plano]
+    while pendentes:
+        p = pendentes.pop()
+        if 'stage' in p:
+            estagios.append(p['stage'])
+        for chave in ('inputStage', 'queryPlan'):
+            if p.get(chave):
+                pendentes.append(p[chave])
+        pendentes.extend(p.get('inputStages', []))
+    return estagios
+
+def verificar_uso_indices():
+    # Roda explain() nas consultas principais e aponta as que fariam COLLSCAN
     col = get_collection()
-    docs = list(col.find({}))
-    st.session_state['registros'] = {}
-    for d in docs:
-        rid = d.get('_id') or d.get('registro_id')
-        st.session_state['registros'][rid] = {
-            'solicitacao': d.get('solicitacao', {}),
-            'adiantamento': d.get('adiantamento', None),
-            'faturamentos': d.get('faturamentos', [])
+    hoje = date.today()
+    consultas = [
+        ('Dashboard: unidade', col, {'solicitacao.unidade': {'$in': UNIDADES[:2]}}),
+        ('Dashboard: solicitante', col, {'solicitacao.solicitante': {'$in': SOLICITANTES[:1]}}),
+        ('Dashboard: status', col, {'status': {'$in': ['Em aberto']}}),
+        ('Dashboard: período', col, {'solicitacao.data_solicitacao': {'$gte': hoje.replace(day=1).isoformat(), '$lte': hoje.isoformat()}}),
+        ('Faturamento por id', col, {'faturamentos.id': 'XXXXXXXX'}),
+        ('Sincronização', col, {'updated_at': {'$gt': datetime.utcnow()}}),
+        ('Log de exclusões', _colecao_exclusoes(col), {'deleted_at': {'$gt': datetime.utcnow()}}),
+    ]
+    resultado = []
+    for nome, colecao, filtro in consultas:
+        plano = colecao.find(filtro).explain().get('queryPlanner', {}).get('winningPlan', {})
+        estagios = _estagios_plano(plano)
+        resultado.append({
+            'Consulta': nome,
+            'Estágios': ' > '.join(reversed(estagios)),
+            'Usa índice': 'COLLSCAN' not in estagios,
+        })
+    return resultado
+
+def _config(nome, padrao=None):
+    try:
+        valor = st.secrets["midia_control"].get(nome)
+    except Exception:
+        valor = None
+    if valor is None:
+        valor = os.environ.get(nome)
+    return padrao if valor is None else valor
+
+# ==== Métricas de desempenho ====
+# Ativadas com MIDIA_METRICAS=1. Desligadas, nenhuma função é envolvida e o custo é só a leitura
+# da configuração a cada rerun.
+BUCKETS_LATENCIA = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Funções do caminho crítico medidas a cada chamada (resolvidas pelo nome no escopo do módulo)
+FUNCOES_INSTRUMENTADAS = [
+    'init_state', 'load_all_registros', '_persistir', 'calcular_consumo', 'agregar_dashboard',
+    'buscar_pagina_registros', 'importar_faturamentos', 'exibir_tabela',
+    'novo_registro', 'registrar_adiantamento', 'adicionar_faturamento', 'atualizar_registro',
+    'editar_adiantamento', 'editar_faturamento', 'excluir_registro', 'excluir_faturamento',
+    'excluir_adiantamento',
+]
+VIEWS_INSTRUMENTADAS = ['render_solicitacoes', 'render_financeiro', 'render_faturamentos', 'render_dashboard', 'render_relatorios']
+
+def _metricas_ativas():
+    return str(_config('MIDIA_METRICAS', '')).strip().lower() in ('1', 'true', 'sim')
+
+class Metricas:
+    # Histogramas de latência por função e contadores rotulados, compartilhados pelo processo
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencias = {}  # nome -> {'buckets': [...], 'soma': s, 'contagem': n, 'maximo': m}
+        self.contadores = {}  # (métrica, rótulo) -> valor
+
+    def observar(self, nome, segundos):
+        with self.lock:
+            h = self.latencias.get(nome)
+            if h is None:
+                h = self.latencias[nome] = {'buckets': [0] * (len(BUCKETS_LATENCIA) + 1), 'soma': 0.0, 'contagem': 0, 'maximo': 0.0}
+            h['buckets'][bisect.bisect_left(BUCKETS_LATENCIA, segundos)] += 1
+            h['soma'] += segundos
+            h['contagem'] += 1
+            h['maximo'] = max(h['maximo'], segundos)
+
+    def somar(self, metrica, rotulo, valor=1):
+        with self.lock:
+            chave = (metrica, rotulo)
+            self.contadores[chave] = self.contadores.get(chave, 0) + valor
+
+    def valor(self, metrica, rotulo):
+        with self.lock:
+            return self.contadores.get((metrica, rotulo), 0)
+
+    def instantaneo(self):
+        with self.lock:
+            latencias = {nome: dict(h, buckets=list(h['buckets'])) for nome, h in self.latencias.items()}
+            contadores = dict(self.contadores)
+        return latencias, contadores
+
+    def zerar(self):
+        with self.lock:
+            self.latencias = {}
+            self.contadores = {}
+
+@st.cache_resource
+def get_metricas():
+    return Metricas()
+
+if _HAS_PYMONGO:
+    class OuvinteMongo(monitoring.CommandListener):
+        # Conta idas ao MongoDB e bytes de resposta por comando (inclusive as do change stream)
+        def __init__(self, metricas):
+            self.metricas = metricas
+
+        def started(self, evento):
+            pass
+
+        def succeeded(self, evento):
+            self.metricas.somar('mongo_comandos_total', evento.command_name)
+            self.metricas.observar(f'mongo.{evento.command_name}', evento.duration_micros / 1e6)
+            try:
+                self.metricas.somar('mongo_bytes_total', evento.command_name, len(bson.encode(evento.reply)))
+            except Exception:
+                pass
+
+        def failed(self, evento):
+            self.metricas.somar('mongo_falhas_total', evento.command_name)
+
+def _medida(nome, funcao, metricas):
+    @functools.wraps(funcao)
+    def medida(*args, **kwargs):
+        inicio = time.perf_counter()
+        try:
+            return funcao(*args, **kwargs)
+        finally:
+            metricas.observar(nome, time.perf_counter() - inicio)
+    return medida
+
+def instrumentar(nomes):
+    # Substitui as funções do módulo por versões medidas; os chamadores as resolvem pelo nome
+    if not _metricas_ativas():
+        return
+    metricas = get_metricas()
+    escopo = globals()
+    for nome in nomes:
+        escopo[nome] = _medida(nome, escopo[nome], metricas)
+
+def resumo_metricas():
+    latencias, contadores = get_metricas().instantaneo()
+    linhas = []
+    for nome, h in sorted(latencias.items()):
+        # p95 aproximado pelo limite superior do bucket
+        alvo, acumulado, p95 = 0.95 * h['contagem'], 0, float('inf')
+        for limite, n in zip(BUCKETS_LATENCIA + (float('inf'),), h['buckets']):
+            acumulado += n
+            if acumulado >= alvo:
+                p95 = limite
+                break
+        linhas.append({
+            'Função': nome,
+            'Chamadas': h['contagem'],
+            'Média (ms)': round(1000 * h['soma'] / h['contagem'], 2) if h['contagem'] else 0.0,
+            'p95 (ms)': 1000 * p95,
+            'Máximo (ms)': round(1000 * h['maximo'], 2),
+        })
+    return linhas
+
+def metricas_json():
+    latencias, contadores = get_metricas().instantaneo()
+    dados = {
+        'buckets': list(BUCKETS_LATENCIA),
+        'latencias': latencias,
+        'contadores': [{'metrica': m, 'rotulo': r, 'valor': v} for (m, r), v in sorted(contadores.items())],
+    }
+    return json.dumps(dados, ensure_ascii=False, indent=2)
+
+def metricas_prometheus():
+    latencias, contadores = get_metricas().instantaneo()
+    saida = ['# TYPE midia_latencia_segundos histogram']
+    for nome, h in sorted(latencias.items()):
+        acumulado = 0
+        for limite, n in zip(BUCKETS_LATENCIA, h['buckets']):
+            acumulado += n
+            saida.append(f'midia_latencia_segundos_bucket{{funcao="{nome}",le="{limite}"}} {acumulado}')
+        saida.append(f'midia_latencia_segundos_bucket{{funcao="{nome}",le="+Inf"}} {h["contagem"]}')
+        saida.append(f'midia_latencia_segundos_sum{{funcao="{nome}"}} {h["soma"]}')
+        saida.append(f'midia_latencia_segundos_count{{funcao="{nome}"}} {h["contagem"]}')
+    tipos = set()
+    for (metrica, rotulo), valor in sorted(contadores.items()):
+        if metrica not in tipos:
+            saida.append(f'# TYPE midia_{metrica} counter')
+            tipos.add(metrica)
+        saida.append(f'midia_{metrica}{{rotulo="{rotulo}"}} {valor}')
+    return '\n'.join(saida) + '\n'
+
+# ==== Modelo de domínio ====
+# Registros em memória usam classes com __slots__: sem __dict__ por instância e sem repetir as
+# chaves em cada registro. Telas e formulários usam o acesso no estilo de dicionário
+# (reg['solicitacao']['unidade'], .get, in); os laços sobre todos os registros (totais, índices,
+# consolidação, frame do dashboard) leem os atributos direto. Documentos BSON/JSON só existem na
+# fronteira com o banco. Valores ficam em float e datas em texto ISO internado: centavos inteiros
+# economizariam menos de 1% por registro (cenário memoria_registros do benchmark.py) e o rollup,
+# onde a soma acumularia erro, já converte para centavos.
+_AUSENTE = object()
+
+class _Modelo:
+    __slots__ = ()
+    INTERNADOS = ()  # textos repetidos entre registros, guardados uma única vez (sys.intern)
+    NUMERICOS = ()  # valores monetários, convertidos para float uma vez na carga
+    CAMPOS = frozenset()  # os __slots__ da classe, para conferir a chave sem percorrer a tupla
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.CAMPOS = frozenset(cls.__slots__)
+
+    def __init__(self, **campos):
+        for nome, valor in campos.items():
+            self[nome] = valor
+
+    @classmethod
+    def de_dict(cls, d):
+        if d is None or isinstance(d, cls):
+            return d
+        obj = cls.__new__(cls)
+        for nome in cls.__slots__:
+            valor = d.get(nome, _AUSENTE)
+            if valor is not _AUSENTE:
+                obj[nome] = valor
+        return obj
+
+    def para_dict(self):
+        return {nome: _para_dict(valor) for nome, valor in self.items()}
+
+    # Acesso por chave: getattr com padrão e um frozenset, sem try/except por chamada
+    def __getitem__(self, nome):
+        if nome in self.CAMPOS:
+            valor = getattr(self, nome, _AUSENTE)
+            if valor is not _AUSENTE:
+                return valor
+        raise KeyError(nome)
+
+    def __setitem__(self, nome, valor):
+        if nome not in self.CAMPOS:
+            raise KeyError(nome)
+        if nome in self.INTERNADOS and isinstance(valor, str):
+            valor = sys.intern(valor)
+        elif nome in self.NUMERICOS and valor is not None:
+            valor = float(valor)
+        setattr(self, nome, valor)
+
+    def get(self, nome, padrao=None):
+        return getattr(self, nome, padrao) if nome in self.CAMPOS else padrao
+
+    def __contains__(self, nome):
+        return nome in self.CAMPOS and hasattr(self, nome)
+
+    def keys(self):
+        return [nome for nome in self.__slots__ if hasattr(self, nome)]
+
+    def items(self):
+        return [(nome, self[nome]) for nome in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, outro):
+        if not isinstance(outro, (_Modelo, dict)):
+            return NotImplemented
+        return self.para_dict() == _para_dict(outro)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.para_dict()!r})"
+
+def _para_dict(valor):
+    if isinstance(valor, _Modelo):
+        return valor.para_dict()
+    if isinstance(valor, dict):
+        return {k: _para_dict(v) for k, v in valor.items()}
+    if isinstance(valor, list):
+        return [_para_dict(v) for v in valor]
+    return valor
+
+class Solicitacao(_Modelo):
+    __slots__ = ('descricao', 'solicitante', 'valor_estimado', 'data_solicitacao', 'observacoes', 'unidade')
+    INTERNADOS = ('solicitante', 'unidade', 'data_solicitacao')
+    NUMERICOS = ('valor_estimado',)
+
+class Adiantamento(_Modelo):
+    __slots__ = ('valor', 'data_adiantamento', 'responsavel', 'observacao', 'unidade')
+    INTERNADOS = ('responsavel', 'unidade', 'data_adiantamento')
+    NUMERICOS = ('valor',)
+
+class Faturamento(_Modelo):
+    __slots__ = ('id', 'numero_fatura', 'valor', 'data_fatura', 'descricao', 'unidade')
+    INTERNADOS = ('unidade', 'data_fatura')
+    NUMERICOS = ('valor',)
+
+class Registro(_Modelo):
+    __slots__ = ('solicitacao', 'adiantamento', 'faturamentos', 'total_faturado', 'saldo', 'status', 'versao')
+    INTERNADOS = ('status',)
+    NUMERICOS = ('total_faturado', 'saldo')
+
+    def __setitem__(self, nome, valor):
+        # Partes aninhadas chegam como dicionários (formulários, banco) e viram modelos aqui
+        if nome == 'solicitacao':
+            valor = Solicitacao.de_dict(valor or {})
+        elif nome == 'adiantamento':
+            valor = Adiantamento.de_dict(valor)
+        elif nome == 'faturamentos':
+            valor = valor if isinstance(valor, Faturamentos) else Faturamentos(valor or [])
+        super().__setitem__(nome, valor)
+
+    def recalcular_totais(self):
+        # Mesma regra de _recalcular_totais. Roda para cada registro na carga: lê e grava os slots
+        # direto, sem o acesso por chave (os valores já são float e o status vem de status_registro)
+        adiantado = float(self.adiantamento.valor) if self.adiantamento else 0.0
+        self.total_faturado = float(sum(f.valor for f in self.faturamentos))
+        self.saldo = adiantado - self.total_faturado
+        self.status = status_registro(adiantado, self.saldo)
+        return self
+
+    def copia(self):
+        # Cópia para os helpers de mutação: o registro publicado é lido por outras sessões e não
+        # muda no lugar. Solicitação, adiantamento e cada faturamento são sempre substituídos
+        # inteiros, então basta uma lista de faturamentos nova com as mesmas referências.
+        novo = Registro.__new__(Registro)
+        for nome, valor in self.items():
+            setattr(novo, nome, Faturamentos(valor) if nome == 'faturamentos' else valor)
+        return novo
+
+class Faturamentos(list):
+    # Lista de faturamentos de um registro com índice id -> posição. Inclusões e substituições
+    # atualizam o índice; remoções o refazem a partir da posição removida; demais alterações
+    # o descartam e ele é refeito na próxima consulta.
+    __slots__ = ('_posicoes',)
+
+    def __init__(self, itens=()):
+        super().__init__(Faturamento.de_dict(f) for f in itens)
+        self._posicoes = None
+
+    def _indexar(self, inicio):
+        if self._posicoes is not None:
+            for i in range(inicio, len(self)):
+                self._posicoes[self[i].get('id')] = i
+
+    def posicao(self, fat_id):
+        if self._posicoes is None:
+            self._posicoes = {f.get('id'): i for i, f in enumerate(self)}
+        return self._posicoes.get(fat_id)
+
+    def por_id(self, fat_id):
+        i = self.posicao(fat_id)
+        return None if i is None else self[i]
+
+    def reindexar(self):
+        self._posicoes = None
+
+    def __reduce__(self):
+        return (Faturamentos, (list(self),))
+
+    def append(self, f):
+        super().append(Faturamento.de_dict(f))
+        self._indexar(len(self) - 1)
+
+    def extend(self, itens):
+        inicio = len(self)
+        super().extend(Faturamento.de_dict(f) for f in itens)
+        self._indexar(inicio)
+
+    def __iadd__(self, itens):
+        self.extend(itens)
+        return self
+
+    def __setitem__(self, i, f):
+        if isinstance(i, slice):
+            super().__setitem__(i, [Faturamento.de_dict(x) for x in f])
+            self._posicoes = None
+            return
+        anterior = self[i].get('id')
+        super().__setitem__(i, Faturamento.de_dict(f))
+        if self._posicoes is not None:
+            self._posicoes.pop(anterior, None)
+            self._indexar(i % len(self))
+
+    def __delitem__(self, i):
+        super().__delitem__(i)
+        if isinstance(i, slice) or self._posicoes is None:
+            self._posicoes = None
+            return
+        self._posicoes = {fid: pos for fid, pos in self._posicoes.items() if pos < i % (len(self) + 1)}
+        self._indexar(i % (len(self) + 1))
+
+    def insert(self, i, f):
+        super().insert(i, Faturamento.de_dict(f))
+        self._posicoes = None
+
+    def pop(self, i=-1):
+        self._posicoes = None
+        return super().pop(i)
+
+    def remove(self, f):
+        self._posicoes = None
+        super().remove(f)
+
+    def clear(self):
+        self._posicoes = None
+        super().clear()
+
+    def sort(self, *args, **kwargs):
+        self._posicoes = None
+        super().sort(*args, **kwargs)
+
+    def reverse(self):
+        self._posicoes = None
+        super().reverse()
+
+def _chave_fatura(numero):
+    return str(numero or '').strip().upper()
+
+class IndiceFaturas:
+    # numero_fatura (normalizado) -> {registro_id: quantidade}, para detectar faturas duplicadas.
+    # Guarda os números de cada registro para desfazer a contribuição anterior quando ele muda,
+    # então cada atualização custa apenas os faturamentos daquele registro.
+    def __init__(self, registros=None):
+        self.lock = threading.Lock()
+        self.por_numero = {}
+        self.por_registro = {}
+        for rid, reg in list((registros or {}).items()):
+            self._atualizar(rid, reg)
+
+    def atualizar(self, registro_id, reg):
+        # reg None remove o registro do índice
+        with self.lock:
+            self._atualizar(registro_id, reg)
+
+    def _atualizar(self, registro_id, reg):
+        for numero in self.por_registro.pop(registro_id, ()):
+            contagem = self.por_numero[numero]
+            contagem[registro_id] -= 1
+            if not contagem[registro_id]:
+                del contagem[registro_id]
+            if not contagem:
+                del self.por_numero[numero]
+        if reg is None:
+            return
+        numeros = [n for n in (_chave_fatura(f.get('numero_fatura')) for f in reg.faturamentos) if n]
+        if numeros:
+            self.por_registro[registro_id] = numeros
+            for numero in numeros:
+                contagem = self.por_numero.setdefault(numero, {})
+                contagem[registro_id] = contagem.get(registro_id, 0) + 1
+
+    def registros_com(self, numero):
+        with self.lock:
+            return dict(self.por_numero.get(_chave_fatura(numero), {}))
+
+# ==== Consolidação mensal (adiantado x faturado) ====
+def _mes(data):
+    # 'AAAA-MM' de uma data 'AAAA-MM-DD'; vazio quando a data falta ou é inválida
+    texto = str(data or '')
+    return texto[:7] if re.match(r'\d{4}-\d{2}', texto) else ''
+
+def _centavos(valor):
+    try:
+        return int(round(float(valor or 0) * 100))
+    except (TypeError, ValueError):
+        return 0
+
+def _contribuicoes_mensais(reg):
+    # {(unidade, mes, solicitante): [adiantado, faturado]} em centavos. Adiantamento e
+    # faturamentos são atribuídos à unidade da solicitação, a mesma usada nos filtros do dashboard.
+    sol = reg.solicitacao
+    unidade, solicitante = sol.get('unidade', ''), sol.get('solicitante', '')
+    contribuicoes = {}
+    ad = reg.adiantamento
+    if ad:
+        chave = (unidade, _mes(ad.get('data_adiantamento')), solicitante)
+        contribuicoes.setdefault(chave, [0, 0])[0] += _centavos(ad.get('valor'))
+    for f in reg.faturamentos:
+        chave = (unidade, _mes(f.get('data_fatura')), solicitante)
+        contribuicoes.setdefault(chave, [0, 0])[1] += _centavos(f.get('valor'))
+    return contribuicoes
+
+class RollupMensal:
+    # (unidade, mês, solicitante) -> [adiantado, faturado, registros], valores em centavos para que
+    # somar e desfazer contribuições não acumule erro. Como no IndiceFaturas, guarda a contribuição
+    # de cada registro e a desfaz quando ele muda: cada atualização custa só aquele registro.
+    def __init__(self, registros=None):
+        self.lock = threading.Lock()
+        self.totais = {}
+        self.por_registro = {}
+        for rid, reg in list((registros or {}).items()):
+            self._atualizar(rid, reg)
+
+    def atualizar(self, registro_id, reg):
+        # reg None remove o registro da consolidação
+        with self.lock:
+            self._atualizar(registro_id, reg)
+
+    def _atualizar(self, registro_id, reg):
+        for chave, (adiantado, faturado) in self.por_registro.pop(registro_id, {}).items():
+            total = self.totais[chave]
+            total[0] -= adiantado
+            total[1] -= faturado
+            total[2] -= 1
+            if not total[2]:
+                del self.totais[chave]
+        if reg is None:
+            return
+        contribuicoes = _contribuicoes_mensais(reg)
+        if contribuicoes:
+            self.por_registro[registro_id] = contribuicoes
+            for chave, (adiantado, faturado) in contribuicoes.items():
+                total = self.totais.setdefault(chave, [0, 0, 0])
+                total[0] += adiantado
+                total[1] += faturado
+                total[2] += 1
+
+    def serie(self, unidades=None, solicitantes=None, mes_ini=None, mes_fim=None):
+        # Linhas por (mês, unidade), em ordem de mês; valores sem data ficam no mês ''
+        with self.lock:
+            itens = list(self.totais.items())
+        agregado = {}
+        for (unidade, mes, solicitante), (adiantado, faturado, _) in itens:
+            if unidades and unidade not in unidades:
+                continue
+            if solicitantes and solicitante not in solicitantes:
+                continue
+            if mes and ((mes_ini and mes < mes_ini) or (mes_fim and mes > mes_fim)):
+                continue
+            total = agregado.setdefault((mes, unidade), [0, 0])
+            total[0] += adiantado
+            total[1] += faturado
+        return [
+            {'Mês': mes, 'Unidade': unidade, 'Adiantado': adiantado / 100, 'Faturado': faturado / 100}
+            for (mes, unidade), (adiantado, faturado) in sorted(agregado.items())
+        ]
+
+# ==== Busca textual (índice invertido + trigramas) ====
+# Similaridade mínima (coeficiente de Dice entre trigramas) para a busca aproximada
+SIMILARIDADE_MINIMA = 0.45
+_NAO_ALFANUMERICO = re.compile(r'[\W_]+')
+
+@functools.lru_cache(maxsize=65536)
+def _normalizar(texto):
+    # Minúsculas, sem acentos e só letras/dígitos: 'Promoção de Verão!' -> 'promocao de verao'.
+    # Em cache: solicitantes, unidades e descrições se repetem muito entre registros.
+    texto = str(texto or '')
+    if texto.isascii():
+        texto = texto.lower()
+    else:
+        texto = unicodedata.normalize('NFKD', texto).casefold()
+        texto = ''.join(c for c in texto if not unicodedata.combining(c))
+    return _NAO_ALFANUMERICO.sub(' ', texto).strip()
+
+def _trigramas(texto):
+    return {texto[i:i + 3] for i in range(len(texto) - 2)}
+
+def _termos_registro(registro_id, reg):
+    # {token: peso}; um token presente em vários campos fica com o maior peso
+    sol = reg['solicitacao'] or {}
+    ad = reg.get('adiantamento') or {}
+    campos = [
+        (registro_id, 5), (sol.get('descricao'), 3), (sol.get('solicitante'), 2), (sol.get('observacoes'), 1),
+        (sol.get('unidade'), 1), (ad.get('responsavel'), 1), (ad.get('observacao'), 1),
+    ]
+    for f in reg['faturamentos']:
+        campos.append((f.get('numero_fatura'), 4))
+        campos.append((f.get('descricao'), 1))
+    termos = {}
+    for texto, peso in campos:
+        normal = _normalizar(texto)
+        tokens = normal.split()
+        if peso >= 4 and len(tokens) > 1:
+            # Códigos também sem separadores: 'NF-2024/001' casa com 'nf2024001'
+            tokens.append(normal.replace(' ', ''))
+        for token in tokens:
+            if termos.get(token, 0) < peso:
+                termos[token] = peso
+    return termos
+
+class IndiceBusca:
+    # Índice invertido token -> {registro_id: peso} e, sobre o vocabulário, trigramas -> tokens,
+    # para busca por prefixo e aproximada (erros de digitação) sem percorrer os registros.
+    # Como o IndiceFaturas, guarda os tokens de cada registro para desfazê-los quando ele muda.
+    # Em segundo plano, a montagem inicial não atrasa a carga do cache; buscas e atualizações
+    # aguardam o fim dela.
+    def __init__(self, registros=None, em_segundo_plano=False):
+        self.lock = threading.Lock()
+        self.por_registro = {}
+        self.por_token = {}
+        self.por_trigrama = {}
+        self._atualizados = set()  # alterados durante a montagem: a versão da montagem é antiga
+        itens = list((registros or {}).items())
+        if em_segundo_plano:
+            threading.Thread(target=self._montar, args=(itens,), daemon=True).start()
+        else:
+            self._montar(itens)
+
+    def _montar(self, itens):
+        with self.lock:
+            for rid, reg in itens:
+                if rid not in self._atualizados:
+                    self._atualizar(rid, reg)
+            self._atualizados = None
+
+    def atualizar(self, registro_id, reg):
+        # reg None remove o registro do índice
+        with self.lock:
+            if self._atualizados is not None:
+                self._atualizados.add(registro_id)
+            self._atualizar(registro_id, reg)
+
+    def _atualizar(self, registro_id, reg):
+        for token in self.por_registro.pop(registro_id, ()):
+            ocorrencias = self.por_token[token]
+            del ocorrencias[registro_id]
+            if not ocorrencias:
+                del self.por_token[token]
+                for trigrama in _trigramas(f'  {token} '):
+                    tokens = self.por_trigrama[trigrama]
+                    tokens.discard(token)
+                    if not tokens:
+                        del self.por_trigrama[trigrama]
+        if reg is None:
+            return
+        termos = _termos_registro(registro_id, reg)
+        self.por_registro[registro_id] = termos
+        for token, peso in termos.items():
+            ocorrencias = self.por_token.get(token)
+            if ocorrencias is None:
+                ocorrencias = self.por_token[token] = {}
+                for trigrama in _trigramas(f'  {token} '):
+                    self.por_trigrama.setdefault(trigrama, set()).add(token)
+            ocorrencias[registro_id] = peso
+
+    def _variantes(self, termo, prefixo=True):
+        # Tokens do vocabulário que atendem ao termo -> qualidade da correspondência (0 a 1)
+        variantes = {}
+        if termo in self.por_token:
+            variantes[termo] = 1.0
+        # Prefixo: os trigramas de '  termo' só aparecem juntos no início de um token
+        conjuntos = sorted((self.por_trigrama.get(t, set()) for t in _trigramas(f'  {termo}')), key=len) if prefixo else None
+        if conjuntos and conjuntos[0]:
+            for token in conjuntos[0].intersection(*conjuntos[1:]):
+                if token != termo and token.startswith(termo):
+                    variantes[token] = 0.8
+        # Aproximada, quando não há correspondência exata nem por prefixo: coeficiente de Dice entre
+        # os trigramas do termo e os de cada token candidato. Só para palavras: em códigos (nº de
+        # fatura, registro, ano) um dígito trocado é outro documento, e os trigramas de 'nf...'
+        # percorreriam todos os números de fatura do vocabulário
+        if len(termo) >= 4 and not variantes and not any(c.isdigit() for c in termo):
+            trigramas = _trigramas(f'  {termo} ')
+            comuns = {}
+            for trigrama in trigramas:
+                for token in self.por_trigrama.get(trigrama, ()):
+                    comuns[token] = comuns.get(token, 0) + 1
+            for token, n in comuns.items():
+                similaridade = 2 * n / (len(trigramas) + len(token) + 1)
+                if similaridade >= SIMILARIDADE_MINIMA and similaridade * 0.6 > variantes.get(token, 0):
+                    variantes[token] = similaridade * 0.6
+        return variantes
+
+    def buscar(self, consulta, limite=None, aceitar=None):
+        # [(registro_id, pontuação)] em ordem decrescente de relevância; todos os termos precisam casar.
+        # Prefixo vale para termos de 3+ caracteres e para o último, que ainda pode estar sendo digitado.
+        # Com limite, só os 'limite' primeiros aceitos por aceitar(registro_id): um termo comum casa
+        # com boa parte dos registros, e o seletor mostra uma página.
+        termos = _normalizar(consulta).split()
+        if not termos:
+            return []
+        pontos = None
+        with self.lock:
+            variantes = [self._variantes(t, len(t) >= 3 or i == len(termos) - 1) for i, t in enumerate(termos)]
+            custos = [sum(len(self.por_token[token]) for token in v) for v in variantes]
+            # Termos mais seletivos primeiro; quando restam poucos registros, os termos seguintes
+            # são conferidos nos tokens de cada um em vez de percorrer as ocorrências do termo
+            for custo, v in sorted(zip(custos, variantes), key=lambda par: par[0]):
+                if pontos is None or custo <= len(pontos):
+                    do_termo = {}
+                    for token, qualidade in v.items():
+                        if not do_termo:
+                            # Primeiro token do termo: cópia das ocorrências, sem comparar uma a uma
+                            ocorrencias = self.por_token[token]
+                            do_termo = dict(ocorrencias) if qualidade == 1.0 else {rid: qualidade * peso for rid, peso in ocorrencias.items()}
+                            continue
+                        for rid, peso in self.por_token[token].items():
+                            if qualidade * peso > do_termo.get(rid, 0):
+                                do_termo[rid] = qualidade * peso
+                    pontos = do_termo if pontos is None else {rid: pontos[rid] + p for rid, p in do_termo.items() if rid in pontos}
+                else:
+                    # Por registro, percorre o lado menor: as variantes do termo (consulta às
+                    # ocorrências de cada uma) ou os tokens do registro
+                    ocorrencias = [(self.por_token[token], qualidade) for token, qualidade in v.items()]
+                    restantes = {}
+                    for rid, p in pontos.items():
+                        termos_rid = self.por_registro[rid]
+                        if len(ocorrencias) < len(termos_rid):
+                            melhor = max((qualidade * o[rid] for o, qualidade in ocorrencias if rid in o), default=0)
+                        else:
+                            melhor = max((v[token] * peso for token, peso in termos_rid.items() if token in v), default=0)
+                        if melhor:
+                            restantes[rid] = p + melhor
+                    pontos = restantes
+                if not pontos:
+                    return []
+        ordem = [(-p, rid) for rid, p in pontos.items()]
+        if limite is None and aceitar is None:
+            ordem.sort()
+            return [(rid, -p) for p, rid in ordem]
+        # Heap em vez de ordenar tudo: retira em ordem de relevância até completar o limite
+        heapq.heapify(ordem)
+        encontrados = []
+        while ordem and (limite is None or len(encontrados) < limite):
+            p, rid = heapq.heappop(ordem)
+            if aceitar is None or aceitar(rid):
+                encontrados.append((rid, -p))
+        return encontrados
+
+def _doc_para_registro(d):
+    reg = Registro(
+        solicitacao=d.get('solicitacao', {}),
+        adiantamento=d.get('adiantamento', None),
+        faturamentos=d.get('faturamentos', []),
+        versao=d.get('versao') or 0,
+    )
+    if d.get('total_faturado') is not None and d.get('saldo') is not None and d.get('status'):
+        reg['total_faturado'] = float(d['total_faturado'])
+        reg['saldo'] = float(d['saldo'])
+        reg['status'] = d['status']
+    else:
+        # Documento ainda sem totais materializados (anterior ao backfill)
+        reg.recalcular_totais()
+    return reg
+
+def _recalcular_totais(reg):
+    # Espelha na cópia local os campos materializados mantidos no MongoDB por _ESTAGIOS_TOTAIS.
+    # Para documentos (backend SQLite); registros em memória usam Registro.recalcular_totais.
+    adiantado = float(reg['adiantamento']['valor']) if reg['adiantamento'] else 0.0
+    reg['total_faturado'] = sum(float(f['valor']) for f in reg['faturamentos'])
+    reg['saldo'] = adiantado - reg['total_faturado']
+    reg['status'] = status_registro(adiantado, reg['saldo'])
+    return reg
+
+# ==== Tarefas em segundo plano ====
+# Recursos do processo (cache de registros, fila de gravação) mantêm laços em threads e, no caso do
+# snapshot, uma gravação na saída (atexit). Limpar o st.cache_resource refaz o recurso; as tarefas do
+# anterior têm de parar, senão acumulam a cada limpeza. Nem variável de módulo (o script é reexecutado
+# a cada interação) nem recurso em cache (é limpo junto) sobrevivem para lembrar delas: o registro são
+# as próprias threads, marcadas com o tipo e o dono da tarefa. O dono expõe o evento parar, que os
+# laços consultam, e encerrar(), para destravar o que estiver bloqueado.
+def _donos_de_tarefas(tipo):
+    donos = {}
+    for tarefa in threading.enumerate():
+        tipo_tarefa, dono = getattr(tarefa, 'tarefa_midia', (None, None))
+        if tipo_tarefa == tipo:
+            donos[id(dono)] = dono
+    return list(donos.values())
+
+def _encerrar_tarefas(dono):
+    for tarefa in threading.enumerate():
+        if getattr(tarefa, 'tarefa_midia', (None, None))[1] is dono and getattr(tarefa, 'ao_sair', None):
+            atexit.unregister(tarefa.ao_sair)
+    dono.encerrar()
+
+def _iniciar_tarefa(tipo, dono, alvo, *args, ao_sair=None):
+    # Um dono novo do mesmo tipo substitui os anteriores: as tarefas deles param. ao_sair é registrado
+    # no atexit junto com a tarefa e sai de lá quando ela é encerrada.
+    for anterior in _donos_de_tarefas(tipo):
+        if anterior is not dono and not anterior.parar.is_set():
+            _encerrar_tarefas(anterior)
+    if dono.parar.is_set():
+        return None
+    tarefa = threading.Thread(target=alvo, args=args, name=tipo, daemon=True)
+    tarefa.tarefa_midia = (tipo, dono)
+    tarefa.ao_sair = ao_sair
+    tarefa.start()
+    if ao_sair is not None:
+        atexit.register(ao_sair)
+    return tarefa
+
+# ==== Cache compartilhado de registros (um por processo) ====
+COLECAO_EXCLUSOES = "registros_excluidos"
+
+def _colecao_exclusoes(col):
+    # Log de exclusões: excluir_registro apaga o documento, então a sincronização incremental
+    # depende deste log para saber o que remover
+    return col.database[COLECAO_EXCLUSOES]
+
+# ==== Arquivo de registros encerrados ====
+# Registros encerrados sem movimentação há mais de MIDIA_ARQUIVO_DIAS saem do conjunto ativo
+# (carga, cache, dashboard) para uma coleção/tabela à parte: uma linha de resumo por registro, com
+# o documento completo comprimido. Relatórios consultam o arquivo sob demanda.
+COLECAO_ARQUIVO = "registros_arquivados"
+COLUNAS_ARQUIVO = ('descricao', 'unidade', 'solicitante', 'data_solicitacao', 'adiantado', 'total_faturado',
+                   'faturamentos', 'ultima_movimentacao', 'arquivado_em')
+
+def _colecao_arquivo(col):
+    return col.database[COLECAO_ARQUIVO]
+
+def _ultima_movimentacao(reg):
+    # Data (AAAA-MM-DD) do último adiantamento ou faturamento; sem eles, a da solicitação
+    datas = [f.get('data_fatura') or '' for f in reg.get('faturamentos') or []]
+    datas.append((reg.get('adiantamento') or {}).get('data_adiantamento') or '')
+    datas.append((reg.get('solicitacao') or {}).get('data_solicitacao') or '')
+    return max(str(d) for d in datas)
+
+def _linha_arquivo(doc, arquivado_em):
+    sol = doc.get('solicitacao') or {}
+    return {
+        '_id': doc['_id'],
+        'descricao': sol.get('descricao', ''),
+        'unidade': sol.get('unidade', ''),
+        'solicitante': sol.get('solicitante', ''),
+        'data_solicitacao': sol.get('data_solicitacao', ''),
+        'adiantado': float(doc['adiantamento']['valor']) if doc.get('adiantamento') else 0.0,
+        'total_faturado': sum(float(f.get('valor', 0)) for f in doc.get('faturamentos') or []),
+        'faturamentos': len(doc.get('faturamentos') or []),
+        'ultima_movimentacao': _ultima_movimentacao(doc),
+        'arquivado_em': arquivado_em,
+        'doc': zlib.compress(json.dumps(doc, default=_json_padrao).encode('utf-8'), 9),
+    }
+
+def _doc_do_arquivo(comprimido):
+    return json.loads(zlib.decompress(comprimido).decode('utf-8'), object_hook=_json_objeto)
+
+# ==== Snapshot local dos registros ====
+# Cópia comprimida do cache em disco, para que a primeira pintura após um reinício não espere a
+# carga completa do banco. Com pyarrow: arquivo Arrow IPC (zstd), lido por memory map; sem ele,
+# JSON por linha em gzip. Um documento JSON por registro, no mesmo formato do backend SQLite.
+SNAPSHOT_FORMATO = 1
+
+def _arquivo_snapshot():
+    # MIDIA_SNAPSHOT_ARQUIVO vazio desliga o snapshot
+    return str(_config('MIDIA_SNAPSHOT_ARQUIVO', 'midia_control_snapshot'))
+
+def _escrever_snapshot(caminho, origem, registros, marca):
+    linhas = [json.dumps(dict(_para_dict(reg), _id=rid), default=_json_padrao) for rid, reg in registros]
+    meta = json.dumps({'formato': SNAPSHOT_FORMATO, 'origem': origem, 'marca': marca.isoformat() if marca else None})
+    # Grava num temporário da mesma pasta e troca de uma vez: leitores nunca veem um arquivo pela metade
+    fd, temporario = tempfile.mkstemp(prefix='.snapshot-', dir=os.path.dirname(os.path.abspath(caminho)))
+    try:
+        with os.fdopen(fd, 'wb') as arquivo:
+            if _HAS_PYARROW:
+                tabela = pa.table({'doc': pa.array(linhas, pa.large_string())}).replace_schema_metadata({'midia_control': meta})
+                compressao = 'zstd' if pa.Codec.is_available('zstd') else None
+                with pa.ipc.new_file(arquivo, tabela.schema, options=pa.ipc.IpcWriteOptions(compression=compressao)) as escritor:
+                    escritor.write_table(tabela, max_chunksize=10000)
+            else:
+                with gzip.GzipFile(fileobj=arquivo, mode='wb', compresslevel=6) as gz:
+                    gz.write((meta + '\n').encode('utf-8'))
+                    for linha in linhas:
+                        gz.write((linha + '\n').encode('utf-8'))
+        os.replace(temporario, caminho)
+    except Exception:
+        try:
+            os.unlink(temporario)
+        except OSError:
+            pass
+        raise
+
+def _ler_snapshot(caminho, origem):
+    # Devolve (docs, marca), ou None se o arquivo não existe ou é de outro banco/formato
+    if not os.path.exists(caminho):
+        return None
+    with open(caminho, 'rb') as arquivo:
+        magica = arquivo.read(6)
+    if magica == b'ARROW1':
+        if not _HAS_PYARROW:
+            return None
+        with pa.memory_map(caminho) as mapa:
+            tabela = pa.ipc.open_file(mapa).read_all()
+            meta = json.loads(tabela.schema.metadata[b'midia_control'])
+            linhas = tabela.column('doc').to_pylist()
+    else:
+        with gzip.open(caminho, 'rt', encoding='utf-8') as gz:
+            meta = json.loads(gz.readline())
+            linhas = gz.read().splitlines()
+    if meta.get('formato') != SNAPSHOT_FORMATO or meta.get('origem') != origem:
+        return None
+    marca = datetime.fromisoformat(meta['marca']) if meta.get('marca') else None
+    return [json.loads(linha, object_hook=_json_objeto) for linha in linhas], marca
+
+class CacheRegistros:
+    # Mantém uma única cópia dos registros para todas as sessões. O dicionário publicado em
+    # self.registros nunca ganha/perde chaves no lugar: inclusões e exclusões geram um novo
+    # dicionário (cópia rasa), para não quebrar sessões que estejam iterando sobre ele.
+    def __init__(self, backend):
+        self.backend = backend
+        self.registros = {}
+        self.lock = threading.Lock()
+        self.modo = None
+        self.ultima_atualizacao = None
+        self.marca = None  # maior updated_at/deleted_at já aplicado (high-water mark)
+        self.atualizado_em = {}  # updated_at do documento de cada registro, quando conhecido
+        self._ultimo_sync = 0.0
+        self.fila = None  # FilaGravacao, quando o modo write-behind está ativo
+        self.versao = 0  # cresce a cada alteração nos dados; chave dos dados derivados
+        self.faturas = IndiceFaturas()
+        self.rollup = RollupMensal()
+        self.busca = IndiceBusca()
+        self.snapshot = _arquivo_snapshot()
+        self.versao_snapshot = None  # versão dos dados gravada no snapshot
+        self.snapshot_gravado_em = None
+        self.origem = 'banco'
+        self.reconciliado = True
+        self.parar = threading.Event()  # sinalizado quando outro cache assume as tarefas
+        self.stream = None
+        if self._carregar_snapshot():
+            # Primeira pintura com o snapshot; change stream e reconciliação com o banco em segundo plano
+            self.origem = 'snapshot'
+            self.reconciliado = False
+            _iniciar_tarefa('cache-registros', self, self._iniciar_sincronizacao, True)
+        else:
+            self._iniciar_sincronizacao(False)
+        if self.snapshot:
+            _iniciar_tarefa('cache-registros', self, self._gravar_snapshot_periodicamente, ao_sair=self.gravar_snapshot)
+
+    def encerrar(self):
+        # O change stream é fechado para destravar a thread que o acompanha
+        self.parar.set()
+        stream = self.stream
+        if stream is not None:
+            try:
+                stream.close()
+            except Exception:
+                pass
+
+    def _iniciar_sincronizacao(self, reconciliar):
+        try:
+            # Abre o change stream antes da carga para não perder alterações feitas no intervalo
+            stream = self.backend.assistir()
+        except Exception:
+            stream = None
+        # Change streams exigem replica set; sem eles, sincronização incremental por updated_at
+        modo = 'change_stream' if stream is not None else 'incremental'
+        if reconciliar:
+            self._reconciliar()
+        else:
+            self.carregar()
+        self.modo = modo
+        if stream is not None:
+            _iniciar_tarefa('cache-registros', self, self._acompanhar_stream, stream)
+        else:
+            _iniciar_tarefa('cache-registros', self, self._acompanhar_incremental)
+
+    def _carregar_snapshot(self):
+        if not self.snapshot:
+            return False
+        try:
+            lido = _ler_snapshot(self.snapshot, self.backend.origem)
+        except Exception:
+            # Snapshot corrompido ou ilegível: segue para a carga completa
+            return False
+        if lido is None:
+            return False
+        docs, marca = lido
+        novos = {d['_id']: _doc_para_registro(d) for d in docs}
+        faturas = IndiceFaturas(novos)
+        rollup = RollupMensal(novos)
+        busca = IndiceBusca(novos, em_segundo_plano=True)
+        with self.lock:
+            self.registros = novos
+            self.faturas = faturas
+            self.rollup = rollup
+            self.busca = busca
+            self.marca = marca
+            self.versao += 1
+            self.versao_snapshot = self.versao
+            self.ultima_atualizacao = datetime.utcnow()
+        return True
+
+    def _reconciliar(self):
+        # Traz do banco o que mudou depois da marca gravada no snapshot, exclusões inclusive.
+        # Com o banco fora do ar, os dados do snapshot continuam servindo e a tentativa se repete.
+        while not self.parar.is_set():
+            try:
+                docs, excluidos = self.backend.alterados_desde(self._desde())
+                if docs or excluidos:
+                    self._aplicar_lote(docs, excluidos)
+                self._ultimo_sync = time.monotonic()
+                self.reconciliado = True
+                return
+            except Exception:
+                self.parar.wait(float(_config('MIDIA_SYNC_INTERVALO', 10)))
+
+    def gravar_snapshot(self):
+        # Só grava se os dados mudaram desde o último snapshot
+        if not self.snapshot or self.versao == self.versao_snapshot:
+            return False
+        with self.lock:
+            versao, marca, registros = self.versao, self.marca, list(self.registros.items())
+        _escrever_snapshot(self.snapshot, self.backend.origem, registros, marca)
+        self.versao_snapshot = versao
+        self.snapshot_gravado_em = datetime.utcnow()
+        return True
+
+    def _gravar_snapshot_periodicamente(self):
+        intervalo = float(_config('MIDIA_SNAPSHOT_INTERVALO', 300))
+        while not self.parar.is_set():
+            try:
+                self.gravar_snapshot()
+            except Exception:
+                pass
+            self.parar.wait(intervalo)
+
+    def _pendentes(self):
+        # Registros com gravações ainda na fila: a cópia local está à frente do banco
+        return self.fila.registros_pendentes() if self.fila is not None else set()
+
+    def carregar(self):
+        novos = {}
+        atualizado_em = {}
+        marca = None
+        for d in self.backend.carregar():
+            rid = d.get('_id') or d.get('registro_id')
+            novos[rid] = _doc_para_registro(d)
+            atualizado_em[rid] = d.get('updated_at')
+            marca = _maior_data(marca, d.get('updated_at'))
+        for rid in self._pendentes():
+            if rid in self.registros:
+                novos[rid] = self.registros[rid]
+        faturas = IndiceFaturas(novos)
+        rollup = RollupMensal(novos)
+        busca = IndiceBusca(novos, em_segundo_plano=True)
+        with self.lock:
+            self.registros = novos
+            self.atualizado_em = atualizado_em
+            self.faturas = faturas
+            self.rollup = rollup
+            self.busca = busca
+            self.marca = marca
+            self._ultimo_sync = time.monotonic()
+            self.versao += 1
+            self.ultima_atualizacao = datetime.utcnow()
+
+    def sincronizar(self, forcar=False):
+        # Busca apenas o que mudou desde a última marca. A margem cobre relógios levemente
+        # diferentes entre instâncias; o que volta dentro dela e já está na cópia local é ignorado.
+        if self.modo != 'incremental':
+            return 0
+        if not forcar and time.monotonic() - self._ultimo_sync < float(_config('MIDIA_SYNC_MIN_INTERVALO', 1)):
+            return 0
+        self._ultimo_sync = time.monotonic()
+        docs, excluidos = self.backend.alterados_desde(self._desde())
+        if docs or excluidos:
+            return self._aplicar_lote(docs, excluidos)
+        return 0
+
+    def _desde(self):
+        if self.marca is None:
+            return None
+        return self.marca - timedelta(seconds=float(_config('MIDIA_SYNC_MARGEM', 30)))
+
+    def _aplicar_lote(self, docs, excluidos):
+        # Aplica só os documentos mais novos que a cópia local e as exclusões de registros ainda
+        # presentes; a versão dos dados avança apenas quando algo mudou. Devolve quantos mudaram.
+        pendentes = self._pendentes()
+        por_id = {d['_id']: d for d in docs}
+        with self.lock:
+            marca = self.marca
+            alterados = {}
+            for rid, d in por_id.items():
+                marca = _maior_data(marca, d.get('updated_at'))
+                if rid in pendentes:
+                    continue
+                conhecido = self.atualizado_em.get(rid)
+                if rid in self.registros and conhecido is not None and d.get('updated_at') is not None and d['updated_at'] <= conhecido:
+                    continue
+                alterados[rid] = d
+            removidos = []
+            for e in excluidos:
+                marca = _maior_data(marca, e.get('deleted_at'))
+                # Só remove se o registro não foi regravado depois da exclusão
+                atual = por_id.get(e['_id'])
+                if (e['_id'] in self.registros or e['_id'] in alterados) and (atual is None or (atual.get('updated_at') and atual['updated_at'] < e['deleted_at'])):
+                    removidos.append(e['_id'])
+            self.marca = marca
+            if not alterados and not removidos:
+                return 0
+            # Substituições mantêm o dicionário publicado; inclusões e exclusões geram uma cópia
+            novos = self.registros
+            if removidos or any(rid not in novos for rid in alterados):
+                novos = dict(novos)
+            for rid, d in alterados.items():
+                reg = _doc_para_registro(d)
+                novos[rid] = reg
+                self.atualizado_em[rid] = d.get('updated_at')
+                self.faturas.atualizar(rid, reg)
+                self.rollup.atualizar(rid, reg)
+                self.busca.atualizar(rid, reg)
+            for rid in removidos:
+                novos.pop(rid, None)
+                self.atualizado_em.pop(rid, None)
+                self.faturas.atualizar(rid, None)
+                self.rollup.atualizar(rid, None)
+                self.busca.atualizar(rid, None)
+            self.registros = novos
+            self.versao += 1
+            self.ultima_atualizacao = datetime.utcnow()
+            return len(alterados) + len(removidos)
+
+    def aplicar(self, registro_id, reg, atualizado_em=None):
+        # Sem atualizado_em (alteração feita por esta instância), a próxima sincronização aceita
+        # o documento do banco uma vez
+        with self.lock:
+            self.atualizado_em[registro_id] = atualizado_em
+            self.faturas.atualizar(registro_id, reg)
+            self.rollup.atualizar(registro_id, reg)
+            self.busca.atualizar(registro_id, reg)
+            if registro_id in self.registros:
+                self.registros[registro_id] = reg
+            else:
+                novos = dict(self.registros)
+                novos[registro_id] = reg
+                self.registros = novos
+            self.versao += 1
+            self.ultima_atualizacao = datetime.utcnow()
+
+    def remover(self, registro_id):
+        with self.lock:
+            self.atualizado_em.pop(registro_id, None)
+            self.faturas.atualizar(registro_id, None)
+            self.rollup.atualizar(registro_id, None)
+            self.busca.atualizar(registro_id, None)
+            if registro_id in self.registros:
+                novos = dict(self.registros)
+                novos.pop(registro_id, None)
+                self.registros = novos
+            self.versao += 1
+            self.ultima_atualizacao = datetime.utcnow()
+
+    def recarregar(self, registro_id, doc):
+        # Gravação recusada na drenagem da fila write-behind: a cópia local, que já tinha a
+        # alteração, volta ao documento do banco. Se o registro ainda tem gravações na fila, elas
+        # avançam o updated_at no banco e a sincronização traz o documento depois.
+        if registro_id in self._pendentes():
+            return
+        if doc is None:
+            self.remover(registro_id)
+        else:
+            self.aplicar(registro_id, _doc_para_registro(doc), doc.get('updated_at'))
+
+    def reconstruir_rollup(self):
+        rollup = RollupMensal(self.registros)
+        with self.lock:
+            self.rollup = rollup
+        return len(rollup.totais)
+
+    def remover_lote(self, registro_ids):
+        # Várias remoções numa única cópia do dicionário (arquivamento)
+        with self.lock:
+            novos = dict(self.registros)
+            for rid in registro_ids:
+                novos.pop(rid, None)
+                self.atualizado_em.pop(rid, None)
+                self.faturas.atualizar(rid, None)
+                self.rollup.atualizar(rid, None)
+                self.busca.atualizar(rid, None)
+            self.registros = novos
+            self.versao += 1
+            self.ultima_atualizacao = datetime.utcnow()
+
+    def _acompanhar_stream(self, stream):
+        intervalo = float(_config('MIDIA_SYNC_INTERVALO', 10))
+        while not self.parar.is_set():
+            self.stream = stream
+            try:
+                with stream:
+                    for ev in stream:
+                        if self.parar.is_set():
+                            break
+                        op = ev.get('operationType')
+                        if op in ('insert', 'replace', 'update'):
+                            doc = ev.get('fullDocument')
+                            if doc is not None and doc['_id'] not in self._pendentes():
+                                self.aplicar(doc['_id'], _doc_para_registro(doc), doc.get('updated_at'))
+                        elif op == 'delete':
+                            self.remover(ev['documentKey']['_id'])
+                        elif op in ('drop', 'rename', 'dropDatabase', 'invalidate'):
+                            break
+            except Exception:
+                self.parar.wait(intervalo)
+            if self.parar.is_set():
+                break
+            # Stream interrompido: reabre e recarrega para cobrir eventos perdidos
+            try:
+                stream = self.backend.assistir()
+                self.carregar()
+            except Exception:
+                self.parar.wait(intervalo)
+
+    def _acompanhar_incremental(self):
+        # Mantém o cache atualizado mesmo sem sessões ativas disparando reruns
+        intervalo = float(_config('MIDIA_SYNC_INTERVALO', 10))
+        while not self.parar.wait(intervalo):
+            try:
+                self.sincronizar(forcar=True)
+            except Exception:
+                pass
+
+def _maior_data(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return max(a, b)
+
+@st.cache_resource
+def get_cache_registros():
+    return CacheRegistros(get_backend())
+
+# ==== Fila de gravação (write-behind) ====
+def _write_behind_ativo():
+    # Só faz sentido com o MongoDB remoto; o backend SQLite já grava localmente
+    return _nome_backend() == 'mongodb' and str(_config('MIDIA_WRITE_BEHIND', '')).lower() in ('1', 'true', 'sim')
+
+class FilaGravacao:
+    # Journal SQLite local com as operações ainda não confirmadas no MongoDB. As mutações só
+    # enfileiram; uma thread drena a fila em bulk_write ordenados (mantendo a ordem das operações
+    # de cada registro), com retentativa e backoff exponencial. Cada operação leva como chave de
+    # idempotência (instância do journal, seq); o documento guarda o último seq aplicado por
+    # instância, então reenviar um lote interrompido no meio não duplica faturamentos.
+    # As condições da gravação (versao, limitar_saldo) vão no journal junto com a operação; se o
+    # filtro não casa na drenagem, a operação é recusada: vai para as falhas e ao_recusar recebe o
+    # documento atual, para a cópia local desfazer a alteração.
+    TAMANHO_LOTE = 200
+    MAX_TENTATIVAS = 5
+
+    def __init__(self, backend, caminho):
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.evento = threading.Event()
+        self.parar = threading.Event()  # sinalizado quando outra fila assume a drenagem
+        self.ultimo_erro = None
+        self.ao_recusar = None
+        self.conn = sqlite3.connect(caminho, timeout=30, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS fila (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                metodo TEXT NOT NULL,
+                registro TEXT,
+                args TEXT NOT NULL,
+                criado_em REAL NOT NULL,
+                tentativas INTEGER NOT NULL DEFAULT 0,
+                condicoes TEXT
+            )""")
+        if 'condicoes' not in {c[1] for c in self.conn.execute('PRAGMA table_info(fila)')}:
+            # Journal criado antes de as condições irem para a fila
+            self.conn.execute('ALTER TABLE fila ADD COLUMN condicoes TEXT')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS falhas (seq INTEGER PRIMARY KEY, metodo TEXT, registro TEXT, args TEXT, criado_em REAL, erro TEXT)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS fila_registro ON fila (registro)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (chave TEXT PRIMARY KEY, valor TEXT NOT NULL)')
+        self.conn.execute('INSERT OR IGNORE INTO meta VALUES (?, ?)', ('instancia', uuid.uuid4().hex[:12]))
+        self.instancia = self.conn.execute("SELECT valor FROM meta WHERE chave = 'instancia'").fetchone()[0]
+        _iniciar_tarefa('fila-gravacao', self, self._drenar)
+
+    def encerrar(self):
+        # O que ficou no journal é drenado pela fila que assumiu
+        self.parar.set()
+        self.evento.set()
+
+    def enfileirar(self, metodo, args, registro=None, condicoes=None):
+        dados = json_util.dumps(list(args), json_options=json_util.CANONICAL_JSON_OPTIONS)
+        condicoes = {k: v for k, v in (condicoes or {}).items() if v is not None and v is not False}
+        with self.lock:
+            self.conn.execute(
+                'INSERT INTO fila (metodo, registro, args, criado_em, condicoes) VALUES (?, ?, ?, ?, ?)',
+                (metodo, registro, dados, time.time(), json.dumps(condicoes) if condicoes else None))
+        self.evento.set()
+
+    def registros_pendentes(self):
+        with self.lock:
+            return {r for (r,) in self.conn.execute('SELECT DISTINCT registro FROM fila WHERE registro IS NOT NULL')}
+
+    def estado(self):
+        with self.lock:
+            pendentes, mais_antigo = self.conn.execute('SELECT COUNT(*), MIN(criado_em) FROM fila').fetchone()
+            falhas = self.conn.execute('SELECT COUNT(*) FROM falhas').fetchone()[0]
+        return {
+            'pendentes': pendentes,
+            'atraso': (time.time() - mais_antigo) if mais_antigo else 0.0,
+            'falhas': falhas,
+            'ultimo_erro': self.ultimo_erro,
         }
 
+    def _proximo_lote(self):
+        with self.lock:
+            return self.conn.execute(
+                'SELECT seq, metodo, registro, args, criado_em, tentativas, condicoes FROM fila ORDER BY seq LIMIT ?',
+                (self.TAMANHO_LOTE,)).fetchall()
+
+    def _remover(self, seqs):
+        with self.lock:
+            self.conn.executemany('DELETE FROM fila WHERE seq = ?', [(q,) for q in seqs])
+
+    def _gravar(self, lote):
+        # Cada item da fila vira uma ou mais operações; operações consecutivas da mesma coleção
+        # seguem juntas num bulk_write ordenado. Um item sai da fila só quando todas as suas
+        # operações foram confirmadas; as demais são reenviadas, e a chave de idempotência faz o
+        # banco ignorar as que já tinham sido aplicadas.
+        ops = []
+        for linha in lote:
+            args = json_util.loads(linha[3], json_options=json_util.CANONICAL_JSON_OPTIONS)
+            condicoes = json.loads(linha[6]) if linha[6] else {}
+            for colecao, modelo in self.backend.operacoes(linha[1], *args, idempotencia=(self.instancia, linha[0]), **condicoes):
+                ops.append((colecao, modelo, linha, condicoes))
+        confirmadas = set()
+        recusadas = []
+        try:
+            inicio = 0
+            while inicio < len(ops):
+                # Operações condicionais seguem sozinhas: só assim matched_count diz se o filtro casou
+                fim = inicio + 1
+                if not ops[inicio][3]:
+                    while fim < len(ops) and ops[fim][0] == ops[inicio][0] and not ops[fim][3]:
+                        fim += 1
+                try:
+                    resultado = self.backend.col.database[ops[inicio][0]].bulk_write([m for _, m, _, _ in ops[inicio:fim]], ordered=True)
+                except BulkWriteError as e:
+                    erro = e.details['writeErrors'][0]
+                    i = inicio + erro['index']
+                    confirmadas.update(range(inicio, i))
+                    if erro.get('code') == 11000 and isinstance(ops[i][1], InsertOne):
+                        # Chave duplicada: inserção já aplicada numa tentativa anterior interrompida
+                        confirmadas.add(i)
+                        inicio = i + 1
+                        continue
+                    seq, metodo, registro, args, criado_em, tentativas, _ = ops[i][2]
+                    with self.lock:
+                        if tentativas + 1 >= self.MAX_TENTATIVAS:
+                            # Erro de escrita persistente: separa a operação para não travar a fila
+                            self.conn.execute('INSERT INTO falhas VALUES (?, ?, ?, ?, ?, ?)', (seq, metodo, registro, args, criado_em, erro.get('errmsg', '')))
+                            self.conn.execute('DELETE FROM fila WHERE seq = ?', (seq,))
+                        else:
+                            self.conn.execute('UPDATE fila SET tentativas = tentativas + 1 WHERE seq = ?', (seq,))
+                    raise
+                if ops[inicio][3] and not resultado.matched_count:
+                    recusada = self._conferir_recusa(*ops[inicio])
+                    if recusada is not None:
+                        recusadas.append(recusada)
+                confirmadas.update(range(inicio, fim))
+                inicio = fim
+        finally:
+            pendentes = {linha[0] for i, (_, _, linha, _) in enumerate(ops) if i not in confirmadas}
+            self._remover([linha[0] for linha in lote if linha[0] not in pendentes])
+            if self.ao_recusar is not None:
+                for registro, doc in recusadas:
+                    self.ao_recusar(registro, doc)
+
+    def _conferir_recusa(self, colecao, modelo, linha, condicoes):
+        # Filtro sem casamento: ou a operação já tinha sido aplicada (reenvio de um lote
+        # interrompido, o documento guarda o seq) ou a condição não vale mais. Nesse caso ela sai
+        # da fila para as falhas; devolve (registro, documento atual) para desfazer a cópia local.
+        seq, metodo, registro, args, criado_em = linha[:5]
+        doc = self.backend.col.database[colecao].find_one({'_id': registro})
+        if doc is not None and (doc.get('fila') or {}).get(self.instancia, 0) >= seq:
+            return None
+        erro = _erro_saldo(registro) if condicoes.get('limitar_saldo') else _erro_versao(registro)
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO falhas VALUES (?, ?, ?, ?, ?, ?)', (seq, metodo, registro, args, criado_em, str(erro)))
+        return registro, doc
+
+    def _drenar(self):
+        intervalo = float(_config('MIDIA_WRITE_BEHIND_INTERVALO', 1))
+        espera = intervalo
+        while not self.parar.is_set():
+            self.evento.wait(timeout=intervalo)
+            self.evento.clear()
+            while not self.parar.is_set():
+                lote = self._proximo_lote()
+                if not lote:
+                    break
+                try:
+                    self._gravar(lote)
+                    self.ultimo_erro = None
+                    espera = intervalo
+                except Exception as e:
+                    self.ultimo_erro = str(e)
+                    self.parar.wait(espera)
+                    espera = min(espera * 2, 60)
+
+@st.cache_resource
+def get_fila_gravacao():
+    return FilaGravacao(get_backend(), _config('MIDIA_WRITE_BEHIND_ARQUIVO', 'midia_control_fila.db'))
+
+def _publicar_registro(registro_id, reg):
+    # Atualiza a cópia local dos registros (cache compartilhado ou, sem banco, dicionário da sessão)
+    # e avança a versão dos dados
+    if st.session_state.get('db_loaded'):
+        cache = get_cache_registros()
+        if reg is None:
+            cache.remover(registro_id)
+        else:
+            cache.aplicar(registro_id, reg)
+        st.session_state['registros'] = cache.registros
+    else:
+        if reg is not None and registro_id in st.session_state['registros']:
+            st.session_state['registros'][registro_id] = reg
+        else:
+            novos = dict(st.session_state['registros'])
+            if reg is None:
+                novos.pop(registro_id, None)
+            else:
+                novos[registro_id] = reg
+            st.session_state['registros'] = novos
+        st.session_state['_versao_sessao'] = st.session_state.get('_versao_sessao', 0) + 1
+        if '_indice_faturas' in st.session_state:
+            st.session_state['_indice_faturas'].atualizar(registro_id, reg)
+        if '_rollup_mensal' in st.session_state:
+            st.session_state['_rollup_mensal'].atualizar(registro_id, reg)
+        if '_indice_busca' in st.session_state:
+            st.session_state['_indice_busca'].atualizar(registro_id, reg)
+
+def _registro_alterado(registro_id, reg, versao=None):
+    # Chamado pelos helpers de mutação depois que a gravação deu certo, com uma cópia já alterada do
+    # registro (Registro.copia). Espelha o incremento de versão feito pelo banco (a partir da versão
+    # gravada, quando conhecida) e publica a cópia no lugar do registro anterior.
+    reg.recalcular_totais()
+    reg['versao'] = (reg.get('versao') or 0 if versao is None else versao) + 1
+    _publicar_registro(registro_id, reg)
+
+def indice_faturas():
+    # Índice global de números de fatura: o do cache compartilhado ou, sem banco, um da sessão
+    if st.session_state.get('db_loaded'):
+        return get_cache_registros().faturas
+    if '_indice_faturas' not in st.session_state:
+        st.session_state['_indice_faturas'] = IndiceFaturas(st.session_state['registros'])
+    return st.session_state['_indice_faturas']
+
+def indice_busca():
+    # Índice de busca textual: o do cache compartilhado ou, sem banco, um da sessão
+    if st.session_state.get('db_loaded'):
+        return get_cache_registros().busca
+    if '_indice_busca' not in st.session_state:
+        st.session_state['_indice_busca'] = IndiceBusca(st.session_state['registros'])
+    return st.session_state['_indice_busca']
+
+def rollup_mensal():
+    # Consolidação mensal: a do cache compartilhado ou, sem banco, uma da sessão
+    if st.session_state.get('db_loaded'):
+        return get_cache_registros().rollup
+    if '_rollup_mensal' not in st.session_state:
+        st.session_state['_rollup_mensal'] = RollupMensal(st.session_state['registros'])
+    return st.session_state['_rollup_mensal']
+
+def reconstruir_rollup_mensal():
+    # Refaz a consolidação a partir de todos os registros (dados históricos ou após divergência)
+    if st.session_state.get('db_loaded'):
+        return get_cache_registros().reconstruir_rollup()
+    st.session_state['_rollup_mensal'] = RollupMensal(st.session_state['registros'])
+    return len(st.session_state['_rollup_mensal'].totais)
+
+def faturas_duplicadas(numero_fatura, registro_id=None, fat_id=None):
+    # Registros que já têm o número de fatura informado (desconsiderando o próprio faturamento
+    # em edição). Retorna {registro_id: quantidade}.
+    if not _chave_fatura(numero_fatura):
+        return {}
+    encontrados = indice_faturas().registros_com(numero_fatura)
+    if fat_id and registro_id in encontrados:
+        reg = st.session_state['registros'].get(registro_id)
+        atual = reg['faturamentos'].por_id(fat_id) if reg else None
+        if atual is not None and _chave_fatura(atual.get('numero_fatura')) == _chave_fatura(numero_fatura):
+            encontrados[registro_id] -= 1
+            if not encontrados[registro_id]:
+                del encontrados[registro_id]
+    return encontrados
+
+def versao_dados():
+    # Identifica os dados visíveis nesta sessão: o cache compartilhado (igual para todas as
+    # sessões) ou o dicionário local da sessão, com o respectivo contador de alterações
+    if st.session_state.get('db_loaded'):
+        return ('compartilhado', get_cache_registros().versao)
+    if '_sessao_id' not in st.session_state:
+        st.session_state['_sessao_id'] = uuid.uuid4().hex
+    return (st.session_state['_sessao_id'], st.session_state.get('_versao_sessao', 0))
+
+def load_all_registros():
+    cache = get_cache_registros()
+    cache.carregar()
+    st.session_state['registros'] = cache.registros
+
 def init_state():
     if 'registros' not in st.session_state:
-        st.session_state['registros'] = {}  # {registro_id: {'solicitacao': {...}, 'adiantamento': {... or None}, 'faturamentos': []}}
-    # Carrega dados do MongoDB apenas uma vez
+        st.session_state['registros'] = {}  # {registro_id: Registro(solicitacao, adiantamento ou None, faturamentos)}
+    # Conecta ao cache compartilhado apenas uma vez por sessão; depois só atualiza a referência
     if 'db_loaded' not in st.session_state:
         try:
-            load_all_registros()
+            st.session_state['registros'] = get_cache_registros().registros
             st.session_state['db_loaded'] = True
         except Exception as e:
             st.session_state['db_loaded'] = False
-            st.warning(f"Não foi possível carregar dados do MongoDB. Usando sessão local. Detalhe: {e}")
+            st.warning(f"Não foi possível carregar dados do banco de dados ({_nome_backend()}). Usando sessão local. Detalhe: {e}")
+    elif st.session_state['db_loaded']:
+        # A cada rerun, traz só o que mudou desde a última sincronização
+        cache = get_cache_registros()
+        if _write_behind_ativo() and cache.fila is None:
+            cache.fila = get_fila_gravacao()
+            cache.fila.ao_recusar = cache.recarregar
+        try:
+            cache.sincronizar()
+        except Exception as e:
+            st.warning(f"Falha ao sincronizar com o MongoDB. Exibindo dados em cache. Detalhe: {e}")
+        st.session_state['registros'] = cache.registros
+
+# ==== Totais materializados por registro ====
+def _expr_status(adiantado, saldo):
+    # Mesma regra de status_registro, avaliada no MongoDB
+    return {'$switch': {
+        'branches': [
+            {'case': {'$and': [{'$gt': [adiantado, 0]}, {'$lte': [saldo, 0]}]}, 'then': 'Encerrado'},
+            {'case': {'$gt': [adiantado, 0]}, 'then': 'Em aberto'},
+        ],
+        'default': 'Aguardando adiantamento'
+    }}
+
+# Estágios de update (pipeline) que recalculam total_faturado, saldo e status a partir do próprio
+# documento, na mesma operação atômica que altera adiantamento/faturamentos
+_ESTAGIOS_TOTAIS = [
+    {'$set': {'total_faturado': {'$sum': '$faturamentos.valor'}}},
+    {'$set': {'saldo': {'$subtract': [{'$ifNull': ['$adiantamento.valor', 0]}, '$total_faturado']}}},
+    {'$set': {'status': _expr_status({'$ifNull': ['$adiantamento.valor', 0]}, '$saldo')}},
+]
+
+def _update_com_totais(campos):
+    # Valores do usuário vão em $literal para que strings iniciadas por '$' não virem expressões
+    return [{'$set': dict(campos, updated_at=datetime.utcnow(), versao=_EXPR_PROXIMA_VERSAO)}] + _ESTAGIOS_TOTAIS
+
+# ==== Controle de concorrência otimista ====
+# Cada gravação incrementa 'versao' no documento. Gravações que substituem um subdocumento inteiro
+# (solicitação, adiantamento) levam no filtro a versão lida; inclusões de faturamentos com limite
+# levam a condição de saldo. Se o filtro não casa, nada é gravado e a operação é recusada.
+_EXPR_PROXIMA_VERSAO = {'$add': [{'$ifNull': ['$versao', 0]}, 1]}
+
+@st.cache_resource
+def _excecoes_concorrencia():
+    # Criadas uma vez por processo: o Streamlit reexecuta o script a cada rerun, e o backend em
+    # cache (get_backend) levanta as exceções da execução em que foi criado. Classes redefinidas a
+    # cada execução não seriam capturadas pelos 'except ConflitoVersao' das execuções seguintes.
+    class ConflitoVersao(RuntimeError):
+        pass
+
+    class SaldoExcedido(RuntimeError):
+        pass
+
+    return ConflitoVersao, SaldoExcedido
+
+ConflitoVersao, SaldoExcedido = _excecoes_concorrencia()
+
+def _filtro_versao(versao):
+    # Documentos anteriores ao controle de versão não têm o campo: equivalem à versão 0
+    return {'versao': {'$in': [0, None]}} if not versao else {'versao': versao}
+
+def _expr_cabe_no_saldo(valor):
+    # Mesma regra de validar_limite_adiantamento, avaliada no servidor no momento da gravação
+    adiantado = {'$ifNull': ['$adiantamento.valor', 0]}
+    return {'$or': [
+        {'$lte': [adiantado, 0]},
+        {'$lte': [{'$add': [{'$sum': '$faturamentos.valor'}, valor]}, adiantado]},
+    ]}
+
+def _cabe_no_saldo(reg, novos):
+    adiantado = float(reg['adiantamento']['valor']) if reg.get('adiantamento') else 0.0
+    faturado = sum(float(f['valor']) for f in reg.get('faturamentos') or [])
+    return adiantado <= 0 or faturado + sum(float(f['valor']) for f in novos) <= adiantado
+
+def _erro_versao(registro_id):
+    return ConflitoVersao(f"Registro {registro_id} alterado por outro usuário")
+
+def _erro_saldo(registro_id):
+    return SaldoExcedido(f"Saldo insuficiente no registro {registro_id}")
+
+def _expr_faturamentos_mais(novos):
+    return {'$concatArrays': [{'$ifNull': ['$faturamentos', []]}, {'$literal': novos}]}
+
+def _expr_faturamentos_sem(fat_id):
+    return {'$filter': {
+        'input': {'$ifNull': ['$faturamentos', []]},
+        'as': 'f',
+        'cond': {'$ne': ['$$f.id', {'$literal': fat_id}]}
+    }}
+
+def _expr_faturamentos_editado(fat_id, campos):
+    return {'$map': {
+        'input': {'$ifNull': ['$faturamentos', []]},
+        'as': 'f',
+        'in': {'$cond': [
+            {'$eq': ['$$f.id', {'$literal': fat_id}]},
+            {'$mergeObjects': ['$$f', {'$literal': campos}]},
+            '$$f'
+        ]}
+    }}
+
+def recalcular_totais_materializados():
+    # Backfill único (e reparo): recalcula os campos materializados de todos os registros
+    col = get_collection()
+    return col.update_many({}, _ESTAGIOS_TOTAIS).modified_count
+
+def verificar_totais_materializados(tolerancia=0.005):
+    # Lista registros cujos campos materializados divergem do cálculo a partir dos faturamentos
+    col = get_collection()
+    adiantado = {'$ifNull': ['$adiantamento.valor', 0]}
+    pipeline = [
+        {'$project': {
+            'total_faturado': 1, 'saldo': 1, 'status': 1,
+            'calc_faturado': {'$sum': '$faturamentos.valor'},
+            'adiantado': adiantado,
+        }},
+        {'$addFields': {'calc_saldo': {'$subtract': ['$adiantado', '$calc_faturado']}}},
+        {'$addFields': {'calc_status': _expr_status('$adiantado', '$calc_saldo')}},
+        {'$match': {'$expr': {'$or': [
+            {'$not': [{'$isNumber': '$total_faturado'}]},
+            {'$not': [{'$isNumber': '$saldo'}]},
+            {'$gt': [{'$abs': {'$subtract': ['$total_faturado', '$calc_faturado']}}, tolerancia]},
+            {'$gt': [{'$abs': {'$subtract': ['$saldo', '$calc_saldo']}}, tolerancia]},
+            {'$ne': ['$status', '$calc_status']},
+        ]}}},
+    ]
+    return list(col.aggregate(pipeline))
+
+# ==== Backends de armazenamento ====
+# Interface comum (carregar, alterados_desde, inserir, definir_solicitacao, definir_adiantamento,
+# incluir_faturamentos, editar_faturamento, remover_faturamento, excluir,
+# incluir_faturamentos_em_lote, agregar_dashboard), implementada pelo MongoDB e por um SQLite local.
+def _nome_backend():
+    return str(_config('MIDIA_BACKEND', 'mongodb')).lower()
+
+class BackendMongo:
+    nome = 'mongodb'
+
+    def __init__(self, col):
+        self.col = col
+        self.relatorios = para_relatorios(col)
+        self.origem = f"mongodb:{col.database.name}.{col.name}"
+
+    def assistir(self):
+        return self.col.watch(full_document='updateLookup')
+
+    def carregar(self):
+        if _concorrencia() <= 1:
+            return self.col.find({})
+        # Uma consulta por unidade, em paralelo: a carga leva o tempo da maior partição, não a soma
+        return itertools.chain.from_iterable(_em_paralelo([
+            lambda filtro=filtro: list(self.col.find(filtro)) for filtro in _particoes_unidade()
+        ]))
+
+    def alterados_desde(self, desde):
+        filtro_docs = {} if desde is None else {'updated_at': {'$gt': desde}}
+        filtro_exc = {} if desde is None else {'deleted_at': {'$gt': desde}}
+        docs, excluidos = _em_paralelo([
+            lambda: list(self.col.find(filtro_docs)),
+            lambda: list(_colecao_exclusoes(self.col).find(filtro_exc)),
+        ])
+        return docs, excluidos
+
+    def operacoes(self, metodo, *args, versao=None, limitar_saldo=False, idempotencia=None):
+        # Traduz uma operação da interface em (coleção, operação de bulk_write); usado também
+        # pela fila write-behind para agrupar gravações. Inserções (chave duplicada) e exclusões
+        # já são idempotentes; nas atualizações, 'idempotencia' = (instância, seq) grava o seq em
+        # fila.<instância> e só casa documentos em que ele ainda não foi aplicado.
+        registros = self.col.name
+        if metodo == 'inserir':
+            return [(registros, InsertOne(args[0]))]
+        if metodo == 'excluir':
+            return [
+                (registros, DeleteOne({'_id': args[0]})),
+                (COLECAO_EXCLUSOES, UpdateOne({'_id': args[0]}, {'$set': {'deleted_at': datetime.utcnow()}}, upsert=True)),
+            ]
+        registro_id = args[0]
+        if metodo == 'definir_solicitacao':
+            update = {'$set': {'solicitacao': args[1], 'updated_at': datetime.utcnow()}, '$inc': {'versao': 1}}
+        elif metodo == 'definir_adiantamento':
+            update = _update_com_totais({'adiantamento': {'$literal': args[1]}})
+        elif metodo == 'incluir_faturamentos':
+            update = _update_com_totais({'faturamentos': _expr_faturamentos_mais(args[1])})
+        elif metodo == 'editar_faturamento':
+            update = _update_com_totais({'faturamentos': _expr_faturamentos_editado(args[1], args[2])})
+        elif metodo == 'remover_faturamento':
+            update = _update_com_totais({'faturamentos': _expr_faturamentos_sem(args[1])})
+        else:
+            raise ValueError(f"Operação desconhecida: {metodo}")
+        filtro = {'_id': registro_id}
+        if versao is not None:
+            filtro.update(_filtro_versao(versao))
+        if limitar_saldo:
+            filtro['$expr'] = _expr_cabe_no_saldo(sum(float(f['valor']) for f in args[1]))
+        if idempotencia is not None:
+            instancia, seq = idempotencia
+            campo = f'fila.{instancia}'
+            filtro[campo] = {'$not': {'$gte': seq}}
+            if isinstance(update, list):
+                update = update + [{'$set': {campo: seq}}]
+            else:
+                update['$set'][campo] = seq
+        return [(registros, UpdateOne(filtro, update))]
+
+    def _executar(self, metodo, *args, versao=None, limitar_saldo=False):
+        for colecao, modelo in self.operacoes(metodo, *args, versao=versao, limitar_saldo=limitar_saldo):
+            resultado = self.col.database[colecao].bulk_write([modelo])
+            if (versao is not None or limitar_saldo) and not resultado.matched_count:
+                raise _erro_saldo(args[0]) if limitar_saldo else _erro_versao(args[0])
+
+    def inserir(self, doc):
+        self._executar('inserir', doc)
+
+    def definir_solicitacao(self, registro_id, solicitacao, versao=None):
+        self._executar('definir_solicitacao', registro_id, solicitacao, versao=versao)
+
+    def definir_adiantamento(self, registro_id, adiantamento, versao=None):
+        self._executar('definir_adiantamento', registro_id, adiantamento, versao=versao)
+
+    def incluir_faturamentos(self, registro_id, faturamentos, limitar_saldo=False):
+        self._executar('incluir_faturamentos', registro_id, faturamentos, limitar_saldo=limitar_saldo)
+
+    def editar_faturamento(self, registro_id, fat_id, campos):
+        self._executar('editar_faturamento', registro_id, fat_id, campos)
+
+    def remover_faturamento(self, registro_id, fat_id):
+        self._executar('remover_faturamento', registro_id, fat_id)
+
+    def excluir(self, registro_id):
+        self._executar('excluir', registro_id)
+
+    def arquivar(self, registro_ids):
+        # Copia para o arquivo e só então apaga do conjunto ativo, com a versão lida no filtro: o
+        # registro alterado nesse intervalo não é apagado e sai do arquivo de novo
+        docs = list(self.col.find({'_id': {'$in': list(registro_ids)}, 'status': 'Encerrado'}))
+        if not docs:
+            return []
+        ids = [d['_id'] for d in docs]
+        arquivo = _colecao_arquivo(self.col)
+        agora = datetime.utcnow()
+        arquivo.bulk_write([ReplaceOne({'_id': d['_id']}, _linha_arquivo(d, agora), upsert=True) for d in docs], ordered=False)
+        self.col.bulk_write([DeleteOne(dict({'_id': d['_id']}, **_filtro_versao(d.get('versao') or 0))) for d in docs], ordered=False)
+        restantes = {d['_id'] for d in self.col.find({'_id': {'$in': ids}}, {'_id': 1})}
+        if restantes:
+            arquivo.delete_many({'_id': {'$in': list(restantes)}})
+        arquivados = [rid for rid in ids if rid not in restantes]
+        if arquivados:
+            # Pelo log de exclusões, as demais instâncias tiram os registros dos seus caches
+            _colecao_exclusoes(self.col).bulk_write([
+                UpdateOne({'_id': rid}, {'$set': {'deleted_at': agora}}, upsert=True) for rid in arquivados
+            ], ordered=False)
+        return arquivados
+
+    def listar_arquivados(self, apos, limite):
+        filtro = {} if apos is None else {'_id': {'$gt': apos}}
+        return list(para_relatorios(_colecao_arquivo(self.col)).find(filtro, {'doc': 0}).sort('_id', 1).limit(limite + 1))
+
+    def ler_arquivado(self, registro_id):
+        linha = _colecao_arquivo(self.col).find_one({'_id': registro_id}, {'doc': 1})
+        return _doc_do_arquivo(linha['doc']) if linha else None
+
+    def restaurar(self, registro_id):
+        doc = self.ler_arquivado(registro_id)
+        if doc is None:
+            return None
+        doc['updated_at'] = datetime.utcnow()
+        self.col.replace_one({'_id': registro_id}, doc, upsert=True)
+        _colecao_arquivo(self.col).delete_one({'_id': registro_id})
+        return doc
+
+    def totais_arquivados(self, unidades=None, solicitantes=None, ini=None, fim=None):
+        match = {}
+        if unidades:
+            match['unidade'] = {'$in': list(unidades)}
+        if solicitantes:
+            match['solicitante'] = {'$in': list(solicitantes)}
+        if ini and fim:
+            match['$or'] = [
+                {'data_solicitacao': {'$gte': ini.isoformat(), '$lte': fim.isoformat()}},
+                {'data_solicitacao': {'$in': [None, '']}},
+            ]
+        grupos = list(para_relatorios(_colecao_arquivo(self.col)).aggregate([
+            {'$match': match},
+            {'$group': {'_id': None, 'registros': {'$sum': 1}, 'adiantado': {'$sum': '$adiantado'}, 'faturado': {'$sum': '$total_faturado'}}},
+        ]))
+        g = grupos[0] if grupos else {}
+        return {'registros': g.get('registros', 0), 'adiantado': g.get('adiantado', 0.0), 'faturado': g.get('faturado', 0.0)}
+
+    def incluir_faturamentos_em_lote(self, por_registro, limitar_saldo=False):
+        # Um único bulk_write não ordenado; devolve {registro_id: erro} das gravações que falharam
+        rids = list(por_registro)
+        ops = [self.operacoes('incluir_faturamentos', rid, por_registro[rid], limitar_saldo=limitar_saldo)[0][1] for rid in rids]
+        try:
+            casados = self.col.bulk_write(ops, ordered=False).matched_count
+            falhas = {}
+        except BulkWriteError as e:
+            casados = e.details.get('nMatched', 0)
+            falhas = {rids[erro['index']]: erro.get('errmsg', 'Falha ao gravar') for erro in e.details.get('writeErrors', [])}
+        if limitar_saldo and casados + len(falhas) < len(rids):
+            # Alguma condição de saldo não casou: os registros que receberam o primeiro faturamento
+            # do seu lote foram gravados, os demais foram recusados
+            primeiros = [por_registro[rid][0]['id'] for rid in rids]
+            gravados = {d['_id'] for d in self.col.find({'_id': {'$in': rids}, 'faturamentos.id': {'$in': primeiros}}, {'_id': 1})}
+            for rid in rids:
+                if rid not in gravados and rid not in falhas:
+                    falhas[rid] = str(_erro_saldo(rid))
+        return falhas
+
+    def agregar_dashboard(self, unidades=None, solicitantes=None, status=None, ini=None, fim=None):
+        if _concorrencia() <= 1:
+            particoes = [([], unidades)]
+        else:
+            # Mesmos pipelines restritos a cada unidade; os parciais são somados aqui
+            particoes = [([{'$match': filtro}], None) for filtro in _particoes_unidade(unidades)]
+        tarefas = []
+        for prefixo, filtro_unidades in particoes:
+            tarefas.append(lambda p=prefixo + pipeline_dashboard(filtro_unidades, solicitantes, status, ini, fim):
+                           next(self.relatorios.aggregate(p), None) or {})
+            tarefas.append(lambda p=prefixo + pipeline_linhas_dashboard(filtro_unidades, solicitantes, status, ini, fim):
+                           list(self.relatorios.aggregate(p, batchSize=EXPORTACAO_LOTE)))
+        parciais = _em_paralelo(tarefas)
+        totais = {'registros': 0, 'adiantado': 0.0, 'faturado': 0.0}
+        linhas = []
+        for tot, linhas_particao in zip(parciais[::2], parciais[1::2]):
+            totais['registros'] += int(tot.get('registros', 0))
+            totais['adiantado'] += float(tot.get('adiantado', 0.0))
+            totais['faturado'] += float(tot.get('faturado', 0.0))
+            linhas.extend(linhas_particao)
+        return totais, linhas
+
+def _concorrencia():
+    # Máximo de consultas simultâneas ao MongoDB por operação; 1 mantém o acesso sequencial
+    return max(1, int(_config('MIDIA_CONCORRENCIA', 1)))
+
+def _particoes_unidade(unidades=None):
+    # Filtros que dividem a coleção por solicitacao.unidade. Sem seleção, uma partição por item de
+    # UNIDADES e outra para unidades fora da lista (vazias ou antigas), cobrindo todos os documentos.
+    if unidades:
+        return [{'solicitacao.unidade': u} for u in unidades]
+    return [{'solicitacao.unidade': u} for u in UNIDADES] + [{'solicitacao.unidade': {'$nin': UNIDADES}}]
+
+def _em_paralelo(tarefas):
+    # Executa as tarefas (funções sem argumentos) com no máximo _concorrencia() threads;
+    # os resultados voltam na ordem das tarefas e a primeira exceção é propagada
+    limite = min(_concorrencia(), len(tarefas))
+    if limite <= 1:
+        return [tarefa() for tarefa in tarefas]
+    with ThreadPoolExecutor(max_workers=limite) as executor:
+        return list(executor.map(lambda tarefa: tarefa(), tarefas))
+
+def _json_padrao(valor):
+    if isinstance(valor, datetime):
+        return {'$date': valor.isoformat()}
+    raise TypeError(f"Tipo não serializável: {type(valor).__name__}")
+
+def _json_objeto(d):
+    if len(d) == 1 and '$date' in d:
+        return datetime.fromisoformat(d['$date'])
+    return d
+
+class BackendSQLite:
+    # Motor embutido para instalações de um só site e testes: documento completo em JSON e as
+    # colunas usadas em filtros/totais extraídas e indexadas. WAL permite leituras durante gravações.
+    nome = 'sqlite'
+
+    def __init__(self, caminho):
+        self.origem = f"sqlite:{os.path.abspath(caminho)}"
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(caminho, timeout=30, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS registros (
+                id TEXT PRIMARY KEY,
+                doc TEXT NOT NULL,
+                unidade TEXT,
+                solicitante TEXT,
+                data_solicitacao TEXT,
+                adiantado REAL NOT NULL DEFAULT 0,
+                total_faturado REAL NOT NULL DEFAULT 0,
+                saldo REAL NOT NULL DEFAULT 0,
+                status TEXT,
+                updated_at TEXT
+            )""")
+        self.conn.execute('CREATE TABLE IF NOT EXISTS registros_excluidos (id TEXT PRIMARY KEY, deleted_at TEXT NOT NULL)')
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS registros_arquivados (
+                id TEXT PRIMARY KEY,
+                descricao TEXT,
+                unidade TEXT,
+                solicitante TEXT,
+                data_solicitacao TEXT,
+                adiantado REAL NOT NULL DEFAULT 0,
+                total_faturado REAL NOT NULL DEFAULT 0,
+                faturamentos INTEGER NOT NULL DEFAULT 0,
+                ultima_movimentacao TEXT,
+                arquivado_em TEXT,
+                doc BLOB NOT NULL
+            )""")
+        self.conn.execute('CREATE INDEX IF NOT EXISTS arquivados_unidade_solicitante_data ON registros_arquivados (unidade, solicitante, data_solicitacao)')
+        for nome, colunas in (
+            ('unidade_solicitante_data', 'unidade, solicitante, data_solicitacao'),
+            ('solicitante_data', 'solicitante, data_solicitacao'),
+            ('status_data', 'status, data_solicitacao'),
+            ('data_solicitacao', 'data_solicitacao'),
+            ('updated_at', 'updated_at'),
+        ):
+            self.conn.execute(f'CREATE INDEX IF NOT EXISTS registros_{nome} ON registros ({colunas})')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS excluidos_deleted_at ON registros_excluidos (deleted_at)')
+
+    def assistir(self):
+        return None
+
+    def _ler(self, texto):
+        return json.loads(texto, object_hook=_json_objeto)
+
+    def carregar(self):
+        with self.lock:
+            linhas = self.conn.execute('SELECT doc FROM registros').fetchall()
+        return [self._ler(doc) for (doc,) in linhas]
+
+    def alterados_desde(self, desde):
+        with self.lock:
+            if desde is None:
+                docs = self.conn.execute('SELECT doc FROM registros').fetchall()
+                excluidos = self.conn.execute('SELECT id, deleted_at FROM registros_excluidos').fetchall()
+            else:
+                docs = self.conn.execute('SELECT doc FROM registros WHERE updated_at > ?', (desde.isoformat(),)).fetchall()
+                excluidos = self.conn.execute('SELECT id, deleted_at FROM registros_excluidos WHERE deleted_at > ?', (desde.isoformat(),)).fetchall()
+        return [self._ler(doc) for (doc,) in docs], [{'_id': rid, 'deleted_at': datetime.fromisoformat(d)} for rid, d in excluidos]
+
+    def _gravar_doc(self, doc):
+        _recalcular_totais(doc)
+        sol = doc.get('solicitacao') or {}
+        adiantado = float(doc['adiantamento']['valor']) if doc.get('adiantamento') else 0.0
+        self.conn.execute(
+            'INSERT OR REPLACE INTO registros (id, doc, unidade, solicitante, data_solicitacao, adiantado, total_faturado, saldo, status, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (doc['_id'], json.dumps(doc, default=_json_padrao), sol.get('unidade', ''), sol.get('solicitante', ''), sol.get('data_solicitacao', ''),
+             adiantado, doc['total_faturado'], doc['saldo'], doc['status'], doc['updated_at'].isoformat()))
+
+    def _alterar(self, registro_id, alteracao, versao=None):
+        # Ler-alterar-gravar dentro de uma transação IMMEDIATE (um escritor por vez)
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                linha = self.conn.execute('SELECT doc FROM registros WHERE id = ?', (registro_id,)).fetchone()
+                if linha is None:
+                    self.conn.execute('ROLLBACK')
+                    return False
+                doc = self._ler(linha[0])
+                if versao is not None and (doc.get('versao') or 0) != versao:
+                    raise _erro_versao(registro_id)
+                doc.setdefault('faturamentos', [])
+                alteracao(doc)
+                doc['updated_at'] = datetime.utcnow()
+                doc['versao'] = (doc.get('versao') or 0) + 1
+                self._gravar_doc(doc)
+                self.conn.execute('COMMIT')
+                return True
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    def inserir(self, doc):
+        with self.lock:
+            self._gravar_doc(dict(doc, faturamentos=list(doc.get('faturamentos') or [])))
+
+    def definir_solicitacao(self, registro_id, solicitacao, versao=None):
+        self._alterar(registro_id, lambda doc: doc.__setitem__('solicitacao', solicitacao), versao)
+
+    def definir_adiantamento(self, registro_id, adiantamento, versao=None):
+        self._alterar(registro_id, lambda doc: doc.__setitem__('adiantamento', adiantamento), versao)
+
+    def _incluir(self, registro_id, faturamentos, limitar_saldo):
+        def alteracao(doc):
+            if limitar_saldo and not _cabe_no_saldo(doc, faturamentos):
+                raise _erro_saldo(registro_id)
+            doc['faturamentos'].extend(faturamentos)
+        return self._alterar(registro_id, alteracao)
+
+    def incluir_faturamentos(self, registro_id, faturamentos, limitar_saldo=False):
+        self._incluir(registro_id, faturamentos, limitar_saldo)
+
+    def editar_faturamento(self, registro_id, fat_id, campos):
+        def alteracao(doc):
+            for f in doc['faturamentos']:
+                if f.get('id') == fat_id:
+                    f.update(campos)
+        self._alterar(registro_id, alteracao)
+
+    def remover_faturamento(self, registro_id, fat_id):
+        def alteracao(doc):
+            doc['faturamentos'] = [f for f in doc['faturamentos'] if f.get('id') != fat_id]
+        self._alterar(registro_id, alteracao)
+
+    def excluir(self, registro_id):
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            self.conn.execute('DELETE FROM registros WHERE id = ?', (registro_id,))
+            self.conn.execute('INSERT OR REPLACE INTO registros_excluidos (id, deleted_at) VALUES (?, ?)', (registro_id, datetime.utcnow().isoformat()))
+            self.conn.execute('COMMIT')
+
+    def arquivar(self, registro_ids):
+        # Cópia para o arquivo, exclusão e log de exclusões na mesma transação
+        agora = datetime.utcnow()
+        arquivados = []
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                for rid in registro_ids:
+                    linha = self.conn.execute("SELECT doc FROM registros WHERE id = ? AND status = 'Encerrado'", (rid,)).fetchone()
+                    if linha is None:
+                        continue
+                    resumo = _linha_arquivo(self._ler(linha[0]), agora.isoformat())
+                    self.conn.execute(
+                        f"INSERT OR REPLACE INTO registros_arquivados (id, {', '.join(COLUNAS_ARQUIVO)}, doc) VALUES ({', '.join('?' * (len(COLUNAS_ARQUIVO) + 2))})",
+                        (rid, *(resumo[c] for c in COLUNAS_ARQUIVO), resumo['doc']))
+                    self.conn.execute('DELETE FROM registros WHERE id = ?', (rid,))
+                    self.conn.execute('INSERT OR REPLACE INTO registros_excluidos (id, deleted_at) VALUES (?, ?)', (rid, agora.isoformat()))
+                    arquivados.append(rid)
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+        return arquivados
+
+    def listar_arquivados(self, apos, limite):
+        with self.lock:
+            linhas = self.conn.execute(
+                f"SELECT id, {', '.join(COLUNAS_ARQUIVO)} FROM registros_arquivados WHERE id > ? ORDER BY id LIMIT ?",
+                ('' if apos is None else apos, limite + 1)).fetchall()
+        docs = [dict(zip(('_id',) + COLUNAS_ARQUIVO, linha)) for linha in linhas]
+        for d in docs:
+            d['arquivado_em'] = datetime.fromisoformat(d['arquivado_em']) if d['arquivado_em'] else None
+        return docs
+
+    def ler_arquivado(self, registro_id):
+        with self.lock:
+            linha = self.conn.execute('SELECT doc FROM registros_arquivados WHERE id = ?', (registro_id,)).fetchone()
+        return _doc_do_arquivo(linha[0]) if linha else None
+
+    def restaurar(self, registro_id):
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                doc = self.ler_arquivado(registro_id)
+                if doc is not None:
+                    doc['updated_at'] = datetime.utcnow()
+                    self._gravar_doc(doc)
+                    self.conn.execute('DELETE FROM registros_arquivados WHERE id = ?', (registro_id,))
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+        return doc
+
+    def totais_arquivados(self, unidades=None, solicitantes=None, ini=None, fim=None):
+        condicoes, params = [], []
+        for coluna, valores in (('unidade', unidades), ('solicitante', solicitantes)):
+            if valores:
+                condicoes.append(f"{coluna} IN ({', '.join('?' * len(valores))})")
+                params.extend(valores)
+        if ini and fim:
+            condicoes.append("(data_solicitacao BETWEEN ? AND ? OR data_solicitacao IS NULL OR data_solicitacao = '')")
+            params.extend([ini.isoformat(), fim.isoformat()])
+        where = f"WHERE {' AND '.join(condicoes)}" if condicoes else ''
+        with self.lock:
+            n, adiantado, faturado = self.conn.execute(
+                f'SELECT COUNT(*), COALESCE(SUM(adiantado), 0), COALESCE(SUM(total_faturado), 0) FROM registros_arquivados {where}', params).fetchone()
+        return {'registros': n, 'adiantado': adiantado, 'faturado': faturado}
+
+    def incluir_faturamentos_em_lote(self, por_registro, limitar_saldo=False):
+        falhas = {}
+        for rid, fats in por_registro.items():
+            try:
+                if not self._incluir(rid, fats, limitar_saldo):
+                    falhas[rid] = 'Registro não encontrado'
+            except Exception as e:
+                falhas[rid] = str(e)
+        return falhas
+
+    def agregar_dashboard(self, unidades=None, solicitantes=None, status=None, ini=None, fim=None):
+        condicoes, params = [], []
+        for coluna, valores in (('unidade', unidades), ('solicitante', solicitantes), ('status', status)):
+            if valores:
+                condicoes.append(f"{coluna} IN ({', '.join('?' * len(valores))})")
+                params.extend(valores)
+        if ini and fim:
+            # Mesma regra do filtro em Python: registros sem data continuam incluídos
+            condicoes.append("(data_solicitacao BETWEEN ? AND ? OR data_solicitacao IS NULL OR data_solicitacao = '')")
+            params.extend([ini.isoformat(), fim.isoformat()])
+        where = f"WHERE {' AND '.join(condicoes)}" if condicoes else ''
+        with self.lock:
+            n, adiantado, faturado = self.conn.execute(
+                f'SELECT COUNT(*), COALESCE(SUM(adiantado), 0), COALESCE(SUM(total_faturado), 0) FROM registros {where}', params).fetchone()
+            linhas = self.conn.execute(
+                f"SELECT id, solicitante, json_extract(doc, '$.solicitacao.descricao'), unidade, adiantado, total_faturado, saldo, status FROM registros {where}", params).fetchall()
+        colunas = ['Registro', 'Solicitante', 'Descrição', 'Unidade', 'Valor adiantado', 'Total faturado', 'Saldo', 'Status']
+        return {'registros': n, 'adiantado': adiantado, 'faturado': faturado}, [dict(zip(colunas, linha)) for linha in linhas]
+
+@st.cache_resource
+def get_backend():
+    if _nome_backend() == 'sqlite':
+        return BackendSQLite(_config('MIDIA_SQLITE_ARQUIVO', 'midia_control.db'))
+    return BackendMongo(get_collection())
+
+def _usa_mongo():
+    # Consultas específicas do MongoDB (paginação no servidor, exportação, manutenção)
+    return bool(st.session_state.get('db_loaded')) and _nome_backend() == 'mongodb'
+
+def _persistir(metodo, *args, **condicoes):
+    # Ponto único de gravação dos helpers de mutação: backend configurado ou fila write-behind.
+    # Na fila, as condições (versao, limitar_saldo) vão junto e são conferidas na drenagem; uma
+    # gravação recusada lá aparece nas falhas da fila e é desfeita na cópia local.
+    if _write_behind_ativo():
+        get_fila_gravacao().enfileirar(metodo, args, registro=args[0] if isinstance(args[0], str) else args[0].get('_id'), condicoes=condicoes)
+        return
+    getattr(get_backend(), metodo)(*args, **condicoes)
+
+def _conferir_versao(reg, registro_id, versao):
+    # Conferência local, contra a cópia compartilhada do processo; a do banco vem na gravação
+    if versao is not None and (reg.get('versao') or 0) != versao:
+        raise _erro_versao(registro_id)
+
+def _atualizar_apos_conflito():
+    # Traz a versão atual do banco para a cópia local, para o usuário comparar e decidir
+    if st.session_state.get('db_loaded'):
+        try:
+            cache = get_cache_registros()
+            cache.sincronizar(forcar=True)
+            st.session_state['registros'] = cache.registros
+        except Exception:
+            pass
 
 def novo_registro(descricao, solicitante, valor_estimado, data_solicitacao, observacoes, unidade=None):
     registro_id = uuid.uuid4().hex[:8].upper()
@@ -106,27 +2351,28 @@ def novo_registro(descricao, solicitante, valor_estimado, data_solicitacao, obse
         },
         'adiantamento': None,
         'faturamentos': [],
+        'total_faturado': 0.0,
+        'saldo': 0.0,
+        'status': status_registro(0.0, 0.0),
         'created_at': datetime.utcnow(),
-        'updated_at': datetime.utcnow()
+        'updated_at': datetime.utcnow(),
+        'versao': 1
     }
     # Persistir no MongoDB
     try:
-        col = get_collection()
-        col.insert_one(doc)
+        _persistir('inserir', doc)
     except Exception as e:
         st.error(f"Falha ao salvar no MongoDB: {e}")
     # Atualizar sessão
-    st.session_state['registros'][registro_id] = {
-        'solicitacao': doc['solicitacao'],
-        'adiantamento': None,
-        'faturamentos': []
-    }
+    _publicar_registro(registro_id, _doc_para_registro(doc))
     return registro_id
 
-def registrar_adiantamento(registro_id, valor, data_adiantamento, responsavel, observacao, unidade=None):
+def registrar_adiantamento(registro_id, valor, data_adiantamento, responsavel, observacao, unidade=None, versao=None):
+    # versao: a versão do registro que o usuário viu; se outro usuário gravou depois, ConflitoVersao
     reg = st.session_state['registros'].get(registro_id)
     if not reg:
         return False
+    _conferir_versao(reg, registro_id, versao)
     ad = {
         'valor': float(valor),
         'data_adiantamento': str(data_adiantamento),
@@ -134,14 +2380,19 @@ def registrar_adiantamento(registro_id, valor, data_adiantamento, responsavel, o
         'observacao': observacao or '',
         'unidade': unidade or reg['solicitacao'].get('unidade', '')
     }
-    # Atualizar sessão
-    st.session_state['registros'][registro_id]['adiantamento'] = ad
-    # Persistir no MongoDB
+    # Persistir no MongoDB (antes da sessão, para não publicar uma alteração recusada)
     try:
-        col = get_collection()
-        col.update_one({'_id': registro_id}, {'$set': {'adiantamento': ad, 'updated_at': datetime.utcnow()}})
+        _persistir('definir_adiantamento', registro_id, ad, versao=versao)
+    except ConflitoVersao:
+        _atualizar_apos_conflito()
+        raise
     except Exception as e:
         st.error(f"Falha ao atualizar adiantamento no MongoDB: {e}")
+        return False
+    # Atualizar sessão
+    novo = reg.copia()
+    novo['adiantamento'] = ad
+    _registro_alterado(registro_id, novo, versao)
     return True
 
 def adicionar_faturamento(registro_id, numero_fatura, valor, data_fatura, descricao, unidade=None):
@@ -156,20 +2407,32 @@ def adicionar_faturamento(registro_id, numero_fatura, valor, data_fatura, descri
         'descricao': descricao or '',
         'unidade': unidade or reg['adiantamento'].get('unidade') or reg['solicitacao'].get('unidade', '')
     }
-    # Atualizar sessão
-    st.session_state['registros'][registro_id]['faturamentos'].append(fat)
-    # Persistir no MongoDB (push na lista de faturamentos e atualizar updated_at)
+    # Persistir no MongoDB (acrescenta à lista de faturamentos e recalcula os totais). O limite do
+    # adiantamento é conferido na cópia local e de novo no servidor, atomicamente: outra sessão
+    # pode ter consumido o saldo depois da leitura local.
     try:
-        col = get_collection()
-        col.update_one({'_id': registro_id}, {'$push': {'faturamentos': fat}, '$set': {'updated_at': datetime.utcnow()}})
+        if not _cabe_no_saldo(reg, [fat]):
+            raise _erro_saldo(registro_id)
+        _persistir('incluir_faturamentos', registro_id, [fat], limitar_saldo=True)
+    except SaldoExcedido:
+        _atualizar_apos_conflito()
+        saldo = calcular_consumo(registro_id)[2]
+        st.error(f"O faturamento (R$ {fat['valor']:,.2f}) excede o saldo atual do registro (R$ {saldo:,.2f}).")
+        return False
     except Exception as e:
         st.error(f"Falha ao adicionar faturamento no MongoDB: {e}")
+        return False
+    # Atualizar sessão
+    novo = reg.copia()
+    novo['faturamentos'].append(fat)
+    _registro_alterado(registro_id, novo)
     return True
 
-def atualizar_registro(registro_id, descricao, solicitante, valor_estimado, data_solicitacao, observacoes, unidade=None):
+def atualizar_registro(registro_id, descricao, solicitante, valor_estimado, data_solicitacao, observacoes, unidade=None, versao=None):
     reg = st.session_state['registros'].get(registro_id)
     if not reg:
         return False
+    _conferir_versao(reg, registro_id, versao)
     solicitacao = {
         'descricao': descricao,
         'solicitante': solicitante,
@@ -178,29 +2441,30 @@ def atualizar_registro(registro_id, descricao, solicitante, valor_estimado, data
         'observacoes': observacoes or '',
         'unidade': unidade or reg['solicitacao'].get('unidade', '')
     }
-    st.session_state['registros'][registro_id]['solicitacao'] = solicitacao
     try:
-        col = get_collection()
-        col.update_one({'_id': registro_id}, {'$set': {'solicitacao': solicitacao, 'updated_at': datetime.utcnow()}})
+        _persistir('definir_solicitacao', registro_id, solicitacao, versao=versao)
+    except ConflitoVersao:
+        _atualizar_apos_conflito()
+        raise
     except Exception as e:
         st.error(f"Falha ao atualizar solicitação no MongoDB: {e}")
+        return False
+    novo = reg.copia()
+    novo['solicitacao'] = solicitacao
+    _registro_alterado(registro_id, novo, versao)
     return True
 
-def editar_adiantamento(registro_id, valor, data_adiantamento, responsavel, observacao):
-    return registrar_adiantamento(registro_id, valor, data_adiantamento, responsavel, observacao)
+def editar_adiantamento(registro_id, valor, data_adiantamento, responsavel, observacao, unidade=None, versao=None):
+    return registrar_adiantamento(registro_id, valor, data_adiantamento, responsavel, observacao, unidade, versao)
 
 def editar_faturamento(registro_id, fat_id, numero_fatura, valor, data_fatura, descricao, unidade=None):
     reg = st.session_state['registros'].get(registro_id)
     if not reg:
         return False
-    idx = None
-    for i, f in enumerate(reg['faturamentos']):
-        if f.get('id') == fat_id:
-            idx = i
-            break
+    idx = reg['faturamentos'].posicao(fat_id)
     if idx is None:
         return False
-    novo = {
+    fat = {
         'id': fat_id,
         'numero_fatura': numero_fatura or '',
         'valor': float(valor),
@@ -208,83 +2472,108 @@ def editar_faturamento(registro_id, fat_id, numero_fatura, valor, data_fatura, d
         'descricao': descricao or '',
         'unidade': unidade or reg['faturamentos'][idx].get('unidade') or reg['adiantamento'].get('unidade') or reg['solicitacao'].get('unidade', '')
     }
-    st.session_state['registros'][registro_id]['faturamentos'][idx] = novo
     try:
-        col = get_collection()
-        col.update_one(
-            {'_id': registro_id},
-            {'$set': {
-                'faturamentos.$[elem].numero_fatura': novo['numero_fatura'],
-                'faturamentos.$[elem].valor': novo['valor'],
-                'faturamentos.$[elem].data_fatura': novo['data_fatura'],
-                'faturamentos.$[elem].descricao': novo['descricao'],
-                'faturamentos.$[elem].unidade': novo['unidade'],
-                'updated_at': datetime.utcnow()
-            }},
-            array_filters=[{'elem.id': fat_id}]
-        )
+        campos = {k: v for k, v in fat.items() if k != 'id'}
+        _persistir('editar_faturamento', registro_id, fat_id, campos)
     except Exception as e:
         st.error(f"Falha ao editar faturamento no MongoDB: {e}")
+        return False
+    novo = reg.copia()
+    novo['faturamentos'][idx] = fat
+    _registro_alterado(registro_id, novo)
     return True
 
 def excluir_registro(registro_id):
-    st.session_state['registros'].pop(registro_id, None)
     try:
-        col = get_collection()
-        col.delete_one({'_id': registro_id})
+        _persistir('excluir', registro_id)
     except Exception as e:
         st.error(f"Falha ao excluir registro no MongoDB: {e}")
+        return False
+    _publicar_registro(registro_id, None)
     return True
 
+def candidatos_arquivamento(dias):
+    # Registros encerrados cuja última movimentação é anterior a hoje - dias; registros com
+    # gravações ainda na fila write-behind ficam para a próxima vez
+    limite = (date.today() - timedelta(days=int(dias))).isoformat()
+    pendentes = get_cache_registros()._pendentes() if st.session_state.get('db_loaded') else set()
+    return [
+        rid for rid, reg in list(st.session_state['registros'].items())
+        if reg.get('status') == 'Encerrado' and rid not in pendentes and '' < _ultima_movimentacao(reg) < limite
+    ]
+
+def arquivar_encerrados(dias):
+    # Só com o banco conectado: o arquivo fica no backend
+    arquivados = get_backend().arquivar(candidatos_arquivamento(dias))
+    cache = get_cache_registros()
+    cache.remover_lote(arquivados)
+    st.session_state['registros'] = cache.registros
+    return arquivados
+
+def restaurar_arquivado(registro_id):
+    doc = get_backend().restaurar(registro_id)
+    if doc is not None:
+        _publicar_registro(registro_id, _doc_para_registro(doc))
+    return doc is not None
+
 def excluir_faturamento(registro_id, fat_id):
     reg = st.session_state['registros'].get(registro_id)
     if not reg:
         return False
-    st.session_state['registros'][registro_id]['faturamentos'] = [f for f in reg['faturamentos'] if f.get('id') != fat_id]
     try:
-        col = get_collection()
-        col.update_one({'_id': registro_id}, {'$pull': {'faturamentos': {'id': fat_id}}, '$set': {'updated_at': datetime.utcnow()}})
+        _persistir('remover_faturamento', registro_id, fat_id)
     except Exception as e:
         st.error(f"Falha ao excluir faturamento no MongoDB: {e}")
+        return False
+    novo = reg.copia()
+    idx = novo['faturamentos'].posicao(fat_id)
+    if idx is not None:
+        del novo['faturamentos'][idx]
+    _registro_alterado(registro_id, novo)
     return True
 
 def excluir_adiantamento(registro_id):
     reg = st.session_state['registros'].get(registro_id)
     if not reg:
         return False
-    st.session_state['registros'][registro_id]['adiantamento'] = None
     try:
-        col = get_collection()
-        col.update_one({'_id': registro_id}, {'$set': {'adiantamento': None, 'updated_at': datetime.utcnow()}})
+        _persistir('definir_adiantamento', registro_id, None)
     except Exception as e:
         st.error(f"Falha ao excluir adiantamento no MongoDB: {e}")
+        return False
+    novo = reg.copia()
+    novo['adiantamento'] = None
+    _registro_alterado(registro_id, novo)
     return True
 
 # Novo: processo de faturamento em lote integrado
+def _normalizar_faturamento(l):
+    # Converte uma linha de lote em faturamento; None se a linha não for válida
+    try:
+        valor = float(l.get('valor', 0) or 0)
+    except (TypeError, ValueError):
+        valor = 0.0
+    numero = (l.get('numero_fatura') or '').strip()
+    desc = (l.get('descricao') or '').strip()
+    data = l.get('data_fatura')
+    # Aceita data como date/datetime/str, converte para str
+    if hasattr(data, 'isoformat'):
+        data_str = data.isoformat()
+    else:
+        data_str = str(data) if data else ''
+    if valor > 0 and (numero or desc):
+        return {
+            'id': uuid.uuid4().hex[:8].upper(),
+            'numero_fatura': numero,
+            'valor': valor,
+            'data_fatura': data_str,
+            'descricao': desc
+        }
+    return None
+
 def processar_faturamentos_em_lote(registro_id, linhas, permitir_exceder=False):
     # Normaliza e filtra linhas válidas
-    novos = []
-    for l in linhas:
-        try:
-            valor = float(l.get('valor', 0) or 0)
-        except (TypeError, ValueError):
-            valor = 0.0
-        numero = (l.get('numero_fatura') or '').strip()
-        desc = (l.get('descricao') or '').strip()
-        data = l.get('data_fatura')
-        # Aceita data como date/datetime/str, converte para str
-        if hasattr(data, 'isoformat'):
-            data_str = data.isoformat()
-        else:
-            data_str = str(data) if data else ''
-        if valor > 0 and (numero or desc):
-            novos.append({
-                'id': uuid.uuid4().hex[:8].upper(),
-                'numero_fatura': numero,
-                'valor': valor,
-                'data_fatura': data_str,
-                'descricao': desc
-            })
+    novos = [n for n in (_normalizar_faturamento(l) for l in linhas) if n]
 
     if not novos:
         return {'inseridos': 0, 'total_novo': 0.0, 'excedeu': False, 'mensagem': 'Nenhuma linha válida para inserir.'}
@@ -300,19 +2589,28 @@ def processar_faturamentos_em_lote(registro_id, linhas, permitir_exceder=False):
             'mensagem': f"Total novo (R$ {total_novo:,.2f}) excede saldo (R$ {validar['saldo']:,.2f}). Habilite 'Permitir exceder' para lançar mesmo assim."
         }
 
-    # Atualiza sessão
-    st.session_state['registros'][registro_id]['faturamentos'].extend(novos)
-
-    # Persiste no MongoDB com $push $each
+    # Persiste no MongoDB numa única operação (faturamentos + totais). Sem 'permitir exceder', o
+    # limite é conferido de novo no servidor, atomicamente: outra sessão pode ter consumido o
+    # saldo depois da leitura local.
     try:
-        col = get_collection()
-        col.update_one(
-            {'_id': registro_id},
-            {'$push': {'faturamentos': {'$each': novos}}, '$set': {'updated_at': datetime.utcnow()}}
-        )
+        _persistir('incluir_faturamentos', registro_id, novos, limitar_saldo=not permitir_exceder)
+    except SaldoExcedido:
+        _atualizar_apos_conflito()
+        saldo = calcular_consumo(registro_id)[2]
+        return {
+            'inseridos': 0,
+            'total_novo': total_novo,
+            'excedeu': True,
+            'mensagem': f"O saldo do registro foi alterado por outro usuário. Total novo (R$ {total_novo:,.2f}) excede o saldo atual (R$ {saldo:,.2f})."
+        }
     except Exception as e:
         return {'inseridos': 0, 'total_novo': total_novo, 'excedeu': False, 'mensagem': f'Falha ao salvar no MongoDB: {e}'}
 
+    # Atualiza sessão
+    reg = st.session_state['registros'][registro_id].copia()
+    reg['faturamentos'].extend(novos)
+    _registro_alterado(registro_id, reg)
+
     return {'inseridos': len(novos), 'total_novo': total_novo, 'excedeu': validar['exceder'], 'mensagem': 'Faturamentos lançados com sucesso.'}
 
 def validar_limite_adiantamento(registro_id, novos_total):
@@ -328,59 +2626,289 @@ def calcular_consumo(registro_id):
     reg = st.session_state['registros'].get(registro_id)
     if not reg:
         return 0.0, 0.0, 0.0
-    adiantado = float(reg['adiantamento']['valor']) if reg['adiantamento'] else 0.0
-    total_faturado = sum(float(f['valor']) for f in reg['faturamentos'])
-    saldo = adiantado - total_faturado
-    return adiantado, total_faturado, saldo
+    return _consumo_registro(reg)
+
+def _consumo_registro(reg):
+    # Chamado para cada registro ao montar tabelas e o frame do dashboard: slots lidos direto
+    adiantado = float(reg.adiantamento.valor) if reg.adiantamento else 0.0
+    if not hasattr(reg, 'total_faturado'):
+        reg.recalcular_totais()
+    return adiantado, reg.total_faturado, reg.saldo
+
+# ==== Importação de faturamentos (CSV/OFX) ====
+COLUNAS_IMPORTACAO = ['registro', 'numero_fatura', 'valor', 'data_fatura', 'descricao', 'unidade']
+
+def _valor_monetario(texto, decimal=None):
+    # Aceita "1234.56", "1.234,56", "1,234.56" e "R$ 1.234,56". Com os dois separadores, o decimal
+    # é o que vem por último. Com um só: repetido ("1.234.567") é de milhar; uma única vez seguido
+    # de três dígitos ("1.234") é ambíguo e decide 'decimal', o separador decimal do arquivo quando
+    # conhecido (sem ele, ValueError); nos demais casos ("1,5", "10.50", "0.125") é o decimal.
+    texto = str(texto or '').replace('R$', '').replace('\xa0', '').replace(' ', '')
+    if not texto:
+        return 0.0
+    separadores = [s for s in (',', '.') if s in texto]
+    separador = None
+    if len(separadores) == 2:
+        separador = ',' if texto.rfind(',') > texto.rfind('.') else '.'
+    elif separadores and texto.count(separadores[0]) == 1:
+        inteiro, _, fracao = texto.partition(separadores[0])
+        if len(fracao) != 3 or inteiro.lstrip('+-') in ('', '0'):
+            separador = separadores[0]
+        elif decimal is None:
+            raise ValueError(f"Valor ambíguo: {texto!r} (separador decimal ou de milhar?)")
+        elif decimal == separadores[0]:
+            separador = decimal
+    if separador:
+        inteiro, fracao = texto.rsplit(separador, 1)
+        milhar = '.' if separador == ',' else ','
+    else:
+        inteiro, fracao = texto, ''
+        milhar = separadores[0] if separadores else None
+    grupos = inteiro.split(milhar) if milhar else [inteiro]
+    if (separador and separador in inteiro) or (len(grupos) > 1 and (not grupos[0].lstrip('+-') or any(len(g) != 3 for g in grupos[1:]))):
+        raise ValueError(f"Valor inválido: {texto!r}")
+    return float(''.join(grupos) + ('.' + fracao if separador else ''))
+
+def _data_importacao(texto):
+    texto = (texto or '').strip()
+    # OFX usa AAAAMMDD seguido de hora/fuso, que são descartados
+    for formato, tamanho in (('%Y-%m-%d', 10), ('%d/%m/%Y', 10), ('%Y%m%d', 8)):
+        try:
+            return datetime.strptime(texto[:tamanho], formato).date()
+        except ValueError:
+            continue
+    return None
+
+def ler_linhas_csv(arquivo):
+    # Lê o CSV linha a linha (separador ; ou ,), devolvendo (número da linha, dados). O separador
+    # de campos indica o decimal dos valores: ';' é o CSV do Excel em português, com vírgula decimal.
+    texto = io.TextIOWrapper(arquivo, encoding='utf-8-sig', newline='')
+    amostra = texto.readline()
+    delimitador = ';' if amostra.count(';') > amostra.count(',') else ','
+    decimal = ',' if delimitador == ';' else '.'
+    cabecalho = [c.strip().lower() for c in next(csv.reader([amostra], delimiter=delimitador))]
+    for n, valores in enumerate(csv.reader(texto, delimiter=delimitador), start=2):
+        if not any(v.strip() for v in valores):
+            continue
+        dados = dict(zip(cabecalho, valores))
+        yield n, dict({c: (dados.get(c) or '').strip() for c in COLUNAS_IMPORTACAO}, decimal=decimal)
+
+_PADRAO_TAG_OFX = re.compile(r'<(/?)([A-Z0-9.]+)>([^<\r\n]*)')
+_PADRAO_REGISTRO = re.compile(r'\b([0-9A-F]{8})\b')
+
+def ler_linhas_ofx(arquivo, registro_padrao=None):
+    # OFX (SGML ou XML) lido em streaming: cada <STMTTRN> vira uma linha de faturamento.
+    # O registro vem de um código de 8 caracteres no MEMO/NAME ou, na falta dele, do registro padrão.
+    texto = io.TextIOWrapper(arquivo, encoding='cp1252', errors='replace')
+    atual = None
+    n = 0
+    for linha in texto:
+        for fecha, tag, valor in _PADRAO_TAG_OFX.findall(linha):
+            if tag == 'STMTTRN':
+                if not fecha:
+                    atual = {}
+                elif atual is not None:
+                    n += 1
+                    memo = atual.get('MEMO') or atual.get('NAME') or ''
+                    achado = _PADRAO_REGISTRO.search(memo.upper())
+                    data = _data_importacao(atual.get('DTPOSTED', ''))
+                    valor = atual.get('TRNAMT', '0')
+                    try:
+                        # OFX não usa separador de milhar: o único separador do TRNAMT é o decimal
+                        valor = str(abs(_valor_monetario(valor, decimal=',' if ',' in valor else '.')))
+                    except ValueError:
+                        pass  # segue como veio e a linha é recusada na importação
+                    yield n, {
+                        'registro': achado.group(1) if achado else (registro_padrao or ''),
+                        'numero_fatura': atual.get('CHECKNUM') or atual.get('FITID', ''),
+                        'valor': valor,
+                        'data_fatura': data.isoformat() if data else '',
+                        'descricao': memo,
+                        'unidade': '',
+                        'decimal': '.',
+                    }
+                    atual = None
+            elif atual is not None and not fecha:
+                atual[tag] = valor.strip()
+
+def importar_faturamentos(linhas, permitir_exceder=False, simular=False):
+    # Valida cada linha contra o saldo (acumulando as linhas já aceitas do mesmo registro),
+    # agrupa por registro e grava tudo num único bulk_write não ordenado. Com write-behind, cada
+    # registro vai para a fila, atrás das gravações dele que ainda estão pendentes.
+    relatorio = []
+    por_registro = {}
+    acumulado = {}
+    numeros_arquivo = set()
+    for n, l in linhas:
+        rid = (l.get('registro') or '').strip().upper()
+        linha_rel = {'Linha': n, 'Registro': rid, 'Número fatura': l.get('numero_fatura', ''), 'Valor': None, 'Situação': 'Rejeitada', 'Motivo': ''}
+        relatorio.append(linha_rel)
+        reg = st.session_state['registros'].get(rid)
+        if not reg:
+            linha_rel['Motivo'] = 'Registro não encontrado'
+            continue
+        if not reg['adiantamento']:
+            linha_rel['Motivo'] = 'Registro sem adiantamento'
+            continue
+        try:
+            l = dict(l, valor=_valor_monetario(l.get('valor'), l.get('decimal')))
+        except ValueError:
+            linha_rel['Motivo'] = 'Valor inválido'
+            continue
+        data = _data_importacao(l.get('data_fatura'))
+        if l.get('data_fatura') and data is None:
+            linha_rel['Motivo'] = 'Data inválida'
+            continue
+        fat = _normalizar_faturamento(dict(l, data_fatura=data))
+        if fat is None:
+            linha_rel['Motivo'] = 'Valor deve ser maior que zero e a linha precisa de número ou descrição'
+            continue
+        linha_rel['Valor'] = fat['valor']
+        validar = validar_limite_adiantamento(rid, acumulado.get(rid, 0.0) + fat['valor'])
+        if validar['exceder'] and not permitir_exceder:
+            linha_rel['Motivo'] = f"Excede o saldo do registro (R$ {validar['saldo']:,.2f})"
+            continue
+        fat['unidade'] = l.get('unidade') or reg['adiantamento'].get('unidade') or reg['solicitacao'].get('unidade', '')
+        acumulado[rid] = acumulado.get(rid, 0.0) + fat['valor']
+        por_registro.setdefault(rid, []).append((linha_rel, fat))
+        linha_rel['Situação'] = 'Aceita (simulação)' if simular else 'Aceita'
+        avisos = ['Excede o saldo (permitido)'] if validar['exceder'] else []
+        duplicadas = faturas_duplicadas(fat['numero_fatura'])
+        chave = _chave_fatura(fat['numero_fatura'])
+        if duplicadas or (chave and chave in numeros_arquivo):
+            avisos.append(f"Número de fatura duplicado ({', '.join(sorted(duplicadas)) or 'no arquivo'})")
+        if chave:
+            numeros_arquivo.add(chave)
+        linha_rel['Motivo'] = '; '.join(avisos)
+
+    if por_registro and not simular:
+        rids = list(por_registro)
+        falhas = {}
+        if st.session_state.get('db_loaded') and _write_behind_ativo():
+            for rid in rids:
+                try:
+                    _persistir('incluir_faturamentos', rid, [f for _, f in por_registro[rid]], limitar_saldo=not permitir_exceder)
+                except Exception as e:
+                    falhas[rid] = str(e)
+        elif st.session_state.get('db_loaded'):
+            try:
+                falhas = get_backend().incluir_faturamentos_em_lote({rid: [f for _, f in por_registro[rid]] for rid in rids}, limitar_saldo=not permitir_exceder)
+            except Exception as e:
+                falhas = {rid: str(e) for rid in rids}
+        for rid in rids:
+            if rid in falhas:
+                for linha_rel, _ in por_registro[rid]:
+                    linha_rel['Situação'] = 'Rejeitada'
+                    linha_rel['Motivo'] = f"Falha ao salvar no MongoDB: {falhas[rid]}"
+                continue
+            reg = st.session_state['registros'][rid].copia()
+            reg['faturamentos'].extend(f for _, f in por_registro[rid])
+            _registro_alterado(rid, reg)
+
+    aceitas = [r for r in relatorio if r['Situação'] != 'Rejeitada']
+    return {
+        'aceitas': len(aceitas),
+        'rejeitadas': len(relatorio) - len(aceitas),
+        'total': sum(r['Valor'] for r in aceitas),
+        'relatorio': relatorio,
+    }
 
-def render_resumo_financeiro(registros=None):
+def status_registro(adiantado, saldo):
+    return 'Encerrado' if adiantado > 0 and saldo <= 0 else ('Em aberto' if adiantado > 0 else 'Aguardando adiantamento')
+
+def linhas_resumo_financeiro(registros=None):
     linhas = []
     regs_src = registros if registros is not None else st.session_state['registros']
     for rid, reg in regs_src.items():
-        adiantado, faturado, saldo = calcular_consumo(rid)
-        status = 'Encerrado' if adiantado > 0 and saldo <= 0 else ('Em aberto' if adiantado > 0 else 'Aguardando adiantamento')
+        adiantado, faturado, saldo = _consumo_registro(reg)
+        sol = reg.solicitacao
         linhas.append({
             'Registro': rid,
-            'Solicitante': reg['solicitacao']['solicitante'],
-            'Descrição': reg['solicitacao']['descricao'],
-            'Unidade': reg['solicitacao'].get('unidade',''),
+            'Solicitante': sol['solicitante'],
+            'Descrição': sol['descricao'],
+            'Unidade': sol.get('unidade',''),
             'Valor adiantado': adiantado,
             'Total faturado': faturado,
             'Saldo': saldo,
-            'Status': status
+            'Status': reg.status or status_registro(adiantado, saldo)
         })
-    st.dataframe(linhas, use_container_width=True)
+    return linhas
 
-init_state()
+def exibir_tabela(dados):
+    st.dataframe(dados, use_container_width=True)
 
-def render_dashboard():
-    with st.expander("Filtros"):
-        unidades_disp = list({reg['solicitacao'].get('unidade','') for reg in st.session_state['registros'].values() if reg['solicitacao'].get('unidade','')}) or UNIDADES
-        unidades_disp = UNIDADES if set(UNIDADES) >= set(unidades_disp) else list(dict.fromkeys(unidades_disp + UNIDADES))
-        solicitantes_disp = list({reg['solicitacao'].get('solicitante','') for reg in st.session_state['registros'].values()})
-        solicitantes_disp = SOLICITANTES if set(SOLICITANTES) >= set(solicitantes_disp) else list(dict.fromkeys(solicitantes_disp + SOLICITANTES))
-        status_opts = ["Encerrado", "Em aberto", "Aguardando adiantamento"]
-        sel_unidades = st.multiselect("Unidades", options=unidades_disp, default=[])
-        sel_solicitantes = st.multiselect("Solicitantes", options=solicitantes_disp, default=[])
-        sel_status = st.multiselect("Status", options=status_opts, default=[])
-        usar_periodo = st.checkbox("Filtrar por período da solicitação", value=False)
-        if usar_periodo:
-            ini = st.date_input("Início", value=date.today().replace(day=1), key="f_ini")
-            fim = st.date_input("Fim", value=date.today(), key="f_fim")
-        else:
-            ini = None
-            fim = None
+def render_resumo_financeiro(registros=None, linhas=None):
+    if linhas is None:
+        linhas = linhas_resumo_financeiro(registros)
+    exibir_tabela(linhas)
+
+# ==== Agregação no servidor (dashboard) ====
+def _estagios_dashboard(unidades=None, solicitantes=None, status=None, ini=None, fim=None):
+    # Filtros e campos calculados comuns aos totais e às linhas do dashboard
+    match = {}
+    if unidades:
+        match['solicitacao.unidade'] = {'$in': list(unidades)}
+    if solicitantes:
+        match['solicitacao.solicitante'] = {'$in': list(solicitantes)}
+    if ini and fim:
+        # Datas gravadas em ISO (AAAA-MM-DD): comparar strings equivale a comparar datas.
+        # Registros sem data continuam incluídos, como no filtro em Python.
+        match['$or'] = [
+            {'solicitacao.data_solicitacao': {'$gte': ini.isoformat(), '$lte': fim.isoformat()}},
+            {'solicitacao.data_solicitacao': {'$in': [None, '']}},
+        ]
+    pipeline = [{'$match': match}] if match else []
+    pipeline += [
+        {'$addFields': {
+            'adiantado': {'$ifNull': ['$adiantamento.valor', 0]},
+            'total_faturado': {'$ifNull': ['$total_faturado', {'$sum': '$faturamentos.valor'}]},
+        }},
+        {'$addFields': {'saldo': {'$subtract': ['$adiantado', '$total_faturado']}}},
+        {'$addFields': {'status': _expr_status('$adiantado', '$saldo')}},
+    ]
+    if status:
+        pipeline.append({'$match': {'status': {'$in': list(status)}}})
+    return pipeline
+
+def pipeline_dashboard(unidades=None, solicitantes=None, status=None, ini=None, fim=None):
+    # Só os totais: um único documento pequeno, qualquer que seja o tamanho da coleção
+    return _estagios_dashboard(unidades, solicitantes, status, ini, fim) + [{'$group': {
+        '_id': None,
+        'registros': {'$sum': 1},
+        'adiantado': {'$sum': '$adiantado'},
+        'faturado': {'$sum': '$total_faturado'},
+    }}]
+
+def pipeline_linhas_dashboard(unidades=None, solicitantes=None, status=None, ini=None, fim=None):
+    # Uma linha projetada por registro, lida por cursor em lotes: as linhas não cabem num único
+    # documento de resultado (limite de 16 MB) em coleções grandes
+    return _estagios_dashboard(unidades, solicitantes, status, ini, fim) + [{'$project': {
+        '_id': 0,
+        'Registro': '$_id',
+        'Solicitante': '$solicitacao.solicitante',
+        'Descrição': '$solicitacao.descricao',
+        'Unidade': {'$ifNull': ['$solicitacao.unidade', '']},
+        'Valor adiantado': '$adiantado',
+        'Total faturado': '$total_faturado',
+        'Saldo': '$saldo',
+        'Status': '$status',
+    }}]
+
+def agregar_dashboard(unidades=None, solicitantes=None, status=None, ini=None, fim=None):
+    return get_backend().agregar_dashboard(unidades, solicitantes, status, ini, fim)
+
+def filtrar_registros(registros, unidades=None, solicitantes=None, status=None, ini=None, fim=None):
     filtrados = {}
-    for rid, reg in st.session_state['registros'].items():
+    for rid, reg in registros.items():
         u = reg['solicitacao'].get('unidade','')
         s = reg['solicitacao'].get('solicitante','')
-        adiantado, faturado, saldo = calcular_consumo(rid)
-        stt = 'Encerrado' if adiantado > 0 and saldo <= 0 else ('Em aberto' if adiantado > 0 else 'Aguardando adiantamento')
-        if sel_unidades and u not in sel_unidades:
+        calcular_consumo(rid)
+        stt = reg['status']
+        if unidades and u not in unidades:
             continue
-        if sel_solicitantes and s not in sel_solicitantes:
+        if solicitantes and s not in solicitantes:
             continue
-        if sel_status and stt not in sel_status:
+        if status and stt not in status:
             continue
         if ini and fim:
             ds = reg['solicitacao'].get('data_solicitacao')
@@ -391,20 +2919,436 @@ def render_dashboard():
             if dsv and not (ini <= dsv <= fim):
                 continue
         filtrados[rid] = reg
-    total_registros = len(filtrados)
-    total_adiantado = sum(float(r['adiantamento']['valor']) for r in filtrados.values() if r['adiantamento'])
-    total_faturado = sum(sum(float(f['valor']) for f in r['faturamentos']) for r in filtrados.values())
-    total_saldo = total_adiantado - total_faturado
-    c1, c2, c3, c4 = st.columns(4)
-    c1.metric("Registros", f"{total_registros}")
-    c2.metric("Total adiantado (R$)", f"{total_adiantado:,.2f}")
-    c3.metric("Total faturado (R$)", f"{total_faturado:,.2f}")
-    c4.metric("Saldo (R$)", f"{total_saldo:,.2f}")
+    return filtrados
+
+# ==== Paginação de registros ====
+# Seletores e tabelas mostram uma página por vez: o trabalho e os widgets de cada rerun ficam no
+# tamanho da página, qualquer que seja o total. A memória do processo não diminui: a cópia local
+# (CacheRegistros) já tem todos os registros, e é dela que as páginas saem. Uma consulta paginada
+# no banco seria uma ida a mais por rerun e teria de sobrepor as gravações ainda na fila
+# write-behind, que só a cópia local já reflete.
+PAGINA_REGISTROS = 50
+PAGINA_RELATORIO = 200
+
+# filtro -> predicado sobre o registro
+FILTROS_LISTAGEM = {
+    'todos': lambda reg: True,
+    'com_adiantamento': lambda reg: bool(reg['adiantamento']),
+    'sem_adiantamento': lambda reg: reg['adiantamento'] is None,
+    'com_faturamentos': lambda reg: bool(reg['faturamentos']),
+}
+
+@st.cache_resource(max_entries=4, show_spinner=False)
+def ids_ordenados(versao, _registros):
+    # Ordem de paginação, refeita uma vez por versão dos dados e compartilhada entre sessões
+    return sorted(_registros)
+
+def buscar_pagina_registros(filtro='todos', apos=None, limite=PAGINA_REGISTROS, busca=''):
+    # Páginas lidas da cópia local dos registros (cache compartilhado ou sessão), a mesma que os
+    # helpers de mutação atualizam: vale para qualquer backend e inclui gravações ainda na fila
+    # write-behind. Paginação por faixa de _id: a página parte da posição de 'apos' na ordem dos ids.
+    # Retorna (docs, proximo), onde proximo é o _id de onde parte a página seguinte (None na última).
+    # Com busca, os registros vêm do índice textual em ordem de relevância e o cursor é a posição.
+    busca = (busca or '').strip()
+    predicado = FILTROS_LISTAGEM[filtro]
+    registros = st.session_state['registros']
+    if busca:
+        inicio = apos or 0
+        encontrados = indice_busca().buscar(busca, inicio + limite + 1, lambda rid: rid in registros and predicado(registros[rid]))
+        proximo = inicio + limite if len(encontrados) > inicio + limite else None
+        return [dict(registros[rid], _id=rid) for rid, _ in encontrados[inicio:inicio + limite]], proximo
+    ids = ids_ordenados(versao_dados(), registros)
+    docs = []
+    for rid in itertools.islice(ids, 0 if apos is None else bisect.bisect_right(ids, apos), None):
+        reg = registros.get(rid)
+        if reg is None or not predicado(reg):
+            continue
+        docs.append(dict(reg, _id=rid))
+        if len(docs) > limite:
+            break
+    proximo = docs[limite - 1]['_id'] if len(docs) > limite else None
+    return docs[:limite], proximo
+
+def paginar_registros(key, filtro='todos', limite=PAGINA_REGISTROS, busca='', tabela=None):
+    # Guarda na sessão o _id inicial de cada página visitada, para permitir voltar.
+    # Com tabela (ver TABELAS_RELATORIO), retorna as linhas já montadas e memoizadas em vez dos documentos.
+    estado = st.session_state.setdefault(f'_pag_{key}', {'inicios': [None], 'busca': busca})
+    if estado['busca'] != busca:
+        estado['inicios'] = [None]
+        estado['busca'] = busca
+    if tabela:
+        docs, proximo = tabela_pagina(versao_dados(), tabela, filtro, estado['inicios'][-1], limite)
+    else:
+        docs, proximo = buscar_pagina_registros(filtro, estado['inicios'][-1], limite, busca)
+    _botoes_pagina(key, estado['inicios'], proximo)
+    return docs
+
+def _botoes_pagina(key, inicios, proximo):
+    if len(inicios) > 1 or proximo is not None:
+        # Callbacks mudam a página antes da próxima execução: dentro de um fragmento, só ele é refeito
+        c1, c2, c3 = st.columns([1, 1, 4])
+        c1.button("◀ Anterior", key=f'{key}_ant', disabled=len(inicios) == 1, on_click=inicios.pop)
+        c2.button("Próxima ▶", key=f'{key}_prox', disabled=proximo is None, on_click=inicios.append, args=(proximo,))
+        c3.caption(f"Página {len(inicios)}")
+
+def seletor_registro(rotulo, filtro='todos', key=None):
+    key = key or rotulo
+    busca = st.text_input("Buscar registro (código, descrição, solicitante, observações ou nº da fatura)", key=f'{key}_busca')
+    docs = paginar_registros(key, filtro, busca=busca)
+    if not docs:
+        if busca:
+            st.info("Nenhum registro encontrado para a busca")
+        return None
+    rotulos = {d['_id']: f"{d['_id']} — {d.get('solicitacao', {}).get('descricao', '')}" for d in docs}
+    return st.selectbox(rotulo, options=list(rotulos), format_func=rotulos.get, key=key)
+
+# ==== Tabelas derivadas (memoizadas por versão dos dados) ====
+# Linhas de tabelas e listas de opções são recalculadas apenas quando a versão dos dados muda
+# (ver versao_dados); reruns causados por outros widgets reaproveitam o resultado guardado.
+TABELAS_CACHE_MAX = 64
+_falta_local = threading.local()
+
+def _memoizada(funcao):
+    # st.cache_data compartilhado entre sessões, com contagem de acertos e faltas quando as métricas
+    # estão ativas (sem elas, nem o lock de Metricas é tomado).
+    # O corpo da função só executa em caso de falta; as demais chamadas são acertos.
+    # functools.wraps preserva a assinatura original: é por ela que o Streamlit deixa de fora do
+    # hash os parâmetros com sublinhado (_registros)
+    @functools.wraps(funcao)
+    def contada(*args, **kwargs):
+        _falta_local.ocorreu = True
+        return funcao(*args, **kwargs)
+    em_cache = st.cache_data(max_entries=TABELAS_CACHE_MAX, show_spinner=False)(contada)
+    def chamada(*args, **kwargs):
+        if not _metricas_ativas():
+            return em_cache(*args, **kwargs)
+        _falta_local.ocorreu = False
+        resultado = em_cache(*args, **kwargs)
+        get_metricas().somar('tabelas_cache_total', 'falta' if _falta_local.ocorreu else 'acerto')
+        return resultado
+    chamada.clear = em_cache.clear
+    return chamada
+
+def estatisticas_tabelas():
+    metricas = get_metricas()
+    acertos, faltas = metricas.valor('tabelas_cache_total', 'acerto'), metricas.valor('tabelas_cache_total', 'falta')
+    total = acertos + faltas
+    return {'acertos': acertos, 'faltas': faltas, 'taxa_acerto': acertos / total if total else 0.0}
+
+def _linhas_adiantamentos(docs):
+    linhas = []
+    for reg in docs:
+        linhas.append({
+            'Registro': reg['_id'],
+            'Solicitante': reg['solicitacao']['solicitante'],
+            'Descrição': reg['solicitacao']['descricao'],
+            'Unidade': reg['solicitacao'].get('unidade',''),
+            'Valor adiantado': float(reg['adiantamento']['valor']),
+            'Data adiantamento': reg['adiantamento'].get('data_adiantamento',''),
+            'Responsável': reg['adiantamento'].get('responsavel','')
+        })
+    return linhas
+
+def _linhas_faturamentos(docs):
+    linhas = []
+    for reg in docs:
+        for f in reg['faturamentos']:
+            linhas.append({
+                'Registro': reg['_id'],
+                'Unidade': f.get('unidade') or (reg.get('adiantamento') or {}).get('unidade') or reg['solicitacao'].get('unidade',''),
+                'Número fatura': f.get('numero_fatura',''),
+                'Descrição': f.get('descricao',''),
+                'Valor': float(f.get('valor',0.0)),
+                'Data': f.get('data_fatura','')
+            })
+    return linhas
+
+def _linhas_saldos(docs):
+    return linhas_resumo_financeiro({d['_id']: _doc_para_registro(d) for d in docs})
+
+# tabela -> montagem das linhas a partir dos documentos da página
+TABELAS_RELATORIO = {
+    'adiantamentos': _linhas_adiantamentos,
+    'faturamentos': _linhas_faturamentos,
+    'saldos': _linhas_saldos,
+}
+
+@_memoizada
+def tabela_pagina(versao, tabela, filtro, apos, limite):
+    docs, proximo = buscar_pagina_registros(filtro, apos, limite)
+    return TABELAS_RELATORIO[tabela](docs), proximo
+
+@_memoizada
+def opcoes_filtros(versao, _registros):
+    # Unidades e solicitantes distintos para os filtros do dashboard
+    if _HAS_PANDAS:
+        # As categorias do frame já são os valores distintos; evita varrer todos os registros
+        df = frame_registros(versao, _registros)
+        unidades_disp = [u for u in df['Unidade'].cat.categories if u] or UNIDADES
+        solicitantes_disp = list(df['Solicitante'].cat.categories)
+    else:
+        unidades_disp = list({reg['solicitacao'].get('unidade','') for reg in _registros.values() if reg['solicitacao'].get('unidade','')}) or UNIDADES
+        solicitantes_disp = list({reg['solicitacao'].get('solicitante','') for reg in _registros.values()})
+    unidades_disp = UNIDADES if set(UNIDADES) >= set(unidades_disp) else list(dict.fromkeys(unidades_disp + UNIDADES))
+    solicitantes_disp = SOLICITANTES if set(SOLICITANTES) >= set(solicitantes_disp) else list(dict.fromkeys(solicitantes_disp + SOLICITANTES))
+    return unidades_disp, solicitantes_disp
+
+@_memoizada
+def totais_arquivo(versao, unidades, solicitantes, status, ini, fim):
+    # Arquivar e restaurar mudam o conjunto ativo, e portanto a versão dos dados
+    if status and 'Encerrado' not in status:
+        return {'registros': 0, 'adiantado': 0.0, 'faturado': 0.0}
+    return get_backend().totais_arquivados(unidades, solicitantes, ini, fim)
+
+@_memoizada
+def resumo_dashboard(versao, unidades, solicitantes, status, ini, fim, _registros):
+    # Totais e linhas do dashboard calculados sobre a cópia em memória
+    if _HAS_PANDAS:
+        return totais_colunares(versao, _registros, unidades, solicitantes, status, ini, fim)
+    filtrados = filtrar_registros(_registros, unidades, solicitantes, status, ini, fim)
+    totais = {
+        'registros': len(filtrados),
+        'adiantado': sum(float(r['adiantamento']['valor']) for r in filtrados.values() if r['adiantamento']),
+        'faturado': sum(_consumo_registro(r)[1] for r in filtrados.values()),
+    }
+    return totais, linhas_resumo_financeiro(filtrados)
+
+# ==== Motor colunar do dashboard ====
+@st.cache_resource(max_entries=4, show_spinner=False)
+def frame_registros(versao, _registros):
+    # Uma linha por registro, montada uma vez por versão dos dados: unidade, solicitante e status
+    # categóricos, data já convertida para datetime64 e totais prontos para redução vetorizada.
+    # O frame é compartilhado entre sessões e não deve ser alterado.
+    ids, descricoes, unidades, solicitantes, datas, adiantados, faturados, status = [], [], [], [], [], [], [], []
+    for rid, reg in list(_registros.items()):
+        adiantado, faturado, saldo = _consumo_registro(reg)
+        sol = reg.solicitacao
+        ids.append(rid)
+        descricoes.append(sol.get('descricao', ''))
+        unidades.append(sol.get('unidade', ''))
+        solicitantes.append(sol.get('solicitante', ''))
+        datas.append(sol.get('data_solicitacao') or None)
+        adiantados.append(adiantado)
+        faturados.append(faturado)
+        status.append(reg.status or status_registro(adiantado, saldo))
+    df = pd.DataFrame({
+        'Registro': ids,
+        'Solicitante': pd.Categorical(solicitantes),
+        'Descrição': descricoes,
+        'Unidade': pd.Categorical(unidades),
+        'Valor adiantado': np.asarray(adiantados, dtype='float64'),
+        'Total faturado': np.asarray(faturados, dtype='float64'),
+        'Status': pd.Categorical(status),
+        # Datas inválidas viram NaT e, como no filtro em Python, não são excluídas pelo período
+        'data': pd.to_datetime(pd.Series(datas, dtype='object'), format='%Y-%m-%d', errors='coerce'),
+    })
+    df['Saldo'] = df['Valor adiantado'] - df['Total faturado']
+    return df
+
+def filtrar_frame(df, unidades=None, solicitantes=None, status=None, ini=None, fim=None):
+    mascara = np.ones(len(df), dtype=bool)
+    if unidades:
+        mascara &= df['Unidade'].isin(unidades).to_numpy()
+    if solicitantes:
+        mascara &= df['Solicitante'].isin(solicitantes).to_numpy()
+    if status:
+        mascara &= df['Status'].isin(status).to_numpy()
+    if ini and fim:
+        datas = df['data']
+        mascara &= (datas.isna() | ((datas >= pd.Timestamp(ini)) & (datas <= pd.Timestamp(fim)))).to_numpy()
+    return df[mascara]
+
+def totais_colunares(versao, registros, unidades=None, solicitantes=None, status=None, ini=None, fim=None):
+    df = frame_registros(versao, registros)
+    sub = filtrar_frame(df, unidades, solicitantes, status, ini, fim)
+    totais = {
+        'registros': len(sub),
+        'adiantado': float(sub['Valor adiantado'].sum()),
+        'faturado': float(sub['Total faturado'].sum()),
+    }
+    colunas = ['Registro', 'Solicitante', 'Descrição', 'Unidade', 'Valor adiantado', 'Total faturado', 'Saldo', 'Status']
+    return totais, sub[colunas].reset_index(drop=True)
+
+instrumentar(FUNCOES_INSTRUMENTADAS)
+init_state()
+
+# ==== Fragmentos ====
+# Cada view e suas seções independentes são fragmentos (st.fragment): um widget alterado executa
+# de novo só o fragmento a que pertence, sem cabeçalho, init_state, barra lateral e o resto da
+# view. Gravações que afetam outras partes da página chamam concluir_alteracao, que executa a
+# página inteira.
+def fragmento(funcao):
+    nome = f'fragmento:{funcao.__name__}'
+    @functools.wraps(funcao)
+    def executar(*args, **kwargs):
+        # init_state não roda nas execuções do fragmento: renova a referência ao cache compartilhado
+        if st.session_state.get('db_loaded'):
+            st.session_state['registros'] = get_cache_registros().registros
+        if _metricas_ativas():
+            return _medida(nome, funcao, get_metricas())(*args, **kwargs)
+        return funcao(*args, **kwargs)
+    return st.fragment(executar)
+
+def concluir_alteracao(mensagem, aviso=None):
+    # As mensagens sobrevivem à nova execução e são exibidas por exibir_mensagens
+    st.session_state['_mensagens'] = [('success', mensagem)] + ([('warning', aviso)] if aviso else [])
+    st.rerun()
+
+def exibir_mensagens():
+    for tipo, texto in st.session_state.pop('_mensagens', []):
+        getattr(st, tipo)(texto)
+
+# O fragmento da view é o dos filtros: alterar um filtro executa de novo cartões, tendência e
+# tabela, que dependem dele. Só os cartões são um fragmento aninhado, por causa da opção do
+# arquivo: marcá-la executa só os cartões e a consulta ao arquivo. Tendência e tabela não têm
+# widgets próprios; como fragmentos, nunca executariam sozinhas.
+@fragmento
+def render_dashboard():
+    with st.expander("Filtros"):
+        unidades_disp, solicitantes_disp = opcoes_filtros(versao_dados(), st.session_state['registros'])
+        status_opts = ["Encerrado", "Em aberto", "Aguardando adiantamento"]
+        sel_unidades = st.multiselect("Unidades", options=unidades_disp, default=[])
+        sel_solicitantes = st.multiselect("Solicitantes", options=solicitantes_disp, default=[])
+        sel_status = st.multiselect("Status", options=status_opts, default=[])
+        usar_periodo = st.checkbox("Filtrar por período da solicitação", value=False)
+        if usar_periodo:
+            ini = st.date_input("Início", value=date.today().replace(day=1), key="f_ini")
+            fim = st.date_input("Fim", value=date.today(), key="f_fim")
+        else:
+            ini = None
+            fim = None
+    totais = linhas = None
+    # 'colunar' (padrão): filtros e totais vetorizados sobre o cache em memória, sem ida ao banco.
+    # 'servidor': agregação no banco de dados.
+    motor = _config('MIDIA_DASHBOARD_MOTOR', 'colunar')
+    if motor == 'servidor' and st.session_state.get('db_loaded'):
+        try:
+            totais, linhas = agregar_dashboard(sel_unidades, sel_solicitantes, sel_status, ini, fim)
+        except Exception as e:
+            st.warning(f"Falha na agregação no banco de dados. Calculando localmente. Detalhe: {e}")
+    if totais is None:
+        totais, linhas = resumo_dashboard(versao_dados(), sel_unidades, sel_solicitantes, sel_status, ini, fim, st.session_state['registros'])
+    _fragmento_cartoes_dashboard(totais, (sel_unidades, sel_solicitantes, sel_status, ini, fim))
+    st.divider()
+    render_tendencia_mensal(sel_unidades, sel_solicitantes, ini, fim)
     st.divider()
     st.subheader("Resumo por registro")
-    render_resumo_financeiro(filtrados)
+    render_resumo_financeiro(linhas=linhas)
+
+@fragmento
+def _fragmento_cartoes_dashboard(totais, filtros):
+    if st.session_state.get('db_loaded') and st.checkbox("Incluir registros arquivados nos totais", value=False, key="f_arquivo"):
+        # Só os cartões: as linhas por registro e a tendência mensal ficam no conjunto ativo
+        try:
+            arquivo = totais_arquivo(versao_dados(), *filtros)
+            totais = {k: totais[k] + arquivo[k] for k in ('registros', 'adiantado', 'faturado')}
+        except Exception as e:
+            st.warning(f"Falha ao consultar o arquivo. Totais sem os registros arquivados. Detalhe: {e}")
+    total_saldo = totais['adiantado'] - totais['faturado']
+    c1, c2, c3, c4 = st.columns(4)
+    c1.metric("Registros", f"{totais['registros']}")
+    c2.metric("Total adiantado (R$)", f"{totais['adiantado']:,.2f}")
+    c3.metric("Total faturado (R$)", f"{totais['faturado']:,.2f}")
+    c4.metric("Saldo (R$)", f"{total_saldo:,.2f}")
+
+def render_tendencia_mensal(unidades, solicitantes, ini=None, fim=None):
+    # Lida da consolidação mensal mantida em memória: não percorre os faturamentos
+    st.subheader("Tendência mensal")
+    linhas = rollup_mensal().serie(
+        unidades, solicitantes,
+        ini.strftime('%Y-%m') if ini else None, fim.strftime('%Y-%m') if fim else None,
+    )
+    sem_data = [l for l in linhas if not l['Mês']]
+    linhas = [l for l in linhas if l['Mês']]
+    if not linhas:
+        st.info("Sem adiantamentos ou faturamentos no período.")
+        return
+    meses = {}
+    for l in linhas:
+        total = meses.setdefault(l['Mês'], [0.0, 0.0])
+        total[0] += l['Adiantado']
+        total[1] += l['Faturado']
+    # Burn-down: acumulado adiantado x faturado e o saldo resultante, mês a mês
+    acumulado = []
+    adiantado = faturado = 0.0
+    for mes, (ad, fat) in sorted(meses.items()):
+        adiantado += ad
+        faturado += fat
+        acumulado.append({
+            'Mês': mes, 'Adiantado no mês': ad, 'Faturado no mês': fat,
+            'Adiantado acumulado': adiantado, 'Faturado acumulado': faturado, 'Saldo': adiantado - faturado,
+        })
+    st.line_chart(acumulado, x='Mês', y=['Adiantado acumulado', 'Faturado acumulado', 'Saldo'])
+    c1, c2 = st.columns(2)
+    with c1:
+        st.caption("Faturado por unidade (R$)")
+        st.bar_chart(linhas, x='Mês', y='Faturado', color='Unidade')
+    with c2:
+        st.caption("Adiantado por unidade (R$)")
+        st.bar_chart(linhas, x='Mês', y='Adiantado', color='Unidade')
+    with st.expander("Valores por mês"):
+        exibir_tabela(acumulado)
+    if sem_data:
+        st.caption(
+            f"Sem data válida (fora dos gráficos): R$ {sum(l['Adiantado'] for l in sem_data):,.2f} adiantado, "
+            f"R$ {sum(l['Faturado'] for l in sem_data):,.2f} faturado"
+        )
+
+# ==== Conflitos de edição ====
+def _registrar_conflito(tipo, registro_id, dados):
+    st.session_state['_conflito'] = {'tipo': tipo, 'registro': registro_id, 'dados': dados}
+
+def render_conflito(tipo):
+    # Alteração recusada por conflito de versão: mostra a alteração do usuário ao lado da versão
+    # atual e permite reaplicá-la sobre a versão atual ou descartá-la
+    conflito = st.session_state.get('_conflito')
+    if not conflito or conflito['tipo'] != tipo:
+        return
+    rid = conflito['registro']
+    reg = st.session_state['registros'].get(rid)
+    if reg is None:
+        st.warning(f"O registro {rid} foi excluído por outro usuário; a alteração foi descartada.")
+        st.session_state.pop('_conflito', None)
+        return
+    atual = (reg['solicitacao'] if tipo == 'solicitacao' else reg['adiantamento']) or {}
+    st.warning(f"O registro {rid} foi alterado por outro usuário enquanto você editava. Compare e escolha como continuar.")
+    exibir_tabela([
+        {'Campo': campo, 'Sua alteração': str(valor), 'Versão atual': str(atual.get(campo, ''))}
+        for campo, valor in conflito['dados'].items()
+    ])
+    c1, c2 = st.columns(2)
+    if c1.button("Aplicar minha alteração sobre a versão atual", key=f"conflito_aplicar_{tipo}"):
+        st.session_state.pop('_conflito', None)
+        editar = atualizar_registro if tipo == 'solicitacao' else registrar_adiantamento
+        try:
+            if not editar(rid, **conflito['dados'], versao=reg.get('versao') or 0):
+                # Falha na gravação: a mensagem de erro fica na tela
+                return
+        except ConflitoVersao:
+            _registrar_conflito(tipo, rid, conflito['dados'])
+        st.rerun()
+    if c2.button("Descartar minha alteração", key=f"conflito_descartar_{tipo}"):
+        st.session_state.pop('_conflito', None)
+        st.rerun()
+
+def _versao_vista(registro_id):
+    # Versão do registro exibida na execução anterior, isto é, a que o usuário tinha na tela ao
+    # enviar o formulário. Atualizada por _marcar_versao_vista ao final de cada execução.
+    reg = st.session_state['registros'].get(registro_id) or {}
+    return st.session_state.get(f'_versao_vista_{registro_id}', reg.get('versao') or 0)
+
+def _marcar_versao_vista(registro_id):
+    reg = st.session_state['registros'].get(registro_id)
+    if reg is not None:
+        st.session_state[f'_versao_vista_{registro_id}'] = reg.get('versao') or 0
 
 def render_solicitacoes():
+    _fragmento_novo_registro()
+    st.divider()
+    _fragmento_editar_registro()
+
+@fragmento
+def _fragmento_novo_registro():
     col_a, col_b = st.columns([1, 3])
     novo = col_a.button("Novo registro")
     if novo or st.session_state.get('abrir_novo'):
@@ -423,13 +3367,15 @@ def render_solicitacoes():
                 else:
                     rid = novo_registro(descricao, solicitante, valor_estimado, data_solicitacao, observacoes, unidade)
                     st.session_state['abrir_novo'] = False
-                    st.success(f"Registro criado: {rid}")
-                    st.rerun()
-    st.divider()
-    rids = list(st.session_state['registros'].keys())
-    if rids:
-        rid_edit = st.selectbox("Editar registro", options=rids)
-        reg = st.session_state['registros'][rid_edit]
+                    concluir_alteracao(f"Registro criado: {rid}")
+
+@fragmento
+def _fragmento_editar_registro():
+    rid_edit = seletor_registro("Editar registro", key="sel_editar_registro")
+    reg = st.session_state['registros'].get(rid_edit)
+    render_conflito('solicitacao')
+    if reg:
+        versao_vista = _versao_vista(rid_edit)
         with st.form("form_editar_registro"):
             descricao = st.text_input("Descrição da campanha", value=reg['solicitacao'].get('descricao', ''))
             _curr_sol = reg['solicitacao'].get('solicitante', '')
@@ -443,31 +3389,49 @@ def render_solicitacoes():
             unidade = st.selectbox("Unidade", options=_uni_opts, index=_uni_opts.index(_curr_uni) if _curr_uni in _uni_opts else 0)
             submitted_e = st.form_submit_button("Salvar alterações")
             if submitted_e:
-                atualizar_registro(rid_edit, descricao, solicitante, valor_estimado, data_solicitacao, observacoes, unidade)
-                st.success("Registro atualizado")
+                try:
+                    if atualizar_registro(rid_edit, descricao, solicitante, valor_estimado, data_solicitacao, observacoes, unidade, versao=versao_vista):
+                        st.success("Registro atualizado")
+                except ConflitoVersao:
+                    _registrar_conflito('solicitacao', rid_edit, {
+                        'descricao': descricao, 'solicitante': solicitante, 'valor_estimado': valor_estimado,
+                        'data_solicitacao': data_solicitacao, 'observacoes': observacoes, 'unidade': unidade,
+                    })
+                    st.rerun()
+        _marcar_versao_vista(rid_edit)
         col_del1, col_del2 = st.columns([1, 3])
         confirm_del = col_del1.checkbox("Confirmar exclusão do registro", key=f"confirm_del_{rid_edit}")
         if col_del2.button("Excluir registro", key=f"btn_del_{rid_edit}"):
             if confirm_del:
-                excluir_registro(rid_edit)
-                st.success("Registro excluído")
-                st.rerun()
+                if excluir_registro(rid_edit):
+                    concluir_alteracao("Registro excluído")
             else:
                 st.warning("Marque a confirmação para excluir.")
 
+@fragmento
 def render_faturamentos():
-    registros_com_adiantamento = [rid for rid, r in st.session_state['registros'].items() if r['adiantamento']]
-    if not registros_com_adiantamento:
+    rid_sel = seletor_registro("Registro", 'com_adiantamento', key="sel_fat_registro")
+    reg = st.session_state['registros'].get(rid_sel)
+    if not reg or not reg['adiantamento']:
         st.info("Nenhum adiantamento encontrado.")
         return
-    rid_sel = st.selectbox("Registro", options=registros_com_adiantamento)
-    reg = st.session_state['registros'][rid_sel]
     c1, c2, c3 = st.columns(3)
     c1.metric("Adiantado (R$)", f"{float(reg['adiantamento']['valor']):,.2f}")
     adiantado, faturado, saldo = calcular_consumo(rid_sel)
     c2.metric("Faturado (R$)", f"{faturado:,.2f}")
     c3.metric("Saldo (R$)", f"{saldo:,.2f}")
     st.divider()
+    _fragmento_novo_faturamento(rid_sel)
+    st.divider()
+    _fragmento_editar_faturamento(rid_sel)
+    st.divider()
+    _fragmento_importar_faturamentos(rid_sel)
+
+@fragmento
+def _fragmento_novo_faturamento(rid_sel):
+    reg = st.session_state['registros'].get(rid_sel)
+    if reg is None:
+        return
     st.subheader("Novo faturamento")
     with st.form("form_faturamento_novo"):
         numero_fatura = st.text_input("Número da fatura/nota")
@@ -482,20 +3446,28 @@ def render_faturamentos():
             if valor_fatura <= 0:
                 st.warning("Informe um valor maior que zero.")
             else:
-                adicionar_faturamento(rid_sel, numero_fatura, valor_fatura, data_fatura, desc_fatura, unidade_nf)
-                st.success("Faturamento lançado")
-    st.divider()
+                duplicadas = faturas_duplicadas(numero_fatura)
+                if adicionar_faturamento(rid_sel, numero_fatura, valor_fatura, data_fatura, desc_fatura, unidade_nf):
+                    concluir_alteracao("Faturamento lançado", f"Número de fatura já lançado em: {', '.join(sorted(duplicadas))}" if duplicadas else None)
+
+@fragmento
+def _fragmento_editar_faturamento(rid_sel):
+    reg = st.session_state['registros'].get(rid_sel)
+    if reg is None:
+        return
     st.subheader("Editar faturamento")
     fats = reg['faturamentos']
     if fats:
         fat_ids = [f.get('id', f"{i}") for i, f in enumerate(fats)]
-        fat_sel_id = st.selectbox("Selecionar", options=fat_ids, format_func=lambda x: next((f['numero_fatura'] or x for f in fats if f.get('id', str(fats.index(f))) == x), x))
-        fat = next((f for f in fats if f.get('id') == fat_sel_id), None)
+        rotulos_fat = {fid: f.get('numero_fatura') or fid for fid, f in zip(fat_ids, fats)}
+        fat_sel_id = st.selectbox("Selecionar", options=fat_ids, format_func=lambda x: rotulos_fat.get(x, x))
+        fat = fats.por_id(fat_sel_id)
         if fat is None:
-            idx = fat_ids.index(fat_sel_id)
-            fat = fats[idx]
+            # Faturamento antigo, sem id: a opção é a posição na lista
+            fat = fats[int(fat_sel_id)]
             fat_sel_id = fat.get('id') or uuid.uuid4().hex[:8].upper()
             fat['id'] = fat_sel_id
+            fats.reindexar()
         with st.form("form_editar_faturamento"):
             numero_fatura_e = st.text_input("Número da fatura/nota", value=fat.get('numero_fatura',''))
             valor_e = st.number_input("Valor faturado (R$)", value=float(fat.get('valor',0.0)), min_value=0.0, step=100.0, format="%.2f")
@@ -506,26 +3478,60 @@ def render_faturamentos():
             unidade_fe = st.selectbox("Unidade", options=_uni_opts_fe, index=_uni_opts_fe.index(_curr_uni_fe) if _curr_uni_fe in _uni_opts_fe else 0)
             submitted_ef = st.form_submit_button("Salvar alterações")
             if submitted_ef:
-                editar_faturamento(rid_sel, fat_sel_id, numero_fatura_e, valor_e, data_e, desc_e, unidade_fe)
-                st.success("Faturamento atualizado")
+                duplicadas = faturas_duplicadas(numero_fatura_e, rid_sel, fat_sel_id)
+                if editar_faturamento(rid_sel, fat_sel_id, numero_fatura_e, valor_e, data_e, desc_e, unidade_fe):
+                    concluir_alteracao("Faturamento atualizado", f"Número de fatura já lançado em: {', '.join(sorted(duplicadas))}" if duplicadas else None)
         col_delf1, col_delf2 = st.columns([1, 3])
         confirm_del_f = col_delf1.checkbox("Confirmar exclusão do faturamento", key=f"confirm_del_f_{fat_sel_id}")
         if col_delf2.button("Excluir faturamento", key=f"btn_del_f_{fat_sel_id}"):
             if confirm_del_f:
-                excluir_faturamento(rid_sel, fat_sel_id)
-                st.success("Faturamento excluído")
-                st.rerun()
+                if excluir_faturamento(rid_sel, fat_sel_id):
+                    concluir_alteracao("Faturamento excluído")
             else:
                 st.warning("Marque a confirmação para excluir.")
     else:
         st.info("Sem faturamentos lançados")
 
+@fragmento
+def _fragmento_importar_faturamentos(rid_sel):
+    st.subheader("Importar faturamentos (CSV/OFX)")
+    st.caption("CSV com as colunas: " + ", ".join(COLUNAS_IMPORTACAO) + f". Em OFX, lançamentos sem código de registro no histórico vão para o registro {rid_sel}.")
+    arquivo_imp = st.file_uploader("Arquivo", type=['csv', 'ofx'], key="imp_arquivo")
+    c_sim, c_exc = st.columns(2)
+    simular = c_sim.checkbox("Simular (não grava)", value=True, key="imp_simular")
+    permitir_exceder = c_exc.checkbox("Permitir exceder saldo", value=False, key="imp_exceder")
+    if arquivo_imp is not None and st.button("Importar", key="imp_botao"):
+        if arquivo_imp.name.lower().endswith('.ofx'):
+            linhas_imp = ler_linhas_ofx(arquivo_imp, rid_sel)
+        else:
+            linhas_imp = ler_linhas_csv(arquivo_imp)
+        res = importar_faturamentos(linhas_imp, permitir_exceder=permitir_exceder, simular=simular)
+        st.session_state['_resultado_importacao'] = res
+        if res['aceitas'] and not simular:
+            # Totais e faturamentos do registro em tela mudaram: executa a página inteira
+            st.rerun()
+    res = st.session_state.pop('_resultado_importacao', None)
+    if res:
+        msg = f"{res['aceitas']} linha(s) aceita(s) (R$ {res['total']:,.2f}), {res['rejeitadas']} rejeitada(s)"
+        if res['rejeitadas']:
+            st.warning(msg)
+        else:
+            st.success(msg)
+        exibir_tabela(res['relatorio'])
+
 def render_financeiro():
-    registros_sem_adiantamento = [rid for rid, r in st.session_state['registros'].items() if r['adiantamento'] is None]
+    render_conflito('adiantamento')
+    _fragmento_gerar_adiantamento()
+    st.divider()
+    _fragmento_editar_adiantamento()
+
+@fragmento
+def _fragmento_gerar_adiantamento():
     st.subheader("Gerar adiantamento")
-    if registros_sem_adiantamento:
+    rid_fin = seletor_registro("Registro", 'sem_adiantamento', key="sel_fin_registro")
+    if rid_fin in st.session_state['registros']:
+        versao_vista = _versao_vista(rid_fin)
         with st.form("form_adiantamento"):
-            rid_fin = st.selectbox("Registro", options=registros_sem_adiantamento)
             valor_adiantamento = st.number_input("Valor do adiantamento (R$)", min_value=0.0, step=100.0, format="%.2f")
             data_adiantamento = st.date_input("Data do adiantamento", value=date.today())
             responsavel = st.selectbox("Responsável", options=RESPONSAVEL)
@@ -538,16 +3544,26 @@ def render_financeiro():
                 if valor_adiantamento <= 0:
                     st.warning("Informe um valor maior que zero.")
                 else:
-                    registrar_adiantamento(rid_fin, valor_adiantamento, data_adiantamento, responsavel, observacao_fin, unidade_ad)
-                    st.success("Adiantamento registrado")
+                    try:
+                        if registrar_adiantamento(rid_fin, valor_adiantamento, data_adiantamento, responsavel, observacao_fin, unidade_ad, versao=versao_vista):
+                            concluir_alteracao("Adiantamento registrado")
+                    except ConflitoVersao:
+                        _registrar_conflito('adiantamento', rid_fin, {
+                            'valor': valor_adiantamento, 'data_adiantamento': data_adiantamento, 'responsavel': responsavel,
+                            'observacao': observacao_fin, 'unidade': unidade_ad,
+                        })
+                        st.rerun()
+        _marcar_versao_vista(rid_fin)
     else:
         st.info("Não há solicitações pendentes de adiantamento")
-    st.divider()
+
+@fragmento
+def _fragmento_editar_adiantamento():
     st.subheader("Editar adiantamento")
-    registros_com_adiantamento = [rid for rid, r in st.session_state['registros'].items() if r['adiantamento']]
-    if registros_com_adiantamento:
-        rid_e = st.selectbox("Registro", options=registros_com_adiantamento, key="rid_edit_ad")
-        ad = st.session_state['registros'][rid_e]['adiantamento']
+    rid_e = seletor_registro("Registro", 'com_adiantamento', key="rid_edit_ad")
+    ad = st.session_state['registros'].get(rid_e, {}).get('adiantamento')
+    if ad:
+        versao_vista = _versao_vista(rid_e)
         with st.form("form_editar_adiantamento"):
             valor_e = st.number_input("Valor do adiantamento (R$)", value=float(ad.get('valor',0.0)), min_value=0.0, step=100.0, format="%.2f")
             data_e = st.date_input("Data do adiantamento", value=date.fromisoformat(ad.get('data_adiantamento')) if ad.get('data_adiantamento') else date.today())
@@ -560,27 +3576,96 @@ def render_financeiro():
             observacao_e = st.text_area("Observação", value=ad.get('observacao',''))
             submitted_ea = st.form_submit_button("Salvar alterações")
             if submitted_ea:
-                editar_adiantamento(rid_e, valor_e, data_e, responsavel_e, observacao_e, unidade_e)
-                st.success("Adiantamento atualizado")
+                try:
+                    if editar_adiantamento(rid_e, valor_e, data_e, responsavel_e, observacao_e, unidade_e, versao=versao_vista):
+                        st.success("Adiantamento atualizado")
+                except ConflitoVersao:
+                    _registrar_conflito('adiantamento', rid_e, {
+                        'valor': valor_e, 'data_adiantamento': data_e, 'responsavel': responsavel_e,
+                        'observacao': observacao_e, 'unidade': unidade_e,
+                    })
+                    st.rerun()
+        _marcar_versao_vista(rid_e)
         col_dela1, col_dela2 = st.columns([1, 3])
         confirm_del_a = col_dela1.checkbox("Confirmar exclusão do adiantamento", key=f"confirm_del_a_{rid_e}")
         if col_dela2.button("Excluir adiantamento", key=f"btn_del_a_{rid_e}"):
             if confirm_del_a:
-                excluir_adiantamento(rid_e)
-                st.success("Adiantamento excluído")
-                st.rerun()
+                if excluir_adiantamento(rid_e):
+                    concluir_alteracao("Adiantamento excluído")
             else:
                 st.warning("Marque a confirmação para excluir.")
     else:
         st.info("Nenhum adiantamento para editar")
 
-def render_relatorios():
-    tab_adi, tab_fat, tab_saldo = st.tabs(["Adiantamentos", "Faturamentos", "Saldos"])
-    with tab_adi:
-        linhas = []
-        for rid, reg in st.session_state['registros'].items():
+# ==== Exportação de relatórios (streaming) ====
+EXPORTACAO_LOTE = 5000
+
+COLUNAS_EXPORTACAO = {
+    'Adiantamentos': [
+        ('Registro', 'texto'), ('Solicitante', 'texto'), ('Descrição', 'texto'), ('Unidade', 'texto'),
+        ('Valor adiantado', 'numero'), ('Data adiantamento', 'texto'), ('Responsável', 'texto'),
+    ],
+    'Faturamentos': [
+        ('Registro', 'texto'), ('Unidade', 'texto'), ('Número fatura', 'texto'), ('Descrição', 'texto'),
+        ('Valor', 'numero'), ('Data', 'texto'),
+    ],
+}
+
+FORMATOS_EXPORTACAO = {
+    'CSV': ('csv', 'text/csv'),
+    'XLSX': ('xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+    'Parquet': ('parquet', 'application/vnd.apache.parquet'),
+}
+
+def _expr_primeiro_preenchido(*campos):
+    # Equivalente a "a or b or c" em Python: pula campos ausentes, nulos ou vazios
+    expr = ''
+    for campo in reversed(campos):
+        expr = {'$cond': [{'$eq': [{'$ifNull': [campo, '']}, '']}, expr, campo]}
+    return expr
+
+def pipeline_exportacao(tipo):
+    if tipo == 'Adiantamentos':
+        return [
+            {'$match': {'adiantamento': {'$ne': None}}},
+            {'$sort': {'_id': 1}},
+            {'$project': {
+                '_id': 0,
+                'Registro': '$_id',
+                'Solicitante': '$solicitacao.solicitante',
+                'Descrição': '$solicitacao.descricao',
+                'Unidade': {'$ifNull': ['$solicitacao.unidade', '']},
+                'Valor adiantado': '$adiantamento.valor',
+                'Data adiantamento': {'$ifNull': ['$adiantamento.data_adiantamento', '']},
+                'Responsável': {'$ifNull': ['$adiantamento.responsavel', '']},
+            }},
+        ]
+    return [
+        {'$match': {'faturamentos.0': {'$exists': True}}},
+        {'$sort': {'_id': 1}},
+        {'$unwind': '$faturamentos'},
+        {'$project': {
+            '_id': 0,
+            'Registro': '$_id',
+            'Unidade': _expr_primeiro_preenchido('$faturamentos.unidade', '$adiantamento.unidade', '$solicitacao.unidade'),
+            'Número fatura': {'$ifNull': ['$faturamentos.numero_fatura', '']},
+            'Descrição': {'$ifNull': ['$faturamentos.descricao', '']},
+            'Valor': {'$ifNull': ['$faturamentos.valor', 0.0]},
+            'Data': {'$ifNull': ['$faturamentos.data_fatura', '']},
+        }},
+    ]
+
+def iterar_linhas_exportacao(tipo):
+    # Gerador: as linhas saem do cursor em lotes, sem montar a lista completa em memória
+    if _usa_mongo():
+        cursor = get_backend().relatorios.aggregate(pipeline_exportacao(tipo), allowDiskUse=True, batchSize=EXPORTACAO_LOTE)
+        yield from cursor
+        return
+    for rid in sorted(st.session_state['registros']):
+        reg = st.session_state['registros'][rid]
+        if tipo == 'Adiantamentos':
             if reg['adiantamento']:
-                linhas.append({
+                yield {
                     'Registro': rid,
                     'Solicitante': reg['solicitacao']['solicitante'],
                     'Descrição': reg['solicitacao']['descricao'],
@@ -588,23 +3673,271 @@ def render_relatorios():
                     'Valor adiantado': float(reg['adiantamento']['valor']),
                     'Data adiantamento': reg['adiantamento'].get('data_adiantamento',''),
                     'Responsável': reg['adiantamento'].get('responsavel','')
-                })
-        st.dataframe(linhas, use_container_width=True)
-    with tab_fat:
-        linhas = []
-        for rid, reg in st.session_state['registros'].items():
+                }
+        else:
             for f in reg['faturamentos']:
-                linhas.append({
+                yield {
                     'Registro': rid,
-                    'Unidade': f.get('unidade') or reg['adiantamento'].get('unidade') or reg['solicitacao'].get('unidade',''),
+                    'Unidade': f.get('unidade') or (reg['adiantamento'] or {}).get('unidade') or reg['solicitacao'].get('unidade',''),
                     'Número fatura': f.get('numero_fatura',''),
                     'Descrição': f.get('descricao',''),
                     'Valor': float(f.get('valor',0.0)),
                     'Data': f.get('data_fatura','')
-                })
-        st.dataframe(linhas, use_container_width=True)
+                }
+
+def _em_lotes(iteravel, tamanho):
+    it = iter(iteravel)
+    while True:
+        lote = list(itertools.islice(it, tamanho))
+        if not lote:
+            return
+        yield lote
+
+def _limite_exportacao():
+    # Tamanho máximo do arquivo exportado, em bytes (0: sem limite). O Streamlit guarda o conteúdo
+    # inteiro em memória para servir o download.
+    return int(float(_config('MIDIA_EXPORTACAO_MAX_MB', 200)) * 1024 * 1024)
+
+def _conferir_tamanho(arquivo, limite):
+    if limite and arquivo.tell() > limite:
+        raise RuntimeError(f"O arquivo passou de {limite / (1024 * 1024):g} MB (MIDIA_EXPORTACAO_MAX_MB). "
+                           "Exporte em Parquet, que é menor, ou aumente o limite.")
+
+def exportar_relatorio(tipo, formato, lote=EXPORTACAO_LOTE, limite=0):
+    # Escreve o relatório lote a lote num arquivo temporário (em memória até 8 MB, depois em disco).
+    # Com limite (bytes), para com RuntimeError assim que o arquivo passa dele: a cada lote no CSV e
+    # no Parquet; no XLSX, escrito só no fim, depois de salvar.
+    # Retorna (arquivo posicionado no início, quantidade de linhas).
+    colunas = COLUNAS_EXPORTACAO[tipo]
+    nomes = [c for c, _ in colunas]
+    arquivo = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+    total = 0
+    linhas = iterar_linhas_exportacao(tipo)
+    if formato == 'CSV':
+        texto = io.TextIOWrapper(arquivo, encoding='utf-8-sig', newline='')
+        escritor = csv.DictWriter(texto, fieldnames=nomes, extrasaction='ignore')
+        escritor.writeheader()
+        for bloco in _em_lotes(linhas, lote):
+            escritor.writerows(bloco)
+            total += len(bloco)
+            _conferir_tamanho(arquivo, limite)
+        texto.flush()
+        texto.detach()
+    elif formato == 'XLSX':
+        if not _HAS_OPENPYXL:
+            raise RuntimeError("Dependência openpyxl ausente. Adicione 'openpyxl' ao requirements.txt.")
+        # write_only: as linhas vão direto para o arquivo, sem manter a planilha em memória
+        wb = openpyxl.Workbook(write_only=True)
+        ws = wb.create_sheet(tipo)
+        ws.append(nomes)
+        for bloco in _em_lotes(linhas, lote):
+            for linha in bloco:
+                ws.append([linha.get(c) for c in nomes])
+            total += len(bloco)
+        wb.save(arquivo)
+    elif formato == 'Parquet':
+        if not _HAS_PYARROW:
+            raise RuntimeError("Dependência pyarrow ausente. Adicione 'pyarrow' ao requirements.txt.")
+        schema = pa.schema([(c, pa.float64() if t == 'numero' else pa.string()) for c, t in colunas])
+        with pq.ParquetWriter(arquivo, schema) as escritor:
+            for bloco in _em_lotes(linhas, lote):
+                escritor.write_table(pa.Table.from_pylist(bloco, schema=schema))
+                total += len(bloco)
+                _conferir_tamanho(arquivo, limite)
+    else:
+        raise ValueError(f"Formato de exportação desconhecido: {formato}")
+    _conferir_tamanho(arquivo, limite)
+    arquivo.seek(0)
+    return arquivo, total
+
+@fragmento
+def render_exportacao():
+    with st.expander("Exportar relatório"):
+        c1, c2 = st.columns(2)
+        tipo = c1.selectbox("Relatório", options=list(COLUNAS_EXPORTACAO), key="exp_tipo")
+        formato = c2.selectbox("Formato", options=list(FORMATOS_EXPORTACAO), key="exp_formato")
+        if st.button("Gerar arquivo", key="exp_gerar"):
+            try:
+                arquivo, total = exportar_relatorio(tipo, formato, limite=_limite_exportacao())
+            except Exception as e:
+                st.error(f"Falha ao exportar relatório: {e}")
+                return
+            extensao, mime = FORMATOS_EXPORTACAO[formato]
+            # O download_button não aceita o SpooledTemporaryFile ("Invalid binary data format"),
+            # mas aceita um io.BufferedReader: um leitor sobre o descritor do temporário (fileno()
+            # passa para o disco o que ainda estava em memória). O Streamlit ainda lê o arquivo
+            # inteiro para servir o download; quem segura a memória é o limite de tamanho.
+            with arquivo, open(arquivo.fileno(), 'rb', closefd=False) as leitor:
+                st.caption(f"{total} linha(s) exportada(s)")
+                st.download_button(
+                    f"Baixar {tipo.lower()} ({formato})",
+                    data=leitor,
+                    file_name=f"midia_control_{tipo.lower()}_{date.today().isoformat()}.{extensao}",
+                    mime=mime,
+                )
+
+def render_relatorios():
+    render_exportacao()
+    tab_adi, tab_fat, tab_saldo, tab_arq = st.tabs(["Adiantamentos", "Faturamentos", "Saldos", "Arquivados"])
+    with tab_adi:
+        _fragmento_tabela_relatorio('rel_adi', 'com_adiantamento', 'adiantamentos')
+    with tab_fat:
+        _fragmento_tabela_relatorio('rel_fat', 'com_faturamentos', 'faturamentos')
     with tab_saldo:
-        render_resumo_financeiro()
+        _fragmento_tabela_relatorio('rel_saldo', 'todos', 'saldos')
+    with tab_arq:
+        _fragmento_arquivados()
+
+@fragmento
+def _fragmento_tabela_relatorio(key, filtro, tabela):
+    # Mudar de página numa aba refaz só a tabela dela
+    linhas = paginar_registros(key, filtro, limite=PAGINA_RELATORIO, tabela=tabela)
+    if tabela == 'saldos':
+        render_resumo_financeiro(linhas=linhas)
+    else:
+        exibir_tabela(linhas)
+
+@fragmento
+def _fragmento_arquivados():
+    if not st.session_state.get('db_loaded'):
+        st.caption("Arquivo disponível apenas com o banco de dados conectado.")
+        return
+    # As abas são montadas juntas: o arquivo só é consultado quando pedido
+    if not st.toggle("Consultar registros arquivados", key="arq_consultar"):
+        return
+    inicios = st.session_state.setdefault('_pag_arquivo', [None])
+    try:
+        docs = get_backend().listar_arquivados(inicios[-1], PAGINA_RELATORIO)
+    except Exception as e:
+        st.error(f"Falha ao consultar o arquivo: {e}")
+        return
+    proximo = docs[PAGINA_RELATORIO - 1]['_id'] if len(docs) > PAGINA_RELATORIO else None
+    docs = docs[:PAGINA_RELATORIO]
+    _botoes_pagina('rel_arq', inicios, proximo)
+    if not docs:
+        st.info("Nenhum registro arquivado")
+        return
+    exibir_tabela([{
+        'Registro': d['_id'],
+        'Descrição': d.get('descricao', ''),
+        'Unidade': d.get('unidade', ''),
+        'Solicitante': d.get('solicitante', ''),
+        'Valor adiantado': d.get('adiantado', 0.0),
+        'Total faturado': d.get('total_faturado', 0.0),
+        'Faturamentos': d.get('faturamentos', 0),
+        'Última movimentação': d.get('ultima_movimentacao', ''),
+        'Arquivado em': d['arquivado_em'].strftime('%d/%m/%Y') if d.get('arquivado_em') else '',
+    } for d in docs])
+    rid = st.selectbox("Detalhar registro arquivado", options=[d['_id'] for d in docs], index=None, key="arq_registro")
+    if rid is None:
+        return
+    doc = get_backend().ler_arquivado(rid)
+    if doc is None:
+        st.info("Registro não está mais no arquivo")
+        return
+    exibir_tabela(_linhas_faturamentos([doc]))
+    if st.button("Restaurar para o conjunto ativo", key=f"arq_restaurar_{rid}"):
+        try:
+            restaurar_arquivado(rid)
+        except Exception as e:
+            st.error(f"Falha ao restaurar registro: {e}")
+        else:
+            concluir_alteracao(f"Registro {rid} restaurado")
+
+def render_manutencao():
+    if st.button("Reconstruir consolidação mensal"):
+        n = reconstruir_rollup_mensal()
+        st.success(f"Consolidação mensal reconstruída ({n} combinação(ões) de unidade, mês e solicitante)")
+    if st.session_state.get('db_loaded'):
+        dias = st.number_input("Arquivar encerrados sem movimentação há (dias)", min_value=0, step=30,
+                               value=int(_config('MIDIA_ARQUIVO_DIAS', 365)), key="arq_dias")
+        if st.button("Arquivar registros encerrados", key="arq_arquivar"):
+            try:
+                arquivados = arquivar_encerrados(dias)
+                st.success(f"{len(arquivados)} registro(s) arquivado(s)")
+            except Exception as e:
+                st.error(f"Falha ao arquivar registros: {e}")
+    if not _usa_mongo():
+        st.caption("Manutenção disponível apenas com o MongoDB conectado.")
+        return
+    if st.button("Recalcular totais materializados"):
+        try:
+            n = recalcular_totais_materializados()
+            st.success(f"Totais recalculados em {n} registro(s)")
+        except Exception as e:
+            st.error(f"Falha ao recalcular totais no MongoDB: {e}")
+    if st.button("Criar índices"):
+        try:
+            garantir_indices(get_collection())
+            st.success("Índices criados ou já existentes")
+        except Exception as e:
+            st.error(f"Falha ao criar índices no MongoDB: {e}")
+    if st.button("Verificar uso de índices"):
+        try:
+            exibir_tabela(verificar_uso_indices())
+        except Exception as e:
+            st.error(f"Falha ao executar explain no MongoDB: {e}")
+    if st.button("Verificar totais materializados"):
+        try:
+            divergentes = verificar_totais_materializados()
+        except Exception as e:
+            st.error(f"Falha ao verificar totais no MongoDB: {e}")
+        else:
+            if divergentes:
+                st.warning(f"{len(divergentes)} registro(s) com totais divergentes")
+                exibir_tabela(divergentes)
+            else:
+                st.success("Nenhuma divergência encontrada")
+
+def render_metricas():
+    if not _metricas_ativas():
+        st.caption("Métricas de desempenho desativadas (defina MIDIA_METRICAS=1).")
+        return
+    st.markdown("**Desempenho**")
+    exibir_tabela(resumo_metricas())
+    _, contadores = get_metricas().instantaneo()
+    mongo = [
+        {'Comando': rotulo, 'Chamadas': valor, 'Bytes recebidos': contadores.get(('mongo_bytes_total', rotulo), 0)}
+        for (metrica, rotulo), valor in sorted(contadores.items()) if metrica == 'mongo_comandos_total'
+    ]
+    if mongo:
+        exibir_tabela(mongo)
+    c1, c2, c3 = st.columns(3)
+    c1.download_button("Prometheus", metricas_prometheus(), file_name="midia_control_metricas.prom", mime="text/plain")
+    c2.download_button("JSON", metricas_json(), file_name="midia_control_metricas.json", mime="application/json")
+    if c3.button("Zerar"):
+        get_metricas().zerar()
+        st.rerun()
+
+def _render_admin():
+    senha_admin = _config('MIDIA_ADMIN_SENHA')
+    if not senha_admin:
+        return
+    with st.expander("Administração"):
+        if not st.session_state.get('admin'):
+            senha = st.text_input("Senha de administrador", type="password", key="admin_senha")
+            if senha and hmac.compare_digest(senha, str(senha_admin)):
+                st.session_state['admin'] = True
+                st.rerun()
+        else:
+            render_manutencao()
+            if _metricas_ativas():
+                est = estatisticas_tabelas()
+                st.caption(f"Cache de tabelas: {est['acertos']} acerto(s), {est['faltas']} falta(s), taxa de acerto {est['taxa_acerto']:.0%}")
+            else:
+                st.caption("Cache de tabelas: acertos e faltas são contados só com MIDIA_METRICAS=1")
+            if st.session_state.get('db_loaded'):
+                cache = get_cache_registros()
+                situacao = 'reconciliado com o banco' if cache.reconciliado else 'reconciliação com o banco em andamento'
+                gravado = cache.snapshot_gravado_em.strftime('%d/%m/%Y %H:%M:%S') if cache.snapshot_gravado_em else '-'
+                st.caption(f"Registros carregados do {cache.origem} ({situacao}). Último snapshot gravado: {gravado} UTC")
+            if _usa_mongo():
+                opcoes = _opcoes_conexao()
+                st.caption(f"Conexões MongoDB: pool de {opcoes['minPoolSize']} a {opcoes['maxPoolSize']}, "
+                           f"compressão {opcoes['compressors'] or 'desligada'}, leituras de relatório em {_preferencia_relatorios().mongos_mode}")
+            render_metricas()
+
+instrumentar(VIEWS_INSTRUMENTADAS)
 
 if 'view' not in st.session_state:
     st.session_state['view'] = 'Dashboard'
@@ -615,6 +3948,16 @@ with st.sidebar:
     if view != st.session_state['view']:
         st.session_state['view'] = view
         st.rerun()
+    if _write_behind_ativo() and st.session_state.get('db_loaded'):
+        estado_fila = get_fila_gravacao().estado()
+        st.caption(f"Fila de gravação: {estado_fila['pendentes']} pendente(s), atraso de {estado_fila['atraso']:.0f}s")
+        if estado_fila['ultimo_erro']:
+            st.warning(f"MongoDB indisponível, gravações aguardando nova tentativa. Detalhe: {estado_fila['ultimo_erro']}")
+        if estado_fila['falhas']:
+            st.error(f"{estado_fila['falhas']} gravação(ões) rejeitada(s) pelo MongoDB. Verifique o journal da fila.")
+    _render_admin()
+
+exibir_mensagens()
 
 if st.session_state['view'] == 'Solicitações':
     render_solicitacoes()
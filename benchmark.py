@@ -0,0 +1,848 @@
+# Benchmark do Midia Control
+#
+# Gera registros sintéticos (distribuições de UNIDADES, SOLICITANTES e RESPONSAVEL lidas do app),
+# popula um banco MongoDB (mongomock em memória ou um mongod local) ou, com --sqlite, o arquivo do
+# backend SQLite, e mede, dentro do runtime do
+# Streamlit (AppTest), os caminhos críticos da aplicação. O resultado é gravado em JSON para comparar
+# execuções. Com --carga, em vez dos cenários, simula várias sessões simultâneas (teste de carga).
+#
+# Uso:
+#   python benchmark.py --registros 10000
+#   python benchmark.py --registros 100000 --mongo mongodb://localhost:27017 --saida antes.json
+#   python benchmark.py --latencia-ms 40 --cenarios load_all_registros,load_all_registros_paralelo
+#   python benchmark.py --registros 50000 --sqlite /tmp/bench.db --saida sqlite.json
+#   python benchmark.py --registros 50000 --faturamentos 13 --cenarios dashboard_rerun
+#   python benchmark.py --carga --sessoes 30 --duracao 120
+#   python benchmark.py --carga --mongo mongodb://localhost:27017 --processos 3 --sessoes 10
+#
+# Dependências: streamlit e mongomock (ou um mongod local com --mongo; nenhuma a mais com --sqlite).
+import argparse
+import ast
+import json
+import multiprocessing
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import textwrap
+import threading
+import time
+from datetime import date, datetime, timedelta
+from unittest import mock
+
+DIRETORIO = os.path.dirname(os.path.abspath(__file__))
+APP = os.path.join(DIRETORIO, 'Midia_Control.py')
+
+# ==== Gerador de dados sintéticos ====
+def ler_constantes(caminho=APP):
+    # Lê as listas do app sem executá-lo (o módulo é um script Streamlit)
+    arvore = ast.parse(open(caminho, encoding='utf-8').read())
+    constantes = {}
+    for no in arvore.body:
+        if isinstance(no, ast.Assign) and len(no.targets) == 1 and isinstance(no.targets[0], ast.Name):
+            nome = no.targets[0].id
+            if nome in ('UNIDADES', 'SOLICITANTES', 'RESPONSAVEL'):
+                constantes[nome] = ast.literal_eval(no.value)
+    return constantes
+
+def _status(adiantado, saldo):
+    # Mesma regra de status_registro no app
+    return 'Encerrado' if adiantado > 0 and saldo <= 0 else ('Em aberto' if adiantado > 0 else 'Aguardando adiantamento')
+
+def gerar_registros(n, constantes, semente=42, inicio=date(2022, 1, 1), dias=3 * 365, faturamentos=4):
+    # Documentos no formato gravado pelo app, com totais materializados.
+    # Unidades seguem uma distribuição de Zipf (poucas unidades concentram a maior parte dos registros);
+    # ~85% dos registros têm adiantamento e a quantidade de faturamentos segue uma exponencial de
+    # média 'faturamentos'.
+    rnd = random.Random(semente)
+    unidades = constantes['UNIDADES']
+    pesos_unidades = [1 / (i + 1) for i in range(len(unidades))]
+    agora = datetime.utcnow()
+    for i in range(n):
+        unidade = rnd.choices(unidades, pesos_unidades)[0]
+        data_sol = inicio + timedelta(days=rnd.randrange(dias))
+        estimado = round(rnd.lognormvariate(8, 0.8), 2)
+        doc = {
+            '_id': f'{i:08X}',
+            'solicitacao': {
+                'descricao': f'Campanha {rnd.choice(["Matrículas", "Eventos", "Institucional", "Vestibular", "Festa Junina"])} {data_sol.year} #{i}',
+                'solicitante': rnd.choice(constantes['SOLICITANTES']),
+                'valor_estimado': estimado,
+                'data_solicitacao': data_sol.isoformat(),
+                'observacoes': '',
+                'unidade': unidade,
+            },
+            'adiantamento': None,
+            'faturamentos': [],
+            'created_at': agora,
+            'updated_at': agora,
+        }
+        adiantado = 0.0
+        faturado = 0.0
+        if rnd.random() < 0.85:
+            adiantado = round(estimado * rnd.uniform(0.8, 1.2), 2)
+            data_ad = data_sol + timedelta(days=rnd.randrange(1, 30))
+            doc['adiantamento'] = {
+                'valor': adiantado,
+                'data_adiantamento': data_ad.isoformat(),
+                'responsavel': rnd.choice(constantes['RESPONSAVEL']),
+                'observacao': '',
+                'unidade': unidade,
+            }
+            quantidade = min(int(rnd.expovariate(1 / faturamentos)), 60)
+            if quantidade:
+                alvo = adiantado * rnd.uniform(0.3, 1.1)
+                partes = [rnd.random() for _ in range(quantidade)]
+                soma_partes = sum(partes)
+                for j, parte in enumerate(partes):
+                    valor = round(alvo * parte / soma_partes, 2) or 0.01
+                    doc['faturamentos'].append({
+                        'id': f'{rnd.getrandbits(32):08X}',
+                        'numero_fatura': f'NF-{i}-{j + 1}',
+                        'valor': valor,
+                        'data_fatura': (data_ad + timedelta(days=rnd.randrange(0, 120))).isoformat(),
+                        'descricao': f'Impulsionamento {j + 1}',
+                        'unidade': unidade,
+                    })
+                    faturado += valor
+        faturado = round(faturado, 2)
+        doc['total_faturado'] = faturado
+        doc['saldo'] = round(adiantado - faturado, 2)
+        doc['status'] = _status(adiantado, doc['saldo'])
+        yield doc
+
+def popular(col, docs, lote=5000):
+    col.drop()
+    col.database['registros_excluidos'].drop()
+    bloco = []
+    total = 0
+    for doc in docs:
+        bloco.append(doc)
+        if len(bloco) >= lote:
+            col.insert_many(bloco, ordered=False)
+            total += len(bloco)
+            bloco = []
+    if bloco:
+        col.insert_many(bloco, ordered=False)
+        total += len(bloco)
+    return total
+
+# O arquivo SQLite é populado pelo próprio backend do app (mesmas colunas extraídas e índices), numa
+# única transação
+SCRIPT_POPULAR_SQLITE = '''
+import sys
+import streamlit as st
+sys.path.insert(0, {diretorio!r})
+import benchmark
+_app = {app!r}
+exec(compile(open(_app, encoding='utf-8').read(), _app, 'exec'))
+_b = get_backend()
+with _b.lock:
+    _b.conn.execute('BEGIN IMMEDIATE')
+    for _tabela in ('registros', 'registros_excluidos', 'registros_arquivados'):
+        _b.conn.execute(f'DELETE FROM {{_tabela}}')
+    _total = 0
+    for _doc in benchmark.gerar_registros({n}, benchmark.ler_constantes(), {semente}, faturamentos={faturamentos}):
+        _b._gravar_doc(_doc)
+        _total += 1
+    _b.conn.execute('COMMIT')
+st.session_state['_total'] = _total
+'''
+
+def popular_sqlite(ambiente, n, semente, faturamentos):
+    at = ambiente.app(SCRIPT_POPULAR_SQLITE.format(diretorio=DIRETORIO, app=APP, n=n, semente=semente, faturamentos=faturamentos))
+    ambiente.executar(at)
+    if at.exception:
+        raise SystemExit(f"Falha ao popular o SQLite: {at.exception[0].message}")
+    return at.session_state['_total']
+
+# ==== Cenários ====
+# Cada cenário é executado dentro de um script que carrega o app (exec) e mede apenas o trecho
+# 'codigo', repetido N vezes; 'preparo' roda uma vez antes das medições.
+CENARIOS = {
+    'load_all_registros': ('', 'load_all_registros()'),
+    'dashboard_python': ('', '''
+        _f = filtrar_registros(st.session_state['registros'], [UNIDADES[0]], None, ['Em aberto'])
+        linhas_resumo_financeiro(_f)
+    '''),
+    'dashboard_colunar_frame': ('', '''
+        frame_registros.clear()
+        frame_registros(versao_dados(), st.session_state['registros'])
+    '''),
+    'dashboard_colunar_filtro': ('frame_registros(versao_dados(), st.session_state["registros"])', '''
+        totais_colunares(versao_dados(), st.session_state['registros'], [UNIDADES[0]], None, ['Em aberto'])
+    '''),
+    'dashboard_servidor': ('', "agregar_dashboard([UNIDADES[0]], None, ['Em aberto'])"),
+    # Dados de um rerun do Dashboard com filtros que ainda não estão no memo de resumo_dashboard:
+    # opções dos filtros, totais e linhas colunares e a série da tendência mensal. Cada repetição
+    # passa por todas as combinações; 'rerun_max_ms' é o pior rerun. Meta: < 50 ms com 50k
+    # registros e ~500k faturamentos (--registros 50000 --faturamentos 13).
+    'dashboard_rerun': ('''
+        frame_registros(versao_dados(), st.session_state['registros'])
+        rollup_mensal()
+        # Mede o regime normal: a montagem do índice de busca em segundo plano, logo após a carga,
+        # disputa o GIL por alguns segundos
+        with get_cache_registros().busca.lock:
+            pass
+        _combinacoes = [(None, None, None), (None, None, ['Em aberto'])] + [
+            ([u], None, [['Encerrado'], ['Em aberto'], None][i % 3]) for i, u in enumerate(UNIDADES[:6])
+        ] + [(UNIDADES[:3], SOLICITANTES[:2], None)]
+        _medidas = {'faturamentos': sum(len(r['faturamentos']) for r in st.session_state['registros'].values()),
+                    'combinacoes': len(_combinacoes), 'rerun_max_ms': 0.0}
+    ''', '''
+        for _u, _s, _st in _combinacoes:
+            _t = time.perf_counter()
+            opcoes_filtros(versao_dados(), st.session_state['registros'])
+            totais_colunares(versao_dados(), st.session_state['registros'], _u, _s, _st)
+            rollup_mensal().serie(_u, _s, None, None)
+            _medidas['rerun_max_ms'] = max(_medidas['rerun_max_ms'], (time.perf_counter() - _t) * 1000)
+    '''),
+    'load_all_registros_paralelo': ('', 'load_all_registros()'),
+    'dashboard_servidor_paralelo': ('', "agregar_dashboard(None, None, ['Em aberto'])"),
+    'relatorios': ('_filtros = {"adiantamentos": "com_adiantamento", "faturamentos": "com_faturamentos", "saldos": "todos"}', '''
+        for _t, _montar in TABELAS_RELATORIO.items():
+            _montar(buscar_pagina_registros(_filtros[_t], None, PAGINA_RELATORIO)[0])
+    '''),
+    'processar_faturamentos_em_lote': ('''
+        _rid = next(r for r, g in st.session_state['registros'].items() if g['adiantamento'])
+        _linhas = [{'numero_fatura': f'BENCH-{k}', 'valor': 10.0, 'data_fatura': '2024-01-01', 'descricao': 'benchmark'} for k in range(50)]
+    ''', '''
+        _r = processar_faturamentos_em_lote(_rid, _linhas, permitir_exceder=True)
+        if not _r['inseridos']:
+            raise RuntimeError(_r['mensagem'])
+    '''),
+    # Bytes retidos por registro: dicionários aninhados (representação anterior) x modelos com __slots__
+    'memoria_registros': ('''
+        import gc, tracemalloc
+        def _retido(construir):
+            gc.collect()
+            tracemalloc.start()
+            _docs = list(get_backend().carregar())
+            _dados = construir(_docs)
+            del _docs
+            gc.collect()
+            _bytes = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            return _bytes / max(len(_dados), 1)
+        _chaves = ('solicitacao', 'adiantamento', 'faturamentos', 'total_faturado', 'saldo', 'status')
+        def _em_centavos(docs):
+            # Os mesmos modelos com os valores monetários em centavos inteiros
+            _regs = [_doc_para_registro(d) for d in docs]
+            for _reg in _regs:
+                for _m in [_reg, _reg.solicitacao, _reg.adiantamento, *_reg.faturamentos]:
+                    for _nome in (type(_m).NUMERICOS if _m is not None else ()):
+                        if getattr(_m, _nome, None) is not None:
+                            setattr(_m, _nome, _centavos(getattr(_m, _nome)))
+            return _regs
+        _medidas = {
+            'bytes_por_registro_dict': _retido(lambda docs: [{k: d.get(k) for k in _chaves} for d in docs]),
+            'bytes_por_registro_modelo': _retido(lambda docs: [_doc_para_registro(d) for d in docs]),
+            'bytes_por_registro_modelo_centavos': _retido(_em_centavos),
+        }
+    ''', 'pass'),
+    # Laços sobre todos os registros que leem os modelos: totais na carga,
+    # frame do dashboard, consolidação mensal e índice de faturas (ms por montagem completa)
+    'acesso_registros': ('''
+        _regs = st.session_state['registros']
+        _medidas = {}
+        def _medir(nome, funcao):
+            _t = time.perf_counter()
+            funcao()
+            _ms = (time.perf_counter() - _t) * 1000
+            _medidas[nome] = min(_medidas.get(nome, _ms), _ms)
+    ''', '''
+        _medir('totais_ms', lambda: [_r.recalcular_totais() for _r in _regs.values()])
+        _medir('frame_ms', lambda: frame_registros.__wrapped__(0, _regs))
+        _medir('rollup_ms', lambda: RollupMensal(_regs))
+        _medir('indice_faturas_ms', lambda: IndiceFaturas(_regs))
+        _medir('resumo_financeiro_ms', lambda: linhas_resumo_financeiro(_regs))
+    '''),
+    # Busca textual sobre o índice já montado (ms, melhor de cada consulta entre as repetições):
+    # termo exato com acento, prefixo, erro de digitação, vários termos, termos de 1 e 2 caracteres,
+    # nº de fatura com e sem separadores ou ainda incompleto e um termo presente em todos os
+    # registros (pior caso).
+    # 'seletor_*_ms' é a primeira página do seletor de registros para a mesma consulta.
+    # Meta: milissegundos com 100k registros (--registros 100000 --cenarios busca)
+    'busca': ('''
+        _indice = indice_busca()
+        with _indice.lock:
+            pass
+        _regs = st.session_state['registros']
+        _fatura = next(r['faturamentos'][0]['numero_fatura'] for r in itertools.islice(_regs.values(), len(_regs) // 2, None) if r['faturamentos'])
+        _consultas = {
+            'exato': 'matrículas', 'prefixo': 'vestib', 'aproximada': 'vestibulr', 'varios_termos': 'festa junina 2023',
+            'um_caractere': 'v', 'dois_caracteres': 'ma', 'fatura': _fatura, 'fatura_sem_separador': _fatura.replace('-', ''),
+            'fatura_digitando': _fatura.replace('-', '')[:-2], 'todos': 'campanha',
+        }
+        _medidas = {'faturamentos': sum(len(r['faturamentos']) for r in _regs.values())}
+        def _medir(nome, funcao):
+            _t = time.perf_counter()
+            _resultado = funcao()
+            _ms = (time.perf_counter() - _t) * 1000
+            _medidas[f'{nome}_ms'] = min(_medidas.get(f'{nome}_ms', _ms), _ms)
+            return _resultado
+    ''', '''
+        for _nome, _consulta in _consultas.items():
+            _medidas[f'{_nome}_resultados'] = len(_medir(_nome, lambda: _indice.buscar(_consulta)))
+            _medir(f'seletor_{_nome}', lambda: buscar_pagina_registros('todos', None, PAGINA_REGISTROS, _consulta))
+    '''),
+    # Pico de memória (tracemalloc) da exportação de faturamentos em streaming, com 10k e 100k
+    # linhas, contra a lista completa de linhas montada em memória. As linhas vêm de um gerador
+    # com cópias das linhas reais, para medir o app sem o cursor: o mongomock materializa o
+    # resultado da agregação inteiro, o mongod entrega em lotes.
+    'memoria_exportacao': ('''
+        import gc, tracemalloc
+        def _pico(funcao):
+            gc.collect()
+            tracemalloc.start()
+            resultado = funcao()
+            pico = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            return pico, resultado
+        _amostra = list(itertools.islice(iterar_linhas_exportacao('Faturamentos'), 1000))
+        def iterar_linhas_exportacao(tipo, _n=0):
+            for _i in range(_n):
+                yield dict(_amostra[_i % len(_amostra)])
+        _medidas = {}
+        for _n in (10000, 100000):
+            iterar_linhas_exportacao.__defaults__ = (_n,)
+            _medidas[f'pico_lista_{_n}_bytes'] = _pico(lambda: list(iterar_linhas_exportacao('Faturamentos')))[0]
+            for _formato in FORMATOS_EXPORTACAO:
+                _bytes, (_arquivo, _total) = _pico(lambda: exportar_relatorio('Faturamentos', _formato))
+                _arquivo.seek(0, 2)
+                _medidas[f'pico_{_formato.lower()}_{_n}_bytes'] = _bytes
+                _medidas[f'arquivo_{_formato.lower()}_{_n}_bytes'] = _arquivo.tell()
+                _arquivo.close()
+    ''', 'pass'),
+    'exportacao_csv': ('', '''
+        for _tipo in COLUNAS_EXPORTACAO:
+            exportar_relatorio(_tipo, 'CSV')[0].close()
+    '''),
+    'exportacao_xlsx': ('', '''
+        for _tipo in COLUNAS_EXPORTACAO:
+            exportar_relatorio(_tipo, 'XLSX')[0].close()
+    '''),
+    'exportacao_parquet': ('', '''
+        for _tipo in COLUNAS_EXPORTACAO:
+            exportar_relatorio(_tipo, 'Parquet')[0].close()
+    '''),
+}
+
+# Importação de 10k linhas de faturamento (CSV e OFX) distribuídas pelos registros com saldo;
+# valores pequenos para que a validação de saldo aceite todas
+PREPARO_IMPORTACAO = '''
+    _alvos = [r for r, g in st.session_state['registros'].items() if g['adiantamento'] and calcular_consumo(r)[2] > 10]
+    _linhas_csv = ['registro;numero_fatura;valor;data_fatura;descricao']
+    _linhas_ofx = ['OFXHEADER:100', 'DATA:OFXSGML', '<OFX><BANKMSGSRSV1><STMTTRNRS><STMTRS><BANKTRANLIST>']
+    for _k in range(10000):
+        _rid = _alvos[_k % len(_alvos)]
+        _linhas_csv.append(f'{_rid};IMP-{_k};0,01;15/03/2024;Importação {_k}')
+        _linhas_ofx.append(f'<STMTTRN><TRNTYPE>DEBIT<DTPOSTED>20240315<TRNAMT>-0.01<FITID>OFX-{_k}<MEMO>Campanha {_rid}</STMTTRN>')
+    _linhas_ofx.append('</BANKTRANLIST></STMTRS></STMTTRNRS></BANKMSGSRSV1></OFX>')
+    _csv = '\\n'.join(_linhas_csv).encode('utf-8')
+    _ofx = '\\n'.join(_linhas_ofx).encode('cp1252')
+    def _importar(leitor, conteudo, simular):
+        _r = importar_faturamentos(leitor(io.BytesIO(conteudo)), simular=simular)
+        if _r['aceitas'] < 9000:
+            raise RuntimeError(f"Só {_r['aceitas']} de {len(_r['relatorio'])} linhas aceitas: {_r['relatorio'][0]['Motivo']}")
+        globals()['_medidas'] = {'linhas': len(_r['relatorio']), 'aceitas': _r['aceitas']}
+'''
+
+CENARIOS.update({
+    'importacao_csv_simulacao': (PREPARO_IMPORTACAO, '_importar(ler_linhas_csv, _csv, True)'),
+    'importacao_csv': (PREPARO_IMPORTACAO, '_importar(ler_linhas_csv, _csv, False)'),
+    'importacao_ofx_simulacao': (PREPARO_IMPORTACAO, '_importar(ler_linhas_ofx, _ofx, True)'),
+    'importacao_ofx': (PREPARO_IMPORTACAO, '_importar(ler_linhas_ofx, _ofx, False)'),
+})
+
+# Variáveis de ambiente aplicadas só durante o cenário
+AMBIENTE_CENARIOS = {
+    'load_all_registros_paralelo': {'MIDIA_CONCORRENCIA': '13'},
+    'dashboard_servidor_paralelo': {'MIDIA_CONCORRENCIA': '13'},
+}
+
+# Cenários que só existem no MongoDB (consultas paralelas por unidade); ficam fora com --sqlite
+CENARIOS_SO_MONGO = {'load_all_registros_paralelo', 'dashboard_servidor_paralelo'}
+
+VIEWS = ["Solicitações", "Financeiro", "Faturamentos", "Relatórios", "Dashboard"]
+
+# Executa o app e guarda as latências medidas por ele (MIDIA_METRICAS=1), entre elas a de cada
+# fragmento: o custo de uma interação com um widget do fragmento, sem o resto do script. Um
+# fragmento aninhado (seções do Dashboard) entra também no tempo do fragmento que o contém.
+# Antes de devolver, espera a montagem do índice de busca em segundo plano, que disputaria o GIL
+# com os reruns medidos.
+SCRIPT_METRICAS = f'''
+import streamlit as st
+_app = {APP!r}
+exec(compile(open(_app, encoding='utf-8').read(), _app, 'exec'))
+if st.session_state.get('db_loaded'):
+    with get_cache_registros().busca.lock:
+        pass
+st.session_state['_latencias'] = get_metricas().instantaneo()[0]
+'''
+
+def script_cenario(preparo, codigo, repeticoes):
+    preparo = textwrap.indent(textwrap.dedent(preparo).strip(), '    ')
+    codigo = textwrap.indent(textwrap.dedent(codigo).strip(), '        ')
+    return f'''
+import time
+import streamlit as st
+_app = {APP!r}
+exec(compile(open(_app, encoding='utf-8').read(), _app, 'exec'))
+try:
+{preparo or '    pass'}
+    _tempos = []
+    for _ in range({repeticoes}):
+        _inicio = time.perf_counter()
+{codigo}
+        _tempos.append(time.perf_counter() - _inicio)
+    st.session_state['_bench'] = {{'tempos': _tempos, **globals().get('_medidas', {{}})}}
+except Exception as _e:
+    st.session_state['_bench'] = {{'erro': f'{{type(_e).__name__}}: {{_e}}'}}
+'''
+
+def estatisticas(tempos):
+    return {
+        'execucoes': len(tempos),
+        'min': min(tempos),
+        'mediana': statistics.median(tempos),
+        'media': statistics.fmean(tempos),
+        'max': max(tempos),
+    }
+
+class _Lento:
+    # Substituto do banco com latência de rede: cada chamada que iria ao servidor dorme antes de
+    # delegar. Envolve cliente, banco e coleção; cursores e resultados são os originais.
+    REDE = {'find', 'find_one', 'aggregate', 'insert_one', 'insert_many', 'update_one', 'update_many',
+            'delete_one', 'bulk_write', 'count_documents', 'create_index', 'create_indexes'}
+
+    def __init__(self, alvo, latencia):
+        self._alvo = alvo
+        self._latencia = latencia
+
+    def __getitem__(self, nome):
+        return _Lento(self._alvo[nome], self._latencia)
+
+    def __getattr__(self, nome):
+        atributo = getattr(self._alvo, nome)
+        if nome == 'database':
+            return _Lento(atributo, self._latencia)
+        if nome in self.REDE:
+            def chamada(*args, **kwargs):
+                time.sleep(self._latencia)
+                return atributo(*args, **kwargs)
+            return chamada
+        return atributo
+
+class Ambiente:
+    # Configura o app para usar o banco do benchmark: segredos do AppTest e MongoClient substituído
+    def __init__(self, cliente, banco, timeout):
+        self.cliente = cliente
+        self.banco = banco
+        self.timeout = timeout
+
+    def app(self, script=None):
+        from streamlit.testing.v1 import AppTest
+        at = AppTest.from_string(script, default_timeout=self.timeout) if script else AppTest.from_file(APP, default_timeout=self.timeout)
+        at.secrets['mongodb'] = {
+            'MONGODB_USERNAME': 'bench', 'MONGODB_PASSWORD': 'bench',
+            'MONGODB_CLUSTER': 'bench', 'MONGODB_DB_NAME': self.banco,
+        }
+        return at
+
+    def executar(self, at, ambiente=None):
+        with mock.patch('pymongo.MongoClient', lambda *a, **k: self.cliente), mock.patch.dict(os.environ, ambiente or {}):
+            inicio = time.perf_counter()
+            at.run()
+            return time.perf_counter() - inicio
+
+def limpar_caches():
+    import streamlit as st
+    st.cache_resource.clear()
+    st.cache_data.clear()
+
+def medir(ambiente, repeticoes, cenarios):
+    resultados = {}
+    # Reruns de cada view com o cache já carregado: a execução completa (o que toda interação
+    # custava antes dos fragmentos) e, em 'fragmentos', a média de cada fragmento da view. Vêm
+    # antes da partida a frio: cada cache descartado ali deixa threads de sincronização e de
+    # montagem de índices que disputariam o GIL com os reruns medidos.
+    limpar_caches()
+    metricas = {'MIDIA_METRICAS': '1'}
+    at = ambiente.app(SCRIPT_METRICAS)
+    ambiente.executar(at, metricas)
+    for view in VIEWS:
+        at.sidebar.radio[0].set_value(view)
+        ambiente.executar(at, metricas)
+        antes = at.session_state['_latencias']
+        tempos = [ambiente.executar(at, metricas) for _ in range(repeticoes)]
+        resultados[f'view:{view}'] = estatisticas(tempos)
+        fragmentos = {}
+        for nome, h in at.session_state['_latencias'].items():
+            anterior = antes.get(nome, {'contagem': 0, 'soma': 0.0})
+            if nome.startswith('fragmento:') and h['contagem'] > anterior['contagem']:
+                n = h['contagem'] - anterior['contagem']
+                fragmentos[nome.split(':', 1)[1]] = {'execucoes': n, 'media': (h['soma'] - anterior['soma']) / n}
+        resultados[f'view:{view}']['fragmentos'] = fragmentos
+    # Primeira execução com caches vazios: conexão, índices e carga completa do cache compartilhado
+    tempos = []
+    for _ in range(repeticoes):
+        limpar_caches()
+        tempos.append(ambiente.executar(ambiente.app()))
+    resultados['partida_a_frio'] = estatisticas(tempos)
+    for nome in cenarios:
+        preparo, codigo = CENARIOS[nome]
+        at = ambiente.app(script_cenario(preparo, codigo, repeticoes))
+        ambiente.executar(at, AMBIENTE_CENARIOS.get(nome))
+        bench = at.session_state['_bench'] if '_bench' in at.session_state else {'erro': 'cenário não executado'}
+        if at.exception:
+            bench = {'erro': str(at.exception[0].message)}
+        resultados[nome] = dict(estatisticas(bench.pop('tempos')), **bench) if 'tempos' in bench else bench
+        print(f"{nome}: {resultados[nome].get('mediana', resultados[nome].get('erro'))}", file=sys.stderr)
+    return resultados
+
+# ==== Teste de carga (várias sessões simultâneas) ====
+# Cada sessão é um AppTest com seu próprio session_state, como um navegador aberto; as sessões de um
+# processo compartilham os caches do app (st.cache_resource), como no servidor. A cada rerun a
+# sessão vai para a view da ação sorteada e executa a ação pelos helpers do app, como o envio de um
+# formulário. O AppTest troca estado global do Streamlit (Runtime, st.secrets) em cada execução, por
+# isso os reruns de um mesmo processo são serializados; a disputa de verdade pelo banco vem de
+# --processos com um mongod (mongomock só existe dentro de um processo).
+MISTURA_CARGA = {'dashboard': 0.4, 'faturamentos': 0.25, 'adiantamento': 0.2, 'novo_registro': 0.15}
+VIEW_ACAO = {'dashboard': 'Dashboard', 'faturamentos': 'Faturamentos', 'adiantamento': 'Financeiro', 'novo_registro': 'Solicitações'}
+FATURAMENTOS_POR_LOTE = 5
+
+# Ação em session_state['_carga_acao'] = (tipo, alvo, chave). O resultado é (situação, registro,
+# detalhe); no adiantamento, o detalhe é a versão do registro vista no rerun anterior da sessão.
+SCRIPT_CARGA = f'''
+import streamlit as st
+_app = {APP!r}
+exec(compile(open(_app, encoding='utf-8').read(), _app, 'exec'))
+_acao = st.session_state.pop('_carga_acao', None)
+_vistas = st.session_state.setdefault('_carga_vistas', {{}})
+if _acao:
+    _tipo, _alvo, _chave = _acao
+    try:
+        if _tipo == 'novo_registro':
+            _r = ('ok', novo_registro(_chave, SOLICITANTES[0], 1000.0, date.today(), '', UNIDADES[0]), None)
+        elif _tipo == 'adiantamento':
+            _versao = _vistas.get(_alvo)
+            _ok = registrar_adiantamento(_alvo, 1000.0, date.today(), RESPONSAVEL[0], _chave, versao=_versao)
+            _r = ('ok' if _ok else 'erro', _alvo, _versao)
+        elif _tipo == 'faturamentos':
+            _linhas = [{{'numero_fatura': f'{{_chave}}-{{k}}', 'valor': 1.0, 'data_fatura': date.today().isoformat(), 'descricao': 'carga'}}
+                       for k in range({FATURAMENTOS_POR_LOTE})]
+            _res = processar_faturamentos_em_lote(_alvo, _linhas)
+            _r = ('ok' if _res['inseridos'] else ('conflito' if _res['excedeu'] else 'erro'), _alvo, _res['mensagem'])
+        else:
+            resumo_dashboard(versao_dados(), [_alvo], None, ['Em aberto'], None, None, st.session_state['registros'])
+            _r = ('ok', None, None)
+    except (ConflitoVersao, SaldoExcedido) as _e:
+        _r = ('conflito', _alvo, str(_e))
+    except Exception as _e:
+        _r = ('erro', _alvo, f'{{type(_e).__name__}}: {{_e}}')
+    st.session_state['_carga_resultado'] = _r
+# Versões que a sessão "vê" ao fim deste rerun: o próximo adiantamento parte delas
+for _alvo in st.session_state.get('_carga_alvos', ()):
+    _reg = st.session_state['registros'].get(_alvo)
+    if _reg is not None:
+        _vistas[_alvo] = _reg.get('versao') or 0
+'''
+
+def _rss():
+    # Memória residente do processo, em bytes
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except Exception:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def percentis(tempos):
+    if not tempos:
+        return {'execucoes': 0}
+    q = statistics.quantiles(tempos, n=100, method='inclusive') if len(tempos) > 1 else [tempos[0]] * 99
+    return {'execucoes': len(tempos), 'p50': q[49], 'p95': q[94], 'p99': q[98], 'media': statistics.fmean(tempos), 'max': max(tempos)}
+
+class Sessao:
+    def __init__(self, ambiente, nome, alvos, semente):
+        self.ambiente = ambiente
+        self.nome = nome
+        self.alvos = alvos
+        self.rnd = random.Random(semente)
+        self.seq = 0
+        self.at = ambiente.app(SCRIPT_CARGA)
+        self.at.session_state['_carga_alvos'] = alvos['adiantamento']
+
+    def sortear(self):
+        self.seq += 1
+        tipo = self.rnd.choices(list(MISTURA_CARGA), list(MISTURA_CARGA.values()))[0]
+        alvo = None
+        if tipo == 'dashboard':
+            alvo = self.rnd.choice(self.alvos['unidades'])
+        elif tipo != 'novo_registro':
+            alvo = self.rnd.choice(self.alvos[tipo])
+        return (tipo, alvo, f'CARGA-{self.nome}-{self.seq}')
+
+    def executar(self, acao, trava):
+        # Devolve (latência do rerun, resultado da ação); a espera pela trava não entra na latência
+        with trava:
+            self.at.session_state['_carga_resultado'] = None
+            if acao:
+                self.at.session_state['_carga_acao'] = acao
+                self.at.sidebar.radio[0].set_value(VIEW_ACAO[acao[0]])
+            latencia = self.ambiente.executar(self.at)
+            if self.at.exception:
+                return latencia, ('erro', acao and acao[1], str(self.at.exception[0].message))
+            return latencia, self.at.session_state['_carga_resultado'] or ('erro', acao and acao[1], 'ação não executada')
+
+def executar_carga(ambiente, processo, sessoes, duracao, pausa, alvos, semente):
+    trava = threading.Lock()
+    memoria = {'inicial': _rss()}
+    lista = [Sessao(ambiente, f'{processo}.{n}', alvos, semente * 1000 + processo * 100 + n) for n in range(sessoes)]
+    # Primeiro rerun de cada sessão (abertura da página): carga do cache e versões vistas
+    abertura = [s.executar(None, trava)[0] for s in lista]
+    memoria['aquecido'] = _rss()
+    amostras = []
+    confirmadas = []
+    fim = time.monotonic() + duracao
+
+    def laco(sessao):
+        while time.monotonic() < fim:
+            acao = sessao.sortear()
+            latencia, (situacao, registro, detalhe) = sessao.executar(acao, trava)
+            amostras.append((acao[0], latencia, situacao, detalhe if situacao == 'erro' else None))
+            if situacao == 'ok' and acao[0] != 'dashboard':
+                confirmadas.append({'tipo': acao[0], 'registro': registro, 'chave': acao[2], 'versao': detalhe if acao[0] == 'adiantamento' else None})
+            if pausa:
+                # Tempo de "leitura" do usuário entre interações
+                time.sleep(sessao.rnd.uniform(0, 2 * pausa))
+
+    inicio = time.perf_counter()
+    threads = [threading.Thread(target=laco, args=(s,), name=f'sessao-{s.nome}') for s in lista]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    memoria['final'] = _rss()
+    return {
+        'processo': processo,
+        'sessoes': sessoes,
+        'duracao': time.perf_counter() - inicio,
+        'abertura': abertura,
+        'amostras': amostras,
+        'confirmadas': confirmadas,
+        'memoria': memoria,
+    }
+
+def _processo_carga(uri, banco, latencia, timeout, *parametros):
+    # Ponto de entrada dos processos filhos (spawn): conexão própria com o mongod
+    cliente = criar_cliente(uri)
+    if latencia:
+        cliente = _Lento(cliente, latencia)
+    return executar_carga(Ambiente(cliente, banco, timeout), *parametros)
+
+def escolher_alvos(col, quantidade, unidades):
+    # Poucos registros disputados por todas as sessões: é onde aparecem conflitos e perdas.
+    # Adiantamentos e faturamentos usam registros distintos para que a verificação de cada um
+    # não dependa das versões geradas pelo outro.
+    return {
+        'adiantamento': [d['_id'] for d in col.find({'adiantamento': None}, {'_id': 1}).sort('_id', 1).limit(quantidade)],
+        'faturamentos': [d['_id'] for d in col.find({'adiantamento': {'$ne': None}, 'saldo': {'$gt': 0}}, {'_id': 1}).sort('_id', 1).limit(quantidade)],
+        'unidades': list(unidades),
+    }
+
+def verificar_perdas(col, confirmadas):
+    # Gravação perdida: confirmada à sessão e ausente do estado final do banco
+    perdas = {'novo_registro': 0, 'adiantamento': 0, 'faturamentos': 0}
+    por_tipo = {tipo: [c for c in confirmadas if c['tipo'] == tipo] for tipo in perdas}
+    ids = [c['registro'] for c in por_tipo['novo_registro']]
+    existentes = {d['_id'] for d in col.find({'_id': {'$in': ids}}, {'_id': 1})}
+    perdas['novo_registro'] = sum(1 for rid in ids if rid not in existentes)
+    rids = list({c['registro'] for c in por_tipo['faturamentos']})
+    numeros = set()
+    for d in col.find({'_id': {'$in': rids}}, {'faturamentos.numero_fatura': 1}):
+        numeros.update(f.get('numero_fatura') for f in d.get('faturamentos', []))
+    perdas['faturamentos'] = sum(
+        1 for c in por_tipo['faturamentos']
+        if any(f"{c['chave']}-{k}" not in numeros for k in range(FATURAMENTOS_POR_LOTE))
+    )
+    # Adiantamentos: duas gravações confirmadas a partir da mesma versão significam que uma
+    # sobrescreveu a outra sem vê-la; e o valor final tem de ser o da gravação de maior versão
+    por_registro = {}
+    for c in por_tipo['adiantamento']:
+        por_registro.setdefault(c['registro'], []).append(c)
+    finais = {d['_id']: (d.get('adiantamento') or {}).get('observacao') for d in col.find({'_id': {'$in': list(por_registro)}}, {'adiantamento.observacao': 1})}
+    for rid, gravacoes in por_registro.items():
+        versoes = [g['versao'] for g in gravacoes]
+        perdas['adiantamento'] += len(versoes) - len(set(versoes))
+        ultima = max(versoes, key=lambda v: -1 if v is None else v)
+        if finais.get(rid) not in {g['chave'] for g in gravacoes if g['versao'] == ultima}:
+            perdas['adiantamento'] += 1
+    return perdas
+
+def resumir_carga(parciais, perdas, duracao):
+    amostras = [a for p in parciais for a in p['amostras']]
+    por_acao = {}
+    for tipo in MISTURA_CARGA:
+        do_tipo = [a for a in amostras if a[0] == tipo]
+        por_acao[tipo] = dict(
+            percentis([a[1] for a in do_tipo]),
+            ok=sum(1 for a in do_tipo if a[2] == 'ok'),
+            conflitos=sum(1 for a in do_tipo if a[2] == 'conflito'),
+            erros=sum(1 for a in do_tipo if a[2] == 'erro'),
+        )
+    erros = sorted({a[3] for a in amostras if a[3]})
+    mb = 1024 * 1024
+    memoria = {}
+    for p in parciais:
+        m = p['memoria']
+        memoria[str(p['processo'])] = {
+            'sessoes': p['sessoes'],
+            'inicial_mb': m['inicial'] / mb,
+            'aquecido_mb': m['aquecido'] / mb,
+            'final_mb': m['final'] / mb,
+            # Crescimento durante a carga, depois da abertura de todas as sessões
+            'crescimento_mb': (m['final'] - m['aquecido']) / mb,
+            'por_sessao_mb': (m['aquecido'] - m['inicial']) / mb / max(p['sessoes'], 1),
+        }
+    return {
+        'sessoes': sum(p['sessoes'] for p in parciais),
+        'processos': len(parciais),
+        'duracao': duracao,
+        'acoes': len(amostras),
+        'vazao_acoes_s': len(amostras) / duracao if duracao else 0.0,
+        'rerun': percentis([a[1] for a in amostras]),
+        'abertura': percentis([t for p in parciais for t in p['abertura']]),
+        'por_acao': por_acao,
+        'gravacoes_confirmadas': sum(len(p['confirmadas']) for p in parciais),
+        'gravacoes_perdidas': perdas,
+        'erros': erros[:20],
+        'memoria': memoria,
+    }
+
+def medir_carga(cliente, ambiente, args, constantes):
+    col = cliente[args.banco]['registros']
+    alvos = escolher_alvos(col, args.alvos, constantes['UNIDADES'])
+    pausa = args.pausa_ms / 1000
+    inicio = time.perf_counter()
+    if args.processos <= 1:
+        parciais = [executar_carga(ambiente, 0, args.sessoes, args.duracao, pausa, alvos, args.semente)]
+    else:
+        por_processo = [args.sessoes // args.processos + (1 if i < args.sessoes % args.processos else 0) for i in range(args.processos)]
+        contexto = multiprocessing.get_context('spawn')
+        with contexto.Pool(args.processos) as pool:
+            parciais = pool.starmap(_processo_carga, [
+                (args.mongo, args.banco, args.latencia_ms / 1000, args.timeout, i, n, args.duracao, pausa, alvos, args.semente)
+                for i, n in enumerate(por_processo)
+            ])
+    duracao = time.perf_counter() - inicio
+    resumo = resumir_carga(parciais, verificar_perdas(col, [c for p in parciais for c in p['confirmadas']]), duracao)
+    rerun = resumo['rerun']
+    print(f"carga: {resumo['acoes']} ações em {duracao:.1f}s ({resumo['vazao_acoes_s']:.1f}/s), "
+          f"rerun p50 {rerun.get('p50', 0):.3f}s p95 {rerun.get('p95', 0):.3f}s p99 {rerun.get('p99', 0):.3f}s, "
+          f"gravações perdidas {sum(resumo['gravacoes_perdidas'].values())}", file=sys.stderr)
+    return resumo
+
+def _commit_atual():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=DIRETORIO, capture_output=True, text=True).stdout.strip()
+    except Exception:
+        return ''
+
+def criar_cliente(uri):
+    if uri:
+        import pymongo
+        return pymongo.MongoClient(uri)
+    try:
+        import mongomock
+    except ImportError:
+        raise SystemExit("mongomock não instalado. Instale com 'pip install mongomock' ou use --mongo URI.")
+    return mongomock.MongoClient()
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark do Midia Control")
+    parser.add_argument('--registros', type=int, default=1000, help="quantidade de registros sintéticos (1k a 1M)")
+    parser.add_argument('--semente', type=int, default=42)
+    parser.add_argument('--faturamentos', type=float, default=4, help="média de faturamentos por registro com adiantamento")
+    parser.add_argument('--repeticoes', type=int, default=5)
+    parser.add_argument('--mongo', default='', help="URI de um mongod local; sem ela usa mongomock em memória")
+    parser.add_argument('--sqlite', default='', help="arquivo do backend SQLite; mede o app com MIDIA_BACKEND=sqlite em vez do MongoDB")
+    parser.add_argument('--banco', default='Midia_Control_bench')
+    parser.add_argument('--latencia-ms', type=float, default=0.0, help="latência simulada por ida ao banco (ms)")
+    parser.add_argument('--cenarios', default='', help="cenários separados por vírgula (padrão: todos os do backend)")
+    parser.add_argument('--timeout', type=float, default=600.0, help="tempo máximo de cada execução do AppTest (s)")
+    parser.add_argument('--somente-gerar', action='store_true', help="apenas popula o banco, sem medir")
+    parser.add_argument('--carga', action='store_true', help="teste de carga com sessões simultâneas em vez dos cenários")
+    parser.add_argument('--sessoes', type=int, default=30, help="sessões simuladas no teste de carga")
+    parser.add_argument('--processos', type=int, default=1, help="processos do app no teste de carga (exige --mongo se > 1)")
+    parser.add_argument('--duracao', type=float, default=60.0, help="duração do teste de carga (s)")
+    parser.add_argument('--pausa-ms', type=float, default=500.0, help="pausa média de cada sessão entre ações (ms)")
+    parser.add_argument('--alvos', type=int, default=20, help="registros disputados pelas sessões no teste de carga")
+    parser.add_argument('--saida', default='benchmark_resultado.json')
+    args = parser.parse_args()
+
+    # O app usa caminhos relativos (imagens) e lê a configuração do ambiente
+    os.chdir(DIRETORIO)
+    os.environ['MIDIA_BACKEND'] = 'sqlite' if args.sqlite else 'mongodb'
+    if args.sqlite:
+        os.environ['MIDIA_SQLITE_ARQUIVO'] = os.path.abspath(args.sqlite)
+    os.environ.pop('MIDIA_WRITE_BEHIND', None)
+    # Sem snapshot local: a partida a frio mede a carga completa do banco do benchmark
+    os.environ['MIDIA_SNAPSHOT_ARQUIVO'] = ''
+
+    if args.carga and args.processos > 1 and not args.mongo:
+        raise SystemExit("--processos maior que 1 exige --mongo: o mongomock não é compartilhado entre processos.")
+    if args.sqlite and (args.mongo or args.latencia_ms or args.carga):
+        raise SystemExit("--sqlite não se combina com --mongo, --latencia-ms ou --carga.")
+    cenarios = [c for c in args.cenarios.split(',') if c] or [c for c in CENARIOS if not (args.sqlite and c in CENARIOS_SO_MONGO)]
+    desconhecidos = set(cenarios) - set(CENARIOS)
+    if desconhecidos:
+        raise SystemExit(f"Cenários desconhecidos: {', '.join(sorted(desconhecidos))}")
+    if args.sqlite and CENARIOS_SO_MONGO & set(cenarios):
+        raise SystemExit(f"Cenários só do MongoDB: {', '.join(sorted(CENARIOS_SO_MONGO & set(cenarios)))}")
+
+    # Com --sqlite o cliente MongoDB não é usado pelo app, mas o AppTest continua com os segredos
+    cliente = criar_cliente(args.mongo)
+    constantes = ler_constantes()
+    banco = _Lento(cliente, args.latencia_ms / 1000) if args.latencia_ms else cliente
+    ambiente = Ambiente(banco, args.banco, args.timeout)
+    inicio = time.perf_counter()
+    if args.sqlite:
+        total = popular_sqlite(ambiente, args.registros, args.semente, args.faturamentos)
+    else:
+        total = popular(cliente[args.banco]['registros'], gerar_registros(args.registros, constantes, args.semente, faturamentos=args.faturamentos))
+    print(f"{total} registros gerados em {time.perf_counter() - inicio:.1f}s", file=sys.stderr)
+    if args.somente_gerar:
+        return
+
+    if args.carga:
+        resultados = {'carga': medir_carga(cliente, ambiente, args, constantes)}
+    else:
+        resultados = medir(ambiente, args.repeticoes, cenarios)
+
+    import streamlit
+    saida = {
+        'meta': {
+            'data': datetime.now().isoformat(timespec='seconds'),
+            'commit': _commit_atual(),
+            'registros': args.registros,
+            'semente': args.semente,
+            'faturamentos': args.faturamentos,
+            'repeticoes': args.repeticoes,
+            'banco': 'sqlite' if args.sqlite else ('mongod' if args.mongo else 'mongomock'),
+            'latencia_ms': args.latencia_ms,
+            'carga': {'sessoes': args.sessoes, 'processos': args.processos, 'duracao': args.duracao, 'pausa_ms': args.pausa_ms, 'alvos': args.alvos} if args.carga else None,
+            'python': platform.python_version(),
+            'streamlit': streamlit.__version__,
+        },
+        'resultados': resultados,
+    }
+    with open(args.saida, 'w', encoding='utf-8') as f:
+        json.dump(saida, f, ensure_ascii=False, indent=2)
+    print(f"Resultados gravados em {args.saida}", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
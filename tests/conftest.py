@@ -0,0 +1,73 @@
+# Apoio dos testes: o app é um script Streamlit, então roda dentro do AppTest, com o MongoClient
+# substituído por um mongomock em memória e os segredos de conexão preenchidos
+# Dependências: pytest, streamlit e mongomock (python -m pytest tests). O mongomock 4.3 não aceita
+# os bulk_write do pymongo 4.11 em diante: use pymongo>=4.6,<4.11 nos testes.
+import os
+import sys
+from unittest import mock
+
+import pytest
+
+DIRETORIO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP = os.path.join(DIRETORIO, 'Midia_Control.py')
+sys.path.insert(0, DIRETORIO)
+
+import benchmark
+
+mongomock = pytest.importorskip('mongomock')
+pytest.importorskip('streamlit')
+
+BANCO = 'Midia_Control_testes'
+
+class App:
+    def __init__(self, cliente, timeout=60):
+        self.cliente = cliente
+        self.timeout = timeout
+
+    @property
+    def col(self):
+        return self.cliente[BANCO]['registros']
+
+    def criar(self, script=None):
+        from streamlit.testing.v1 import AppTest
+        at = AppTest.from_string(script, default_timeout=self.timeout) if script else AppTest.from_file(APP, default_timeout=self.timeout)
+        at.secrets['mongodb'] = {
+            'MONGODB_USERNAME': 'teste', 'MONGODB_PASSWORD': 'teste',
+            'MONGODB_CLUSTER': 'teste', 'MONGODB_DB_NAME': BANCO,
+        }
+        return at
+
+    def executar(self, at):
+        with mock.patch('pymongo.MongoClient', lambda *a, **k: self.cliente):
+            at.run()
+        assert not at.exception, [e.message for e in at.exception]
+        return at
+
+    def rodar(self, codigo):
+        # Carrega o app e executa 'codigo' no mesmo escopo; o resultado vai em st.session_state['_r']
+        return self.executar(self.criar(script_com_app(codigo)))
+
+def script_com_app(codigo):
+    return f'''
+import streamlit as st
+_app = {APP!r}
+exec(compile(open(_app, encoding='utf-8').read(), _app, 'exec'))
+{codigo}
+'''
+
+def popular(col, n, semente=7):
+    return benchmark.popular(col, benchmark.gerar_registros(n, benchmark.ler_constantes(APP), semente))
+
+@pytest.fixture
+def app(monkeypatch):
+    import streamlit as st
+    monkeypatch.chdir(DIRETORIO)
+    monkeypatch.setenv('MIDIA_BACKEND', 'mongodb')
+    monkeypatch.setenv('MIDIA_SNAPSHOT_ARQUIVO', '')
+    monkeypatch.delenv('MIDIA_WRITE_BEHIND', raising=False)
+    # Caches de processo (conexão, cópia compartilhada dos registros) não passam de um teste a outro
+    st.cache_resource.clear()
+    st.cache_data.clear()
+    yield App(mongomock.MongoClient())
+    st.cache_resource.clear()
+    st.cache_data.clear()
@@ -0,0 +1,165 @@
+# Conformidade dos backends: cada método da interface roda contra o MongoDB (mongomock) e contra
+# um arquivo SQLite temporário, com o mesmo resultado esperado
+import pytest
+
+@pytest.fixture(params=['mongodb', 'sqlite'])
+def backend(request, app, monkeypatch, tmp_path):
+    monkeypatch.setenv('MIDIA_BACKEND', request.param)
+    monkeypatch.setenv('MIDIA_SQLITE_ARQUIVO', str(tmp_path / 'midia_control.db'))
+    return app
+
+APOIO = '''
+def doc_teste(rid, unidade=UNIDADES[0], adiantado=100.0, valores=()):
+    doc = {
+        '_id': rid,
+        'solicitacao': {'descricao': f'Teste {rid}', 'solicitante': SOLICITANTES[0], 'valor_estimado': adiantado,
+                        'data_solicitacao': '2024-05-01', 'observacoes': '', 'unidade': unidade},
+        'adiantamento': {'valor': adiantado, 'data_adiantamento': '2024-05-01', 'responsavel': '',
+                         'observacao': '', 'unidade': unidade} if adiantado else None,
+        'faturamentos': [fatura_teste(f'{rid}-{i}', v) for i, v in enumerate(valores)],
+        'created_at': datetime.utcnow(), 'updated_at': datetime.utcnow(), 'versao': 1,
+    }
+    return _recalcular_totais(doc)
+
+def fatura_teste(fid, valor):
+    return {'id': fid, 'numero_fatura': fid, 'valor': float(valor), 'data_fatura': '2024-05-02', 'descricao': '', 'unidade': ''}
+
+def lido(b, rid):
+    return next((d for d in b.carregar() if d['_id'] == rid), None)
+
+b = get_backend()
+'''
+
+def rodar(app, codigo):
+    return app.rodar(APOIO + codigo).session_state['_r']
+
+def test_inserir_e_carregar(backend):
+    r = rodar(backend, '''
+b.inserir(doc_teste('A1', valores=[30]))
+b.inserir(doc_teste('A2', adiantado=0))
+d = lido(b, 'A1')
+st.session_state['_r'] = [b.nome, sorted(x['_id'] for x in b.carregar()), d['solicitacao']['descricao'], d['total_faturado'], d['saldo'], d['status'], d['versao']]
+''')
+    assert r[1:] == [['A1', 'A2'], 'Teste A1', 30.0, 70.0, 'Em aberto', 1]
+
+def test_alterados_desde(backend):
+    r = rodar(backend, '''
+b.inserir(doc_teste('A1'))
+b.inserir(doc_teste('A2'))
+corte = datetime.utcnow()
+time.sleep(0.01)
+b.definir_solicitacao('A2', dict(lido(b, 'A2')['solicitacao'], descricao='Alterada'))
+b.excluir('A1')
+docs, excluidos = b.alterados_desde(corte)
+todos, _ = b.alterados_desde(None)
+st.session_state['_r'] = [[d['_id'] for d in docs], [e['_id'] for e in excluidos], isinstance(excluidos[0]['deleted_at'], datetime), [d['_id'] for d in todos]]
+''')
+    assert r == [['A2'], ['A1'], True, ['A2']]
+
+def test_solicitacao_e_adiantamento_com_versao(backend):
+    r = rodar(backend, '''
+b.inserir(doc_teste('A1', adiantado=0))
+b.definir_solicitacao('A1', dict(lido(b, 'A1')['solicitacao'], descricao='Nova'), versao=1)
+b.definir_adiantamento('A1', {'valor': 50.0, 'data_adiantamento': '2024-05-03', 'responsavel': '', 'observacao': '', 'unidade': UNIDADES[0]}, versao=2)
+try:
+    b.definir_solicitacao('A1', lido(b, 'A1')['solicitacao'], versao=1)
+    conflito = False
+except ConflitoVersao:
+    conflito = True
+d = lido(b, 'A1')
+st.session_state['_r'] = [d['solicitacao']['descricao'], d['adiantamento']['valor'], d['saldo'], d['status'], d['versao'], conflito]
+''')
+    assert r == ['Nova', 50.0, 50.0, 'Em aberto', 3, True]
+
+def test_faturamentos(backend):
+    r = rodar(backend, '''
+b.inserir(doc_teste('A1', valores=[10]))
+b.incluir_faturamentos('A1', [fatura_teste('F1', 20), fatura_teste('F2', 30)])
+b.remover_faturamento('A1', 'A1-0')
+try:
+    b.incluir_faturamentos('A1', [fatura_teste('F3', 60)], limitar_saldo=True)
+    recusado = False
+except SaldoExcedido:
+    recusado = True
+d = lido(b, 'A1')
+st.session_state['_r'] = [[(f['id'], f['valor'], f['descricao']) for f in d['faturamentos']], d['total_faturado'], d['saldo'], d['versao'], recusado]
+''')
+    assert r == [[('F1', 20.0, ''), ('F2', 30.0, '')], 50.0, 50.0, 3, True]
+
+def test_editar_faturamento(backend, request):
+    if request.node.callspec.params['backend'] == 'mongodb':
+        pytest.skip('mongomock 4.3 não implementa $mergeObjects')
+    r = rodar(backend, '''
+b.inserir(doc_teste('A1', valores=[10, 20]))
+b.editar_faturamento('A1', 'A1-1', {'valor': 25.0, 'descricao': 'Editada'})
+d = lido(b, 'A1')
+st.session_state['_r'] = [[(f['id'], f['valor'], f['descricao']) for f in d['faturamentos']], d['total_faturado'], d['saldo'], d['versao']]
+''')
+    assert r == [[('A1-0', 10.0, ''), ('A1-1', 25.0, 'Editada')], 35.0, 65.0, 2]
+
+def test_incluir_faturamentos_em_lote(backend):
+    r = rodar(backend, '''
+for rid in ('A1', 'A2', 'A3'):
+    b.inserir(doc_teste(rid))
+falhas = b.incluir_faturamentos_em_lote({
+    'A1': [fatura_teste('F1', 40), fatura_teste('F2', 40)],
+    'A2': [fatura_teste('F3', 150)],
+    'A3': [fatura_teste('F4', 100)],
+}, limitar_saldo=True)
+st.session_state['_r'] = [sorted(falhas), [lido(b, rid)['total_faturado'] for rid in ('A1', 'A2', 'A3')], lido(b, 'A3')['status']]
+''')
+    assert r == [['A2'], [80.0, 0.0, 100.0], 'Encerrado']
+
+def test_arquivar_listar_e_restaurar(backend):
+    r = rodar(backend, '''
+b.inserir(doc_teste('A1', valores=[100]))
+b.inserir(doc_teste('A2', valores=[10]))
+b.inserir(doc_teste('A3', unidade=UNIDADES[1], valores=[60, 40]))
+arquivados = sorted(b.arquivar(['A1', 'A2', 'A3']))
+pagina = b.listar_arquivados(None, 1)
+seguinte = b.listar_arquivados(pagina[0]['_id'], 1)
+totais = b.totais_arquivados()
+so_unidade = b.totais_arquivados(unidades=[UNIDADES[1]])
+arquivado = b.ler_arquivado('A3')
+restaurado = b.restaurar('A3')
+docs, excluidos = b.alterados_desde(None)
+st.session_state['_r'] = [
+    arquivados, [d['_id'] for d in pagina], [d['_id'] for d in seguinte], pagina[0]['faturamentos'], isinstance(pagina[0]['arquivado_em'], datetime),
+    totais, so_unidade, [f['id'] for f in arquivado['faturamentos']], restaurado['_id'], sorted(d['_id'] for d in docs),
+    b.ler_arquivado('A3'), b.restaurar('A9'), sorted(e['_id'] for e in excluidos),
+]
+''')
+    assert r == [
+        ['A1', 'A3'], ['A1', 'A3'], ['A3'], 1, True,
+        {'registros': 2, 'adiantado': 200.0, 'faturado': 200.0}, {'registros': 1, 'adiantado': 100.0, 'faturado': 100.0},
+        ['A3-0', 'A3-1'], 'A3', ['A2', 'A3'], None, None, ['A1', 'A3'],
+    ]
+
+def test_agregar_dashboard(backend):
+    r = rodar(backend, '''
+b.inserir(doc_teste('A1', valores=[100]))
+b.inserir(doc_teste('A2', valores=[10]))
+b.inserir(doc_teste('A3', unidade=UNIDADES[1], adiantado=0))
+tudo, linhas = b.agregar_dashboard()
+encerrados, linhas_encerradas = b.agregar_dashboard(status=['Encerrado'])
+periodo, _ = b.agregar_dashboard(unidades=[UNIDADES[0]], ini=date(2024, 5, 1), fim=date(2024, 5, 31))
+fora, _ = b.agregar_dashboard(ini=date(2023, 1, 1), fim=date(2023, 1, 31))
+st.session_state['_r'] = [
+    {k: float(v) for k, v in tudo.items()}, sorted(l['Registro'] for l in linhas), sorted(linhas[0]),
+    int(encerrados['registros']), [l['Registro'] for l in linhas_encerradas], int(periodo['registros']), int(fora['registros']),
+]
+''')
+    assert r == [
+        {'registros': 3.0, 'adiantado': 200.0, 'faturado': 110.0}, ['A1', 'A2', 'A3'],
+        sorted(['Registro', 'Solicitante', 'Descrição', 'Unidade', 'Valor adiantado', 'Total faturado', 'Saldo', 'Status']),
+        1, ['A1'], 2, 0,
+    ]
+
+def test_excluir(backend):
+    r = rodar(backend, '''
+b.inserir(doc_teste('A1'))
+b.excluir('A1')
+b.excluir('A1')
+st.session_state['_r'] = [lido(b, 'A1'), [e['_id'] for e in b.alterados_desde(None)[1]]]
+''')
+    assert r == [None, ['A1']]
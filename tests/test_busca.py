@@ -0,0 +1,114 @@
+from conftest import popular
+
+# Dois registros criados pelos helpers do app; o índice é o do cache compartilhado, o mesmo que os
+# seletores consultam
+CRIAR = '''
+_busca = lambda consulta: [rid for rid, _ in indice_busca().buscar(consulta) if rid in (_a, _b)]
+_a = novo_registro('Promoção de Verão', SOLICITANTES[0], 100.0, date(2024, 1, 1), 'Rádio e outdoor', UNIDADES[0])
+_b = novo_registro('Matrículas Inverno', SOLICITANTES[0], 100.0, date(2024, 1, 1), '', UNIDADES[0])
+registrar_adiantamento(_a, 500.0, date(2024, 1, 2), RESPONSAVEL[0], '')
+adicionar_faturamento(_a, 'NF-2024/001', 100.0, date(2024, 1, 3), 'Impulsionamento')
+'''
+
+def _rodar(app, codigo):
+    popular(app.col, 30)
+    return app.rodar(CRIAR + codigo).session_state['_r']
+
+def test_busca_sem_acentos_e_sem_maiusculas(app):
+    r = _rodar(app, '''
+st.session_state['_r'] = [_a, _b] + [_busca(c) for c in ['promocao verao', 'PROMOÇÃO', 'matriculas', 'rádio', 'radio', 'nf2024001', 'nf 2024 001']]
+''')
+    a, b = r[:2]
+    assert r[2:] == [[a], [a], [b], [a], [a], [a], [a]]
+
+def test_prefixo_e_busca_aproximada(app):
+    r = _rodar(app, '''
+st.session_state['_r'] = [_a, _b] + [_busca(c) for c in ['promo', 'matric inv', 'promocap', 'matriclas', 'xyzw']]
+''')
+    a, b = r[:2]
+    assert r[2:] == [[a], [b], [a], [b], []]
+
+def test_consultas_com_menos_de_tres_caracteres(app):
+    # Termo curto só vale como prefixo quando é o último (ainda sendo digitado)
+    r = _rodar(app, '''
+_ids = lambda consulta: {rid for rid, _ in indice_busca().buscar(consulta)}
+st.session_state['_r'] = [_a, _b, _busca('p'), _busca('pr'), _busca('verao pr'), _busca('pr verao'), _busca('in matriculas'),
+                          _busca(''), _busca('   '), _busca('!?'), _a in _ids('p'), _ids('de') == _ids('de')]
+''')
+    a, b = r[:2]
+    assert r[2:10] == [[a], [a], [a], [], [], [], [], []]
+    assert r[10] and r[11]
+
+def test_edicao_e_exclusao_nao_deixam_entradas_antigas(app, monkeypatch, tmp_path):
+    # No SQLite: o mongomock não executa o $mergeObjects da edição de faturamento
+    monkeypatch.setenv('MIDIA_BACKEND', 'sqlite')
+    monkeypatch.setenv('MIDIA_SQLITE_ARQUIVO', str(tmp_path / 'midia.db'))
+    r = app.rodar(CRIAR + '''
+_r = [_a, _b]
+_fat = st.session_state['registros'][_a]['faturamentos'][0]['id']
+atualizar_registro(_a, 'Campanha Outono', SOLICITANTES[0], 100.0, date(2024, 1, 1), '', UNIDADES[0])
+_r += [_busca('verao'), _busca('radio'), _busca('outono')]
+editar_faturamento(_a, _fat, 'NF-9999/777', 100.0, date(2024, 1, 3), 'Impulsionamento')
+_r += [_busca('nf2024001'), _busca('nf9999777')]
+excluir_faturamento(_a, _fat)
+_r += [_busca('nf9999777'), _busca('impulsionamento')]
+excluir_registro(_b)
+_r += [_busca('matriculas inverno'), _busca('inverno')]
+_indice = indice_busca()
+_r += [_a in _indice.por_registro, _b in _indice.por_registro, 'verao' in _indice.por_token, 'inverno' in _indice.por_token,
+       any('verao' in tokens for tokens in _indice.por_trigrama.values())]
+st.session_state['_r'] = _r
+''').session_state['_r']
+    a, b = r[:2]
+    assert r[2:5] == [[], [], [a]]
+    assert r[5:7] == [[], [a]]
+    assert r[7:9] == [[], []]
+    assert r[9:11] == [[], []]
+    assert r[11:] == [True, False, False, False, False]
+
+def test_busca_nos_seletores(app):
+    r = _rodar(app, '''
+_docs, _proximo = buscar_pagina_registros('todos', None, 10, 'verao')
+_sem, _ = buscar_pagina_registros('sem_adiantamento', None, 10, 'verao')
+st.session_state['_r'] = [_a, [d['_id'] for d in _docs], _proximo, [d['_id'] for d in _sem]]
+''')
+    assert r[1:] == [[r[0]], None, []]
+
+def test_limite_devolve_o_inicio_da_ordem_completa(app):
+    popular(app.col, 200)
+    at = app.rodar('''
+_indice = indice_busca()
+_regs = st.session_state['registros']
+_aceitar = lambda rid: bool(_regs[rid]['adiantamento'])
+_r = []
+for _c in ['campanha', 'matriculas', 'vestib', 'nf 1']:
+    _todos = _indice.buscar(_c)
+    _r.append(len(_todos) > 20 and _indice.buscar(_c, 20) == _todos[:20]
+              and _indice.buscar(_c, 20, _aceitar) == [item for item in _todos if _aceitar(item[0])][:20])
+st.session_state['_r'] = _r
+''')
+    assert at.session_state['_r'] == [True] * 4
+
+def test_busca_aproximada(app):
+    popular(app.col, 200)
+    at = app.rodar('''
+_indice = indice_busca()
+def _todos(termo):
+    trigramas = _trigramas(f'  {termo} ')
+    variantes = {}
+    for token in _indice.por_token:
+        similaridade = 2 * len(trigramas & _trigramas(f'  {token} ')) / (len(trigramas) + len(token) + 1)
+        if similaridade >= SIMILARIDADE_MINIMA:
+            variantes[token] = similaridade * 0.6
+    return variantes
+_r = []
+for _termo in ['vestibulr', 'matriculsa', 'institucinal', 'impulsionamneto', 'campnha', 'xyzwq']:
+    _r.append([_termo, bool(_todos(_termo)), _indice._variantes(_termo, False) == _todos(_termo)])
+# Códigos não têm busca aproximada: só exata ou por prefixo
+for _termo in ['nf1999', 'nf19x1', '00000a1b']:
+    _r.append([_termo, True, _indice._variantes(_termo, False) == {}])
+st.session_state['_r'] = _r
+''')
+    r = at.session_state['_r']
+    assert all(igual for _, _, igual in r), r
+    assert [termo for termo, encontrou, _ in r if not encontrou] == ['xyzwq']
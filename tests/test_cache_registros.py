@@ -0,0 +1,171 @@
+from datetime import datetime
+
+from conftest import popular
+
+def test_sincronizar_sem_alteracoes_mantem_versao(app):
+    popular(app.col, 50)
+    at = app.rodar('''
+cache = get_cache_registros()
+versao, registros = cache.versao, cache.registros
+st.session_state['_r'] = [cache.modo, cache.sincronizar(forcar=True), cache.sincronizar(forcar=True), cache.versao - versao, cache.registros is registros]
+''')
+    assert at.session_state['_r'] == ['incremental', 0, 0, 0, True]
+
+def test_sincronizar_aplica_so_o_que_mudou(app):
+    popular(app.col, 50)
+    at = app.rodar('''
+cache = get_cache_registros()
+st.session_state['_antes'] = cache.versao
+''')
+    app.col.update_one({'_id': '00000001'}, {'$set': {'solicitacao.descricao': 'Alterada fora do app', 'updated_at': datetime.utcnow()}})
+    app.col.delete_one({'_id': '00000002'})
+    app.col.database['registros_excluidos'].insert_one({'_id': '00000002', 'deleted_at': datetime.utcnow()})
+    at = app.rodar('''
+cache = get_cache_registros()
+versao = cache.versao
+aplicados = cache.sincronizar(forcar=True)
+st.session_state['_r'] = [
+    aplicados, cache.versao - versao, cache.registros['00000001']['solicitacao']['descricao'],
+    '00000002' in cache.registros, cache.sincronizar(forcar=True), cache.versao - versao,
+]
+''')
+    assert at.session_state['_r'] == [2, 1, 'Alterada fora do app', False, 0, 1]
+
+def test_carga_inicial_compartilhada_entre_sessoes(app):
+    popular(app.col, 120)
+    codigo = '''
+st.session_state['_r'] = [len(st.session_state['registros']), st.session_state['db_loaded'], get_cache_registros().modo, id(get_cache_registros())]
+'''
+    primeira = app.rodar(codigo).session_state['_r']
+    segunda = app.rodar(codigo).session_state['_r']
+    # Sem replica set (mongomock não tem change streams), a sincronização cai para o modo incremental
+    assert primeira[:3] == [120, True, 'incremental']
+    assert segunda == primeira
+
+def test_insercao_e_exclusao_publicadas_no_cache_e_no_banco(app):
+    popular(app.col, 10)
+    at = app.rodar('''
+versao = get_cache_registros().versao
+rid = novo_registro('Teste publicação', SOLICITANTES[0], 100.0, date(2024, 5, 1), '', UNIDADES[0])
+st.session_state['_r'] = [rid, rid in get_cache_registros().registros, get_cache_registros().versao > versao]
+''')
+    rid, no_cache, versao_avancou = at.session_state['_r']
+    assert no_cache and versao_avancou
+    assert app.col.find_one({'_id': rid})['solicitacao']['descricao'] == 'Teste publicação'
+    # Outra sessão enxerga o registro pela cópia compartilhada e o exclui
+    at = app.rodar(f'''
+visto = {rid!r} in st.session_state['registros']
+excluir_registro({rid!r})
+st.session_state['_r'] = [visto, {rid!r} in get_cache_registros().registros]
+''')
+    assert at.session_state['_r'] == [True, False]
+    assert app.col.find_one({'_id': rid}) is None
+    assert app.col.database['registros_excluidos'].find_one({'_id': rid}) is not None
+
+def test_change_stream_aplica_insercoes_e_exclusoes(app):
+    popular(app.col, 10)
+    novo = dict(app.col.find_one({'_id': '00000003'}), _id='NOVO0001', updated_at=datetime.utcnow())
+    app.col.insert_one(novo)
+    app.col.delete_one({'_id': '00000004'})
+    at = app.rodar('''
+import threading, time
+
+class Stream:
+    # Entrega os eventos e depois fica aberto, como um change stream sem novidades
+    def __init__(self, eventos):
+        self.eventos = eventos
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        return False
+    def __iter__(self):
+        yield from self.eventos
+        threading.Event().wait()
+
+class BackendComStream(BackendMongo):
+    def __init__(self, col, eventos):
+        super().__init__(col)
+        self.eventos = [eventos]
+    def assistir(self):
+        return Stream(self.eventos.pop() if self.eventos else [])
+
+novo = get_collection().find_one({'_id': 'NOVO0001'})
+cache = CacheRegistros(BackendComStream(get_collection(), [
+    {'operationType': 'insert', 'fullDocument': novo},
+    {'operationType': 'delete', 'documentKey': {'_id': '00000004'}},
+]))
+limite = time.monotonic() + 5
+while time.monotonic() < limite and ('NOVO0001' not in cache.registros or '00000004' in cache.registros):
+    time.sleep(0.01)
+st.session_state['_r'] = [cache.modo, 'NOVO0001' in cache.registros, '00000004' in cache.registros]
+''')
+    assert at.session_state['_r'] == ['change_stream', True, False]
+
+def test_falha_na_gravacao_nao_altera_o_registro_publicado(app):
+    popular(app.col, 20)
+    at = app.rodar('''
+def _falhar(*args, **kwargs):
+    raise RuntimeError('banco fora do ar')
+
+backend = get_backend()
+for metodo in ('incluir_faturamentos', 'editar_faturamento', 'remover_faturamento', 'definir_adiantamento', 'excluir'):
+    setattr(backend, metodo, _falhar)
+cache = get_cache_registros()
+rid = next(r for r, reg in cache.registros.items() if reg['adiantamento'] and reg['faturamentos'])
+reg = cache.registros[rid]
+fat_id = reg['faturamentos'][0]['id']
+antes = (reg.para_dict(), cache.versao, cache.rollup.por_registro.get(rid))
+resultados = [
+    adicionar_faturamento(rid, 'NF-FALHA', 10.0, date(2024, 5, 1), 'Falha'),
+    editar_faturamento(rid, fat_id, 'NF-FALHA', 10.0, date(2024, 5, 1), 'Falha'),
+    excluir_faturamento(rid, fat_id),
+    excluir_adiantamento(rid),
+    excluir_registro(rid),
+]
+depois = (cache.registros[rid].para_dict(), cache.versao, cache.rollup.por_registro.get(rid))
+st.session_state['_r'] = [resultados, cache.registros[rid] is reg, depois == antes, sorted(faturas_duplicadas('NF-FALHA'))]
+''')
+    assert at.session_state['_r'] == [[False, False, False, False, False], True, True, []]
+    assert len(at.error) == 5
+
+def test_alteracao_publica_copia_sem_mexer_no_registro_anterior(app):
+    popular(app.col, 20)
+    at = app.rodar('''
+cache = get_cache_registros()
+rid = next(r for r, reg in cache.registros.items() if reg['adiantamento'])
+anterior = cache.registros[rid]
+antes = anterior.para_dict()
+ok = adicionar_faturamento(rid, 'NF-COPIA', 10.0, date(2024, 5, 1), 'Cópia')
+atual = cache.registros[rid]
+st.session_state['_r'] = [ok, atual is anterior, anterior.para_dict() == antes, len(atual['faturamentos']) - len(anterior['faturamentos']), atual['versao'] - anterior['versao']]
+''')
+    assert at.session_state['_r'] == [True, False, True, 1, 1]
+
+def test_cache_refeito_encerra_tarefas_do_anterior(app, monkeypatch, tmp_path):
+    # Cada limpeza do st.cache_resource refaz o cache; as threads e a gravação do snapshot na saída
+    # (atexit) do anterior não podem se acumular
+    monkeypatch.setenv('MIDIA_SNAPSHOT_ARQUIVO', str(tmp_path / 'snapshot.json'))
+    popular(app.col, 20)
+    at = app.rodar('''
+import atexit, time
+
+def _tarefas(dono):
+    return [t for t in threading.enumerate() if getattr(t, 'tarefa_midia', (None, None))[1] is dono and t.is_alive()]
+
+_caches = [get_cache_registros()]
+_saidas = [_caches[0].gravar_snapshot]
+_registrar, _desfazer = atexit.register, atexit.unregister
+atexit.register, atexit.unregister = _saidas.append, _saidas.remove
+try:
+    for _ in range(3):
+        st.cache_resource.clear()
+        _caches.append(get_cache_registros())
+finally:
+    atexit.register, atexit.unregister = _registrar, _desfazer
+limite = time.monotonic() + 5
+while time.monotonic() < limite and any(_tarefas(c) for c in _caches[:-1]):
+    time.sleep(0.01)
+st.session_state['_r'] = [[len(_tarefas(c)) > 0 for c in _caches], [c.parar.is_set() for c in _caches],
+                          [s.__self__ is _caches[-1] for s in _saidas]]
+''')
+    assert at.session_state['_r'] == [[False, False, False, True], [True, True, True, False], [True]]
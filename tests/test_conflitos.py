@@ -0,0 +1,106 @@
+from datetime import datetime
+
+from conftest import popular
+
+def _clicar(app, at, rotulo):
+    next(b for b in at.button if b.label == rotulo).click()
+    return app.executar(at)
+
+def _campo(at, rotulo):
+    return next(t for t in list(at.text_input) + list(at.text_area) if t.label == rotulo)
+
+def _sessao(app, view):
+    at = app.criar()
+    at.session_state['view'] = view
+    return app.executar(at)
+
+def test_conflito_de_versao_entre_duas_sessoes(app):
+    popular(app.col, 20)
+    a = _sessao(app, 'Solicitações')
+    b = _sessao(app, 'Solicitações')
+    rid = a.selectbox(key='sel_editar_registro').value
+    assert b.selectbox(key='sel_editar_registro').value == rid
+    versao = app.col.find_one({'_id': rid}).get('versao') or 0
+
+    # B grava primeiro, sobre a versão que as duas sessões têm na tela
+    _campo(b, 'Observações').input('Observação de B')
+    _clicar(app, b, 'Salvar alterações')
+    assert [s.value for s in b.success] == ['Registro atualizado']
+    assert app.col.find_one({'_id': rid})['solicitacao']['observacoes'] == 'Observação de B'
+
+    # A grava sobre a versão antiga: a gravação é recusada e o conflito aparece para decisão
+    _campo(a, 'Descrição da campanha').input('Alteração de A')
+    _clicar(app, a, 'Salvar alterações')
+    assert not a.success
+    assert any('alterado por outro usuário' in w.value for w in a.warning)
+    assert a.session_state['_conflito']['registro'] == rid
+    assert a.session_state['_conflito']['dados']['descricao'] == 'Alteração de A'
+    assert app.col.find_one({'_id': rid})['solicitacao']['descricao'] != 'Alteração de A'
+
+    # Reaplicada sobre a versão atual, a alteração de A é gravada
+    _clicar(app, a, 'Aplicar minha alteração sobre a versão atual')
+    doc = app.col.find_one({'_id': rid})
+    assert doc['solicitacao']['descricao'] == 'Alteração de A'
+    assert doc['solicitacao']['observacoes'] == 'Observação de B'
+    assert doc['versao'] == versao + 2
+    assert '_conflito' not in a.session_state
+    assert a.session_state[f'_versao_vista_{rid}'] == versao + 2
+
+def test_descartar_conflito_mantem_a_versao_do_outro_usuario(app):
+    popular(app.col, 20)
+    a = _sessao(app, 'Solicitações')
+    b = _sessao(app, 'Solicitações')
+    rid = a.selectbox(key='sel_editar_registro').value
+    descricao = app.col.find_one({'_id': rid})['solicitacao']['descricao']
+    _campo(b, 'Observações').input('Observação de B')
+    _clicar(app, b, 'Salvar alterações')
+    _campo(a, 'Descrição da campanha').input('Alteração de A')
+    _clicar(app, a, 'Salvar alterações')
+    _clicar(app, a, 'Descartar minha alteração')
+    assert '_conflito' not in a.session_state
+    assert not a.warning
+    assert app.col.find_one({'_id': rid})['solicitacao']['descricao'] == descricao
+    assert a.session_state['registros'][rid]['solicitacao']['observacoes'] == 'Observação de B'
+
+def _lancar(app, at, numero, valor):
+    _campo(at, 'Número da fatura/nota').input(numero)
+    next(n for n in at.number_input if n.label == 'Valor faturado (R$)').set_value(valor)
+    return _clicar(app, at, 'Lançar')
+
+def test_saldo_consumido_por_outra_sessao(app):
+    popular(app.col, 20)
+    a = _sessao(app, 'Faturamentos')
+    b = _sessao(app, 'Faturamentos')
+    rid = a.selectbox(key='sel_fat_registro').value
+    doc = app.col.find_one({'_id': rid})
+    saldo = doc['adiantamento']['valor'] - sum(f['valor'] for f in doc['faturamentos'])
+    assert saldo > 1
+
+    # B consome todo o saldo; A, com o mesmo saldo na tela, não pode mais lançar
+    _lancar(app, b, 'NF-B', saldo)
+    assert [s.value for s in b.success] == ['Faturamento lançado']
+    _lancar(app, a, 'NF-A', 1.0)
+    assert any('excede o saldo' in e.value for e in a.error)
+    numeros = [f['numero_fatura'] for f in app.col.find_one({'_id': rid})['faturamentos']]
+    assert 'NF-B' in numeros and 'NF-A' not in numeros
+
+def test_saldo_consumido_por_outra_instancia_e_recusado_no_servidor(app, monkeypatch):
+    # Sem sincronização no rerun, a cópia local continua com o saldo antigo e só o servidor recusa
+    monkeypatch.setenv('MIDIA_SYNC_MIN_INTERVALO', '3600')
+    popular(app.col, 20)
+    a = _sessao(app, 'Faturamentos')
+    rid = a.selectbox(key='sel_fat_registro').value
+    doc = app.col.find_one({'_id': rid})
+    saldo = doc['adiantamento']['valor'] - sum(f['valor'] for f in doc['faturamentos'])
+    # Outra instância do app consome o saldo direto no banco; a cópia local ainda não sabe disso
+    app.col.update_one({'_id': rid}, {
+        '$push': {'faturamentos': {'id': 'OUTRA001', 'numero_fatura': 'NF-OUTRA', 'valor': saldo, 'data_fatura': '2024-05-01', 'descricao': '', 'unidade': ''}},
+        '$set': {'total_faturado': doc['adiantamento']['valor'], 'saldo': 0.0, 'status': 'Encerrado', 'updated_at': datetime.utcnow()},
+        '$inc': {'versao': 1},
+    })
+    _lancar(app, a, 'NF-A', 1.0)
+    assert [e.value for e in a.error] == ['O faturamento (R$ 1.00) excede o saldo atual do registro (R$ 0.00).']
+    numeros = [f['numero_fatura'] for f in app.col.find_one({'_id': rid})['faturamentos']]
+    assert 'NF-OUTRA' in numeros and 'NF-A' not in numeros
+    # Depois da recusa, a cópia local traz o faturamento gravado pela outra instância
+    assert a.session_state['registros'][rid]['faturamentos'].por_id('OUTRA001') is not None
@@ -0,0 +1,66 @@
+import pytest
+
+from conftest import popular
+
+def test_dashboard_renderiza_com_registros(app):
+    popular(app.col, 200)
+    at = app.executar(app.criar())
+    cartoes = {m.label: m.value for m in at.metric}
+    assert cartoes['Registros'] == '200'
+    # Rerun com os mesmos dados: as tabelas memoizadas são reaproveitadas
+    app.executar(at)
+    assert {m.label: m.value for m in at.metric} == cartoes
+
+def test_dashboard_filtro_por_unidade(app):
+    popular(app.col, 200)
+    at = app.executar(app.criar())
+    unidades = next(m for m in at.multiselect if m.label == 'Unidades')
+    unidade = unidades.options[0]
+    unidades.set_value([unidade])
+    app.executar(at)
+    esperado = app.col.count_documents({'solicitacao.unidade': unidade})
+    assert {m.label: m.value for m in at.metric}['Registros'] == str(esperado)
+
+def test_cartoes_com_registros_arquivados(app):
+    popular(app.col, 200)
+    at = app.executar(app.criar())
+    arquivados = app.rodar("st.session_state['_r'] = len(arquivar_encerrados(0))").session_state['_r']
+    assert arquivados
+    app.executar(at)
+    assert {m.label: m.value for m in at.metric}['Registros'] == str(200 - arquivados)
+    # A opção fica no fragmento dos cartões e soma os totais do arquivo
+    at.checkbox(key='f_arquivo').check()
+    app.executar(at)
+    assert {m.label: m.value for m in at.metric}['Registros'] == '200'
+    assert at.subheader[-1].value == 'Resumo por registro'
+
+@pytest.mark.parametrize('concorrencia', ['1', '4'])
+def test_agregacao_no_servidor_igual_ao_calculo_em_memoria(app, monkeypatch, concorrencia):
+    monkeypatch.setenv('MIDIA_CONCORRENCIA', concorrencia)
+    popular(app.col, 300)
+    at = app.rodar('''
+_unidades = [UNIDADES[0], UNIDADES[1]]
+_servidor = agregar_dashboard(_unidades, None, ['Em aberto', 'Encerrado'])
+_memoria = resumo_dashboard(versao_dados(), _unidades, None, ['Em aberto', 'Encerrado'], None, None, st.session_state['registros'])
+st.session_state['_r'] = [_servidor[0], len(_servidor[1]), _memoria[0], len(_memoria[1]),
+                          sorted(l['Registro'] for l in _servidor[1]) == sorted(_memoria[1]['Registro'] if hasattr(_memoria[1], 'columns') else [l['Registro'] for l in _memoria[1]])]
+''')
+    servidor, n_servidor, memoria, n_memoria, mesmas = at.session_state['_r']
+    assert servidor['registros'] == memoria['registros'] == n_servidor == n_memoria
+    assert abs(servidor['adiantado'] - memoria['adiantado']) < 0.01
+    assert abs(servidor['faturado'] - memoria['faturado']) < 0.01
+    assert mesmas
+
+@pytest.mark.parametrize('ativas', [False, True])
+def test_acertos_do_cache_de_tabelas_so_com_metricas(app, monkeypatch, ativas):
+    if ativas:
+        monkeypatch.setenv('MIDIA_METRICAS', '1')
+    popular(app.col, 20)
+    at = app.rodar('''
+opcoes_filtros.clear()
+_metricas = get_metricas()
+_antes = (_metricas.valor('tabelas_cache_total', 'acerto'), _metricas.valor('tabelas_cache_total', 'falta'))
+_r = [opcoes_filtros(versao_dados(), st.session_state['registros']) for _ in range(3)]
+st.session_state['_r'] = [_r[0] == _r[2], _metricas.valor('tabelas_cache_total', 'acerto') - _antes[0], _metricas.valor('tabelas_cache_total', 'falta') - _antes[1]]
+''')
+    assert at.session_state['_r'] == ([True, 2, 1] if ativas else [True, 0, 0])
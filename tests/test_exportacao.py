@@ -0,0 +1,53 @@
+import pytest
+
+from conftest import popular
+
+@pytest.mark.parametrize('formato', ['CSV', 'XLSX', 'Parquet'])
+def test_gerar_arquivo_oferece_download(app, formato):
+    popular(app.col, 40)
+    at = app.criar()
+    at.session_state['view'] = 'Relatórios'
+    app.executar(at)
+    at.selectbox(key='exp_formato').set_value(formato)
+    at.button(key='exp_gerar').click()
+    app.executar(at)
+    assert not at.error
+    assert any('linha(s) exportada(s)' in c.value for c in at.caption)
+
+@pytest.mark.parametrize('formato', ['CSV', 'XLSX', 'Parquet'])
+def test_arquivo_acima_do_limite_nao_e_oferecido(app, monkeypatch, formato):
+    monkeypatch.setenv('MIDIA_EXPORTACAO_MAX_MB', '0.001')
+    popular(app.col, 200)
+    at = app.criar()
+    at.session_state['view'] = 'Relatórios'
+    app.executar(at)
+    at.selectbox(key='exp_tipo').set_value('Faturamentos')
+    at.selectbox(key='exp_formato').set_value(formato)
+    at.button(key='exp_gerar').click()
+    app.executar(at)
+    assert len(at.error) == 1 and 'MIDIA_EXPORTACAO_MAX_MB' in at.error[0].value
+    assert not any('linha(s) exportada(s)' in c.value for c in at.caption)
+
+def test_limite_interrompe_a_escrita_no_lote_que_passa_dele(app):
+    popular(app.col, 200)
+    at = app.rodar('''
+_lidos = []
+_iterar = iterar_linhas_exportacao
+def iterar_linhas_exportacao(tipo):
+    for linha in _iterar(tipo):
+        _lidos.append(linha)
+        yield linha
+try:
+    exportar_relatorio('Faturamentos', 'CSV', lote=10, limite=1000)
+    _erro = None
+except RuntimeError as e:
+    _erro = str(e)
+_arquivo, _total = exportar_relatorio('Faturamentos', 'CSV', lote=10)
+with _arquivo, open(_arquivo.fileno(), 'rb', closefd=False) as _leitor:
+    _conteudo = _leitor.read()
+st.session_state['_r'] = [_erro is not None, len(_lidos) - _total, _total, _conteudo.count(b'\\n') - 1]
+''')
+    erro, lidos_antes, total, linhas = at.session_state['_r']
+    assert erro
+    assert 0 < lidos_antes < total
+    assert linhas == total
@@ -0,0 +1,120 @@
+from conftest import popular
+
+# A fila de teste não drena sozinha: o teste chama _gravar com o lote que quiser reenviar
+FILA = '''
+class FilaTeste(FilaGravacao):
+    def _drenar(self):
+        pass
+
+fila = FilaTeste(get_backend(), {caminho!r})
+'''
+
+def _faturamento(n):
+    return {'id': f'FAT{n}', 'valor': 1.0, 'data_fatura': '2024-05-01', 'numero_fatura': str(n)}
+
+def test_lote_reenviado_nao_duplica_faturamentos(app, tmp_path):
+    popular(app.col, 5)
+    doc = dict(app.col.find_one({'_id': '00000001'}, {'created_at': 0, 'updated_at': 0}), _id='NOVO0001', faturamentos=[])
+    at = app.rodar(FILA.format(caminho=str(tmp_path / 'fila.db')) + f'''
+fila.enfileirar('incluir_faturamentos', ['00000001', [{_faturamento(2)!r}]], registro='00000001')
+fila.enfileirar('inserir', [{doc!r}], registro='NOVO0001')
+fila.enfileirar('incluir_faturamentos', ['NOVO0001', [{_faturamento(1)!r}]], registro='NOVO0001')
+lote = fila._proximo_lote()
+fila._gravar(lote)
+pendentes = fila.estado()['pendentes']
+# Tempo esgotado depois de o banco aplicar tudo: o mesmo lote volta inteiro
+fila._gravar(lote)
+st.session_state['_r'] = [pendentes, fila.estado()['pendentes']]
+''')
+    assert at.session_state['_r'] == [0, 0]
+    assert [f['id'] for f in app.col.find_one({'_id': 'NOVO0001'})['faturamentos']] == ['FAT1']
+    assert [f['id'] for f in app.col.find_one({'_id': '00000001'})['faturamentos']].count('FAT2') == 1
+
+def test_lote_aplicado_pela_metade_completa_sem_repetir(app, tmp_path):
+    popular(app.col, 5)
+    antes = len(app.col.find_one({'_id': '00000002'})['faturamentos'])
+    at = app.rodar(FILA.format(caminho=str(tmp_path / 'fila.db')) + f'''
+for n in range(3):
+    fila.enfileirar('incluir_faturamentos', ['00000002', [{{'id': f'FAT{{n}}', 'valor': 1.0, 'data_fatura': '2024-05-01', 'numero_fatura': str(n)}}]], registro='00000002')
+lote = fila._proximo_lote()
+# Um bulk_write ordenado interrompido depois da segunda operação
+backend = get_backend()
+for linha in lote[:2]:
+    args = json_util.loads(linha[3], json_options=json_util.CANONICAL_JSON_OPTIONS)
+    for colecao, modelo in backend.operacoes(linha[1], *args, idempotencia=(fila.instancia, linha[0])):
+        backend.col.database[colecao].bulk_write([modelo])
+fila._gravar(lote)
+st.session_state['_r'] = fila.estado()['pendentes']
+''')
+    assert at.session_state['_r'] == 0
+    doc = app.col.find_one({'_id': '00000002'})
+    assert [f['id'] for f in doc['faturamentos'][antes:]] == ['FAT0', 'FAT1', 'FAT2']
+    assert doc['total_faturado'] == sum(float(f['valor']) for f in doc['faturamentos'])
+
+def test_condicoes_vao_para_a_fila_e_recusas_viram_falhas(app, tmp_path):
+    popular(app.col, 5)
+    doc = app.col.find_one({'_id': '00000003'})
+    versao = doc.get('versao') or 0
+    saldo = doc['adiantamento']['valor'] - sum(f['valor'] for f in doc['faturamentos'])
+    at = app.rodar(FILA.format(caminho=str(tmp_path / 'fila.db')) + f'''
+recarregados = []
+fila.ao_recusar = lambda rid, doc: recarregados.append((rid, doc['versao']))
+sol = dict(get_cache_registros().registros['00000003']['solicitacao'].para_dict(), descricao='Na versão certa')
+fila.enfileirar('definir_solicitacao', ['00000003', sol], registro='00000003', condicoes={{'versao': {versao}}})
+fila.enfileirar('definir_solicitacao', ['00000003', dict(sol, descricao='Na versão antiga')], registro='00000003', condicoes={{'versao': {versao}}})
+fila.enfileirar('incluir_faturamentos', ['00000003', [{{'id': 'ALEM', 'valor': {saldo} + 1, 'data_fatura': '2024-05-01', 'numero_fatura': 'ALEM'}}]], registro='00000003', condicoes={{'limitar_saldo': True}})
+lote = fila._proximo_lote()
+fila._gravar(lote)
+recusas = list(recarregados)
+# Reenviar o lote não transforma em recusa a operação que já tinha sido aplicada
+fila._gravar(lote)
+erros = [erro for (erro,) in fila.conn.execute('SELECT erro FROM falhas ORDER BY seq')]
+st.session_state['_r'] = [fila.estado()['pendentes'], erros, recusas]
+''')
+    pendentes, erros, recarregados = at.session_state['_r']
+    assert pendentes == 0
+    assert erros == ['Registro 00000003 alterado por outro usuário', 'Saldo insuficiente no registro 00000003']
+    assert recarregados == [('00000003', versao + 1), ('00000003', versao + 1)]
+    doc = app.col.find_one({'_id': '00000003'})
+    assert doc['solicitacao']['descricao'] == 'Na versão certa'
+    assert doc['versao'] == versao + 1
+    assert 'ALEM' not in [f['id'] for f in doc['faturamentos']]
+
+def test_recusa_na_fila_desfaz_a_copia_local(app, tmp_path):
+    popular(app.col, 5)
+    at = app.rodar(FILA.format(caminho=str(tmp_path / 'fila.db')) + '''
+cache = get_cache_registros()
+cache.fila = fila
+fila.ao_recusar = cache.recarregar
+reg = cache.registros['00000004']
+versao = reg['versao']
+novo = reg.copia()
+novo['solicitacao'] = dict(reg['solicitacao'].para_dict(), descricao='Publicada antes da drenagem')
+cache.aplicar('00000004', novo)
+fila.enfileirar('definir_solicitacao', ['00000004', novo['solicitacao'].para_dict()], registro='00000004', condicoes={'versao': versao + 5})
+fila._gravar(fila._proximo_lote())
+st.session_state['_r'] = [cache.registros['00000004']['solicitacao']['descricao'] == reg['solicitacao']['descricao'], fila.estado()['falhas']]
+''')
+    assert at.session_state['_r'] == [True, 1]
+
+def test_importacao_com_write_behind_passa_pela_fila(app, monkeypatch, tmp_path):
+    monkeypatch.setenv('MIDIA_WRITE_BEHIND', '1')
+    monkeypatch.setenv('MIDIA_WRITE_BEHIND_ARQUIVO', str(tmp_path / 'fila.db'))
+    popular(app.col, 20)
+    rid = app.col.find_one({'adiantamento': {'$ne': None}, 'status': 'Em aberto'})['_id']
+    at = app.rodar(f'''
+import time
+res = importar_faturamentos([(1, {{'registro': {rid!r}, 'numero_fatura': 'IMP-FILA', 'valor': '1,00', 'data_fatura': '2024-05-01'}})])
+fila = get_fila_gravacao()
+fila.evento.set()
+limite = time.monotonic() + 10
+while fila.estado()['pendentes'] and time.monotonic() < limite:
+    time.sleep(0.05)
+st.session_state['_r'] = [res['aceitas'], fila.estado()['pendentes'], fila.instancia]
+''')
+    aceitas, pendentes, instancia = at.session_state['_r']
+    assert [aceitas, pendentes] == [1, 0]
+    doc = app.col.find_one({'_id': rid})
+    assert 'IMP-FILA' in [f['numero_fatura'] for f in doc['faturamentos']]
+    # Gravado pela fila: o documento guarda o seq aplicado por esta instância do journal
+    assert instancia in doc['fila']
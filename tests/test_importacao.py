@@ -0,0 +1,116 @@
+from conftest import popular
+
+VALORES = [
+    ('1234.56', None, 1234.56),
+    ('1.234,56', None, 1234.56),
+    ('1,234.56', None, 1234.56),
+    ('R$ 1.234,56', None, 1234.56),
+    ('1.234.567', None, 1234567.0),
+    ('1,234,567.5', None, 1234567.5),
+    ('10,5', None, 10.5),
+    ('10.50', None, 10.5),
+    ('0.125', None, 0.125),
+    ('-150,75', None, -150.75),
+    ('1.234', ',', 1234.0),
+    ('1.234', '.', 1.234),
+    ('1,234', ',', 1.234),
+    ('1,234', '.', 1234.0),
+    ('', None, 0.0),
+]
+
+def _avaliar(app, chamadas):
+    # Executa cada expressão no app e devolve o resultado ou o nome da exceção
+    at = app.rodar(f'''
+_r = []
+for _expr in {chamadas!r}:
+    try:
+        _r.append(eval(_expr))
+    except Exception as e:
+        _r.append(type(e).__name__)
+st.session_state['_r'] = _r
+''')
+    return at.session_state['_r']
+
+def test_valor_monetario(app):
+    chamadas = [f'_valor_monetario({texto!r}, {decimal!r})' for texto, decimal, _ in VALORES]
+    assert _avaliar(app, chamadas) == [esperado for _, _, esperado in VALORES]
+
+def test_valor_ambiguo_ou_mal_formado_e_recusado(app):
+    textos = ['1.234', '1,234', '1.23,45', '1,234,56', '12.34.5', 'abc', '1.2.3,4']
+    assert _avaliar(app, [f'_valor_monetario({t!r})' for t in textos]) == ['ValueError'] * len(textos)
+
+CSV_PONTO_E_VIRGULA = '''registro;numero_fatura;valor;data_fatura;descricao;unidade
+{rid};NF-1;1.234,56;05/03/2024;Primeira;
+{rid};NF-2;1.234;2024-03-06;Milhar;
+{rid};NF-3;10,5;2024-03-07;Decimal;
+'''
+
+CSV_VIRGULA = '''registro,numero_fatura,valor,data_fatura,descricao,unidade
+{rid},NF-4,"1,234.56",2024-03-05,Primeira,
+{rid},NF-5,1.234,2024-03-06,Decimal,
+{rid},NF-6,"1,234",2024-03-07,Milhar,
+'''
+
+OFX = '''OFXHEADER:100
+DATA:OFXSGML
+
+<OFX><BANKMSGSRSV1><STMTTRNRS><STMTRS><BANKTRANLIST>
+<STMTTRN><TRNTYPE>DEBIT<DTPOSTED>20240305120000[-3:BRT]<TRNAMT>-1234.56<FITID>F1<MEMO>Pagamento {rid}</STMTTRN>
+<STMTTRN><TRNTYPE>DEBIT<DTPOSTED>20240306<TRNAMT>-150,75<FITID>F2<CHECKNUM>889<MEMO>Sem código</STMTTRN>
+<STMTTRN><TRNTYPE>DEBIT<DTPOSTED>20240307<TRNAMT>1,234<FITID>F3<MEMO>Vírgula decimal</STMTTRN>
+<STMTTRN><TRNTYPE>DEBIT<DTPOSTED>20240308<TRNAMT>abc<FITID>F4<MEMO>Inválido</STMTTRN>
+</BANKTRANLIST></STMTRS></STMTTRNRS></BANKMSGSRSV1></OFX>
+'''
+
+def _importar(app, leitor, conteudo, codificacao='utf-8', registro_padrao=None):
+    # Simulação da importação: só validação e relatório, nada é gravado
+    argumentos = f'io.BytesIO({conteudo.encode(codificacao)!r})' + (f', {registro_padrao!r}' if registro_padrao else '')
+    at = app.rodar(f'''
+import io
+_res = importar_faturamentos({leitor}({argumentos}), permitir_exceder=True, simular=True)
+st.session_state['_r'] = [(l['Número fatura'], l['Valor'], l['Registro'], l['Motivo']) for l in _res['relatorio']]
+''')
+    return at.session_state['_r']
+
+def _rid(app):
+    return app.col.find_one({'adiantamento': {'$ne': None}})['_id']
+
+def test_csv_com_ponto_e_virgula_usa_virgula_decimal(app):
+    popular(app.col, 10)
+    rid = _rid(app)
+    linhas = _importar(app, 'ler_linhas_csv', CSV_PONTO_E_VIRGULA.format(rid=rid))
+    assert [(numero, valor) for numero, valor, _, _ in linhas] == [('NF-1', 1234.56), ('NF-2', 1234.0), ('NF-3', 10.5)]
+
+def test_csv_com_virgula_usa_ponto_decimal(app):
+    popular(app.col, 10)
+    rid = _rid(app)
+    linhas = _importar(app, 'ler_linhas_csv', CSV_VIRGULA.format(rid=rid))
+    assert [(numero, valor) for numero, valor, _, _ in linhas] == [('NF-4', 1234.56), ('NF-5', 1.234), ('NF-6', 1234.0)]
+
+def test_ofx_sem_separador_de_milhar(app):
+    popular(app.col, 10)
+    rid = _rid(app)
+    outro = app.col.find_one({'adiantamento': {'$ne': None}, '_id': {'$ne': rid}})['_id']
+    at = app.rodar(f'''
+import io
+st.session_state['_r'] = [l for _, l in ler_linhas_ofx(io.BytesIO({OFX.format(rid=outro).encode('cp1252')!r}), {rid!r})]
+''')
+    linhas = at.session_state['_r']
+    assert [(l['registro'], l['numero_fatura'], l['valor'], l['data_fatura']) for l in linhas] == [
+        (outro, 'F1', '1234.56', '2024-03-05'),
+        (rid, '889', '150.75', '2024-03-06'),
+        (rid, 'F3', '1.234', '2024-03-07'),
+        (rid, 'F4', 'abc', '2024-03-08'),
+    ]
+    relatorio = _importar(app, 'ler_linhas_ofx', OFX.format(rid=outro), 'cp1252', rid)
+    assert [(numero, valor) for numero, valor, _, _ in relatorio[:3]] == [('F1', 1234.56), ('889', 150.75), ('F3', 1.234)]
+    assert relatorio[3][1] is None and relatorio[3][3] == 'Valor inválido'
+
+def test_valor_ambiguo_sem_indicacao_do_arquivo_e_recusado(app):
+    popular(app.col, 10)
+    rid = _rid(app)
+    at = app.rodar(f'''
+_res = importar_faturamentos([(1, {{'registro': {rid!r}, 'numero_fatura': 'NF-9', 'valor': '1.234', 'data_fatura': '2024-03-05'}})], permitir_exceder=True, simular=True)
+st.session_state['_r'] = [_res['rejeitadas'], _res['relatorio'][0]['Motivo']]
+''')
+    assert at.session_state['_r'] == [1, 'Valor inválido']
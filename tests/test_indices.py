@@ -0,0 +1,28 @@
+import threading
+import time
+from unittest import mock
+
+import mongomock
+
+from conftest import popular
+
+def test_indices_criados_sem_atrasar_a_partida(app):
+    popular(app.col, 20)
+    liberar = threading.Event()
+    original = mongomock.collection.Collection.create_indexes
+
+    def lento(self, *args, **kwargs):
+        # Servidor ocupado construindo índices: create_indexes só volta quando o teste liberar
+        liberar.wait(30)
+        return original(self, *args, **kwargs)
+
+    with mock.patch.object(mongomock.collection.Collection, 'create_indexes', lento):
+        at = app.rodar("st.session_state['_r'] = len(st.session_state['registros'])")
+        assert at.session_state['_r'] == 20
+        assert 'unidade_solicitante_data' not in app.col.index_information()
+        liberar.set()
+        for _ in range(100):
+            if 'unidade_solicitante_data' in app.col.index_information():
+                break
+            time.sleep(0.05)
+    assert {'unidade_solicitante_data', 'status_data', 'updated_at'} <= set(app.col.index_information())
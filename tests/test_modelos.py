@@ -0,0 +1,106 @@
+DOC = {
+    'solicitacao': {'descricao': 'Campanha', 'solicitante': 'Ana', 'valor_estimado': '1500', 'data_solicitacao': '2024-03-01', 'observacoes': '', 'unidade': 'Centro'},
+    'adiantamento': {'valor': 1000, 'data_adiantamento': '2024-03-02', 'responsavel': 'Bruno', 'observacao': '', 'unidade': 'Centro'},
+    'faturamentos': [
+        {'id': 'F1', 'numero_fatura': 'NF-1', 'valor': '250.5', 'data_fatura': '2024-03-10', 'descricao': '', 'unidade': 'Centro'},
+        {'id': 'F2', 'numero_fatura': 'NF-2', 'valor': 100, 'data_fatura': '2024-04-10', 'descricao': '', 'unidade': 'Centro'},
+    ],
+    'status': 'Aberto',
+    'versao': 3,
+}
+
+def _rodar(app, codigo):
+    at = app.rodar(f'_doc = {DOC!r}\n{codigo}')
+    return at.session_state['_r']
+
+def test_de_dict_e_para_dict(app):
+    r = _rodar(app, '''
+_reg = Registro.de_dict(_doc)
+_outro = Registro.de_dict(_doc)
+st.session_state['_r'] = {
+    'tipos': [type(_reg).__name__, type(_reg.solicitacao).__name__, type(_reg.adiantamento).__name__, type(_reg.faturamentos).__name__, type(_reg.faturamentos[0]).__name__],
+    'valores': [_reg.solicitacao.valor_estimado, _reg.adiantamento.valor, _reg.faturamentos[0].valor],
+    'internados': _reg.solicitacao.solicitante is _outro.solicitacao.solicitante and _reg.faturamentos[1].data_fatura is _outro.faturamentos[1].data_fatura,
+    'dict': _reg.para_dict(),
+    'igual': _reg == Registro.de_dict(_reg.para_dict()) and _reg == _outro.para_dict(),
+}
+''')
+    assert r['tipos'] == ['Registro', 'Solicitacao', 'Adiantamento', 'Faturamentos', 'Faturamento']
+    assert r['valores'] == [1500.0, 1000.0, 250.5]
+    assert all(isinstance(v, float) for v in r['valores'])
+    assert r['internados']
+    esperado = dict(DOC)
+    esperado['solicitacao'] = dict(DOC['solicitacao'], valor_estimado=1500.0)
+    esperado['adiantamento'] = dict(DOC['adiantamento'], valor=1000.0)
+    esperado['faturamentos'] = [dict(f, valor=float(f['valor'])) for f in DOC['faturamentos']]
+    assert r['dict'] == esperado
+    assert r['igual']
+
+def test_acesso_por_chave(app):
+    r = _rodar(app, '''
+_reg = Registro.de_dict({'solicitacao': _doc['solicitacao'], 'adiantamento': None, 'faturamentos': []})
+_r = []
+for _expr in ["_reg['solicitacao']['unidade']", "_reg['adiantamento']", "_reg['saldo']", "_reg['inexistente']",
+              "_reg.get('saldo', 'padrao')", "_reg.get('inexistente', 'padrao')", "'saldo' in _reg", "'adiantamento' in _reg",
+              "'inexistente' in _reg", "sorted(_reg.keys())", "_reg.__setitem__('inexistente', 1)"]:
+    try:
+        _r.append(eval(_expr))
+    except Exception as e:
+        _r.append(type(e).__name__)
+st.session_state['_r'] = _r
+''')
+    assert r == ['Centro', None, 'KeyError', 'KeyError', 'padrao', 'padrao', False, True, False,
+                 ['adiantamento', 'faturamentos', 'solicitacao'], 'KeyError']
+
+def test_recalcular_totais(app):
+    r = _rodar(app, '''
+_reg = Registro.de_dict(_doc).recalcular_totais()
+_sem = Registro.de_dict({'solicitacao': _doc['solicitacao'], 'adiantamento': None, 'faturamentos': []}).recalcular_totais()
+_documento = _recalcular_totais(dict(_doc, faturamentos=[dict(f) for f in _doc['faturamentos']]))
+st.session_state['_r'] = [(_reg.total_faturado, _reg.saldo, _reg.status), (_sem.total_faturado, _sem.saldo, _sem.status),
+                          (_documento['total_faturado'], _documento['saldo'], _documento['status'])]
+''')
+    assert r[0] == r[2] == (350.5, 649.5, r[0][2])
+    assert r[1][:2] == (0.0, 0.0)
+
+def test_copia_nao_altera_o_original(app):
+    r = _rodar(app, '''
+_reg = Registro.de_dict(_doc).recalcular_totais()
+_nova = _reg.copia()
+_nova.faturamentos.append({'id': 'F3', 'numero_fatura': 'NF-3', 'valor': 50, 'data_fatura': '2024-05-01', 'descricao': '', 'unidade': 'Centro'})
+_nova['solicitacao'] = dict(_reg.solicitacao.para_dict(), descricao='Outra')
+_nova.recalcular_totais()
+st.session_state['_r'] = [len(_reg.faturamentos), _reg.saldo, _reg.solicitacao.descricao, len(_nova.faturamentos), _nova.saldo,
+                          _nova.solicitacao.descricao, _nova.faturamentos[0] is _reg.faturamentos[0], _nova.versao]
+''')
+    assert r == [2, 649.5, 'Campanha', 3, 599.5, 'Outra', True, 3]
+
+def test_indice_de_faturamentos(app):
+    # A cada alteração, o índice id -> posição confere com a lista
+    r = _rodar(app, '''
+def _f(i):
+    return {'id': f'F{i}', 'numero_fatura': f'NF-{i}', 'valor': i, 'data_fatura': '2024-03-01', 'descricao': '', 'unidade': 'Centro'}
+def _confere(fats):
+    return all(fats.por_id(f.id) is f for f in fats) and fats.por_id('nenhum') is None
+_fats = Faturamentos([_f(i) for i in range(5)])
+_r = [_confere(_fats)]
+_fats.append(_f(5)); _r.append(_confere(_fats))
+_fats.extend([_f(6), _f(7)]); _r.append(_confere(_fats))
+_fats += [_f(8)]; _r.append(_confere(_fats))
+_fats[2] = _f(20); _r.append(_confere(_fats) and _fats.por_id('F2') is None)
+_fats[-1] = _f(21); _r.append(_confere(_fats) and _fats.por_id('F8') is None)
+del _fats[0]; _r.append(_confere(_fats) and _fats.por_id('F0') is None)
+del _fats[-2]; _r.append(_confere(_fats) and _fats.por_id('F7') is None)
+del _fats[1:3]; _r.append(_confere(_fats))
+_fats.insert(1, _f(30)); _r.append(_confere(_fats))
+_fats.pop(); _r.append(_confere(_fats))
+_fats.sort(key=lambda f: f.valor, reverse=True); _r.append(_confere(_fats))
+_fats.reverse(); _r.append(_confere(_fats))
+_fats.remove(_fats[0]); _r.append(_confere(_fats))
+list.append(_fats, Faturamento.de_dict(_f(40))); _fats.reindexar(); _r.append(_confere(_fats))
+_r.append([f.id for f in _fats])
+_fats.clear(); _r.append(_fats.por_id('F40') is None)
+st.session_state['_r'] = _r
+''')
+    assert all(r[:15]) and r[16], r
+    assert r[15] == ['F4', 'F5', 'F6', 'F30', 'F40']
@@ -0,0 +1,39 @@
+from conftest import popular
+
+PAGINAR_TUDO = '''
+def _paginar(filtro, limite=7):
+    ids, apos = [], None
+    while True:
+        docs, apos = buscar_pagina_registros(filtro, apos, limite)
+        ids += [d['_id'] for d in docs]
+        if apos is None:
+            return ids
+'''
+
+def test_paginas_cobrem_todos_os_registros_em_ordem(app):
+    popular(app.col, 60)
+    at = app.rodar(PAGINAR_TUDO + '''
+st.session_state['_r'] = [_paginar('todos'), _paginar('com_adiantamento')]
+''')
+    todos, com_adiantamento = at.session_state['_r']
+    assert todos == sorted(d['_id'] for d in app.col.find({}, {'_id': 1}))
+    assert com_adiantamento == sorted(d['_id'] for d in app.col.find({'adiantamento': {'$ne': None}}, {'_id': 1}))
+
+def test_registro_novo_aparece_no_seletor_com_write_behind(app, monkeypatch, tmp_path):
+    monkeypatch.setenv('MIDIA_WRITE_BEHIND', '1')
+    monkeypatch.setenv('MIDIA_WRITE_BEHIND_ARQUIVO', str(tmp_path / 'fila.db'))
+    popular(app.col, 20)
+    at = app.rodar(PAGINAR_TUDO + '''
+_rid = novo_registro('Na fila', SOLICITANTES[0], 10.0, date(2024, 1, 1), '', UNIDADES[0])
+st.session_state['_r'] = [_rid, _rid in _paginar('sem_adiantamento')]
+''')
+    assert at.session_state['_r'][1]
+
+def test_seletor_com_backend_sqlite(app, monkeypatch, tmp_path):
+    monkeypatch.setenv('MIDIA_BACKEND', 'sqlite')
+    monkeypatch.setenv('MIDIA_SQLITE_ARQUIVO', str(tmp_path / 'midia.db'))
+    at = app.rodar(PAGINAR_TUDO + '''
+_rids = [novo_registro(f'SQLite {i}', SOLICITANTES[0], 10.0, date(2024, 1, 1), '', UNIDADES[0]) for i in range(15)]
+st.session_state['_r'] = [_paginar('todos') == sorted(_rids), get_backend().nome]
+''')
+    assert at.session_state['_r'] == [True, 'sqlite']
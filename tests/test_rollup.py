@@ -0,0 +1,102 @@
+import pytest
+
+# Sequência aleatória (semente fixa) de alterações feitas pelos helpers do app; depois de cada uma,
+# a consolidação mensal mantida por incremento tem de ser igual à refeita do zero e aos totais do
+# dashboard calculados pelo backend. No SQLite: o mongomock não executa o $mergeObjects da edição
+# de faturamento.
+SEQUENCIA = '''
+import random
+_rnd = random.Random({semente})
+
+def _data():
+    return date(2023, 1, 1) + timedelta(days=_rnd.randrange(540))
+
+def _ativos(predicado=lambda reg: True):
+    return sorted(rid for rid, reg in st.session_state['registros'].items() if predicado(reg))
+
+def _confere(passo):
+    rollup = rollup_mensal()
+    if rollup.totais != RollupMensal(st.session_state['registros']).totais:
+        return f'{{passo}}: difere da consolidação completa'
+    for unidades in (None, [_rnd.choice(UNIDADES[:3])]):
+        totais, _ = agregar_dashboard(unidades)
+        serie = rollup.serie(unidades)
+        adiantado = sum(_centavos(l['Adiantado']) for l in serie)
+        faturado = sum(_centavos(l['Faturado']) for l in serie)
+        if (adiantado, faturado) != (_centavos(totais['adiantado']), _centavos(totais['faturado'])):
+            return f'{{passo}}: difere do dashboard com unidades={{unidades}}'
+    return None
+
+def _saldo(rid):
+    return calcular_consumo(rid)[2]
+
+for _i in range(12):
+    _rid = novo_registro(f'Rollup {{_i}}', _rnd.choice(SOLICITANTES[:3]), 1000.0, _data(), '', _rnd.choice(UNIDADES[:3]))
+    if _i % 4:
+        registrar_adiantamento(_rid, float(_rnd.randrange(200, 1000)), _data(), RESPONSAVEL[0], '')
+
+_arquivados = []
+_feitos = set()
+_erros = [_confere('carga')]
+for _passo in range(60):
+    _op = _rnd.choice(['incluir', 'incluir', 'editar', 'excluir', 'encerrar', 'adiantamento', 'unidade', 'arquivar', 'restaurar'])
+    com_saldo = _ativos(lambda reg: reg['adiantamento'] and reg['saldo'] > 1)
+    com_faturas = _ativos(lambda reg: reg['faturamentos'])
+    if _op == 'incluir' and com_saldo:
+        _rid = _rnd.choice(com_saldo)
+        adicionar_faturamento(_rid, f'NF-{{_passo}}', round(_rnd.uniform(0.01, min(_saldo(_rid), 300)), 2), _data(), '')
+    elif _op == 'encerrar' and com_saldo:
+        _rid = _rnd.choice(com_saldo)
+        adicionar_faturamento(_rid, f'NF-{{_passo}}', _saldo(_rid), _data(), '')
+    elif _op == 'editar' and com_faturas:
+        _rid = _rnd.choice(com_faturas)
+        _f = _rnd.choice(st.session_state['registros'][_rid]['faturamentos'])
+        editar_faturamento(_rid, _f['id'], _f['numero_fatura'], round(_f['valor'] * _rnd.uniform(0.2, 1.0), 2), _data(), 'Editado')
+    elif _op == 'excluir' and com_faturas:
+        _rid = _rnd.choice(com_faturas)
+        excluir_faturamento(_rid, _rnd.choice(st.session_state['registros'][_rid]['faturamentos'])['id'])
+    elif _op == 'adiantamento' and _ativos(lambda reg: reg['adiantamento']):
+        _rid = _rnd.choice(_ativos(lambda reg: reg['adiantamento']))
+        _reg = st.session_state['registros'][_rid]
+        editar_adiantamento(_rid, _reg['total_faturado'] + _rnd.randrange(0, 500), _data(), RESPONSAVEL[0], '')
+    elif _op == 'unidade':
+        _rid = _rnd.choice(_ativos())
+        _sol = st.session_state['registros'][_rid]['solicitacao']
+        atualizar_registro(_rid, _sol['descricao'], _rnd.choice(SOLICITANTES[:3]), 1000.0, _sol['data_solicitacao'], '', _rnd.choice(UNIDADES[:3]))
+    elif _op == 'arquivar':
+        _novos = arquivar_encerrados(0)
+        if not _novos:
+            continue
+        _arquivados += _novos
+    elif _op == 'restaurar' and _arquivados:
+        if not restaurar_arquivado(_arquivados.pop(_rnd.randrange(len(_arquivados)))):
+            continue
+    else:
+        continue
+    _feitos.add(_op)
+    _erros.append(_confere(f'{{_passo}} {{_op}}'))
+
+# Ao final, encerra mais um registro, arquiva os encerrados e restaura um a um
+_rid = _rnd.choice(_ativos(lambda reg: reg['adiantamento'] and reg['saldo'] > 0))
+adicionar_faturamento(_rid, 'NF-FINAL', _saldo(_rid), _data(), '')
+_novos = arquivar_encerrados(0)
+if _novos:
+    _feitos.add('arquivar')
+_arquivados += _novos
+_erros.append(_confere('arquivar no final'))
+for _rid in _arquivados:
+    if restaurar_arquivado(_rid):
+        _feitos.add('restaurar')
+    _erros.append(_confere(f'restaurar {{_rid}}'))
+st.session_state['_r'] = [[e for e in _erros if e], sorted(_feitos)]
+'''
+
+@pytest.mark.parametrize('semente', [1, 2, 3])
+def test_rollup_igual_a_consolidacao_completa_e_ao_dashboard(app, monkeypatch, tmp_path, semente):
+    monkeypatch.setenv('MIDIA_BACKEND', 'sqlite')
+    monkeypatch.setenv('MIDIA_SQLITE_ARQUIVO', str(tmp_path / 'midia.db'))
+    at = app.rodar(SEQUENCIA.format(semente=semente))
+    erros, feitos = at.session_state['_r']
+    assert erros == []
+    assert {'incluir', 'editar', 'excluir', 'arquivar', 'restaurar'} <= set(feitos)
+    assert not at.error